@@ -2,9 +2,9 @@
 
 # external - default
 
-import os
 import math
 import time
+import uuid
 import webbrowser
 
 # external - installed
@@ -17,11 +17,10 @@ import pandas
 
 # internal
 
-import ext.systools as systools
-
-from mediasleuth.platform import temp_directory
+from mediasleuth.workspace import get_workspace
 from mediasleuth.mediainspection_display import MediaInspectionDisplayItem
 from mediasleuth.config import MediaSleuthConfig
+from mediasleuth.registry import column_property
 
 
 '''
@@ -84,6 +83,9 @@ class MainWindow(wx.Frame):
         self.results = []
         self.config = MediaSleuthConfig().config
 
+        # this also clears out any working files orphaned by previous runs
+        self.workspace = get_workspace(self.config)
+
         # Set UI style - dark mode
         font_color, bg_color = dark_mode_check()
         self.SetBackgroundColour(bg_color)
@@ -130,6 +132,19 @@ class MainWindow(wx.Frame):
             ["SLATE DATE",        0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_CENTRE, True],
             ["SLATE ASPECT",      0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_CENTRE, True],
             ["SLATE DURATION",    0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_CENTRE, True],
+            ["PICTURE ACCURACY",  0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_CENTRE, True],
+            ["FRAME RATE MODE",   0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_CENTRE, True],
+            ["PEAK BITRATE",      0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_CENTRE, True],
+            ["MAX GOP",           0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_CENTRE, True],
+            ["AUDIO LAYOUT",      0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_CENTRE, True],
+            ["AUDIO PROGRAMMES",  0, DATA_CELL_MIN_WIDTH * 3,   wx.ALIGN_LEFT,   True],
+            ["CONTENT LOUDNESS",  0, DATA_CELL_MIN_WIDTH * 3,   wx.ALIGN_LEFT,   True],
+            ["BURN INS",          0, DATA_CELL_MIN_WIDTH * 3,   wx.ALIGN_LEFT,   True],
+            ["MD5",               0, DATA_CELL_MIN_WIDTH * 2,   wx.ALIGN_LEFT,   True],
+            ["SHA-256",           0, DATA_CELL_MIN_WIDTH * 3,   wx.ALIGN_LEFT,   True],
+            ["XXH64",             0, DATA_CELL_MIN_WIDTH,       wx.ALIGN_LEFT,   True],
+            ["FINGERPRINT",       0, DATA_CELL_MIN_WIDTH * 2,   wx.ALIGN_LEFT,   True],
+            ["LIBRARY MATCH",     0, DATA_CELL_MIN_WIDTH * 3,   wx.ALIGN_LEFT,   True],
 
         ]
 
@@ -203,21 +218,12 @@ class MainWindow(wx.Frame):
 
     def tempfiles_flush(self, event):
         """
-        Delete all the temp working files
-        Has a disclaimer that unfinished jobs will be in error
+        Delete all the temp working files that aren't in use
+        Files that running checks still need are left alone, so this is safe to do at any time
 
         TODO maybe this should also clear the dataview? dunno tho, the existing jobs may have been completed
         """
-        dialog = wx.MessageDialog(self,
-                                  "This will cause errors for any currently running checks.",
-                                  "CAUTION",
-                                  wx.ICON_WARNING | wx.OK | wx.CANCEL)
-
-        # this cancels the operation if the user backs out
-        if not dialog.ShowModal():
-            return
-
-        systools.rm(temp_directory())
+        self.workspace.flush()
 
     def dataview_clear(self):
         """
@@ -243,6 +249,21 @@ class MainWindow(wx.Frame):
         column = self.dataview_get_column_by_name(column_name)
         column.SetHidden(not column.IsHidden())
 
+        # if the column is now showing, make sure whatever fills it gets worked out
+        # this is a no-op for results that already have (or are working on) the value
+        property_key = column_property(column_name)
+        if not column.IsHidden() and property_key:
+            for result in self.results:
+                result.request_properties([property_key])
+
+    def visible_properties(self):
+        """
+        The property keys of all the columns currently showing
+        These are the only properties we bother to work out, as they are the only ones that can be seen or exported
+        """
+        keys = [column_property(c.GetTitle()) for c in self.columns if not c.IsHidden()]
+        return [x for x in keys if x]
+
     def dataview_get_column_by_name(self, name):
         matches = [x for x in self.columns if name == x.GetTitle()]
         if matches:
@@ -263,7 +284,7 @@ class MainWindow(wx.Frame):
         item = self.dataview.AppendItem(new_item.display_results)
         new_item.item = item
 
-        new_item.start_threads()
+        new_item.start_threads(self.visible_properties())
 
         # todo diagnose this problem - it may causes crashes
         # slow down the input of many files at once
@@ -275,6 +296,9 @@ class MainWindow(wx.Frame):
 
         print("Refreshing file in dataview : {}".format(filepath))
 
+        # stop the old checks first, otherwise we'll have two lots of processes running on the same file
+        result.cancel()
+
         new_item = MediaInspectionDisplayItem(self, filepath)
 
         target_index = self.results.index(result)
@@ -282,7 +306,7 @@ class MainWindow(wx.Frame):
 
         new_item.item = result.item
 
-        new_item.start_threads()
+        new_item.start_threads(self.visible_properties())
 
         # todo diagnose this problem - it may causes crashes
         # slow down the input of many files at once
@@ -363,12 +387,15 @@ class MainWindow(wx.Frame):
         html_data = html_data.replace('<td>', '<td style="{}">'.format(td_style))
 
         # todo put io elsewhere?
-        systools.mkdir(temp_directory("table"))
-        html_path = os.path.join(temp_directory("table"), 'mediasleuth_results.html')
+        html_path = self.workspace.new_artifact(uuid.uuid1(), "table", "html")
 
         with open(html_path, 'w+') as f:
             f.write(html_data)
 
+        # the browser needs it after we're done, so keep it around until it needs to make room
+        self.workspace.written(html_path)
+        self.workspace.retain(html_path)
+
         webbrowser.open('file://{}'.format(html_path))
 
     def dataview_copy(self, event=None):
@@ -14,8 +14,16 @@ Reason being : ffmpeg is an incredibly robust tool, and supporting it in a meani
     If we need that there is always this - https://github.com/kkroening/ffmpeg-python
 """
 
+import os
 import re
+import sys
 import json
+import math
+import time
+import array
+import bisect
+import signal
+import threading
 import subprocess
 
 """
@@ -55,31 +63,215 @@ FULL VALUE CLASSES
 A class that gets all the info one time, stores it, and you can look at it all kinds of ways
 These are preferable to the single value methods for most purposes 
 
-TODO reconcile this 
 Initially the goals was to have the Stream object be the big kahuna that holds all the cards
-However, several diagnostic tasks require a completely different command to run, meaning that it basically CAN'T combine
+However, several diagnostic tasks require a completely different command to run
     ie VolumeDetection, LoudnessDetection, CropDetection
-part of me wants to try and route us back to that paradigm
-alternatively make the underlying function call clearer, and more different in the class names
+So rather than route them back through the Stream, they each describe their part of a decode as a FilterTap,
+    and any number of them can share the one decode, see FUSED DECODES
 """
 
 
+"""
+FUSED DECODES
+
+A FilterTap is one check's filters, the streams they take, and what to do with whatever those filters log
+A FusedDecode puts every tap it's given into the one -filter_complex:
+    any stream wanted by more than one tap is split (split / asplit), so each tap gets its own copy
+    every tap's outputs go to the one null output, unless a tap writes something (eg an image), then it gets its own
+    each tap has a tag, which goes in the names of its filters (eg astats@f0_t1), so its logs find their way back to it
+So adding a check to a decode adds the cost of its filters, rather than another demux and decode of the whole file
+
+The detection classes all take decode=None
+    without one they run a decode of their own, the way they always have
+    with one they add their tap to it, and have their results once whoever owns the decode has run it
+NOTE : a shared decode has the one window (its input_args), so a detection's own ss_from / to don't apply
+NOTE : MetadataWatch stays on its own, it stops its decode early and that would cut short everything sharing it
+"""
+
+
+class FilterTap:
+    def __init__(self, inputs, graph, read=None, outputs=None, finish=None):
+        """
+        inputs - stream specifiers, eg ['a:0', 'a:1']
+        graph - graph(tag, inputs, outputs) returns the tap's filter_complex chains
+            inputs and outputs are the pad labels to use, and tag goes on the front of any filter name that logs
+        read - read(filter, name, message) is given each line the tap's filters log, with the tag taken off the name
+        outputs - the output options for each output, None for the null output (the default is one null output)
+        finish - called once the decode has run
+        """
+        self.inputs = inputs
+        self.graph = graph
+        self.read = read
+        self.outputs = outputs or [None]
+        self.finish = finish
+
+        # given by the decode it's added to
+        self.tag = None
+
+
+class FusedDecode:
+    def __init__(self, file, input_args='', executable='ffmpeg', cancel_token=None, timeout=None, source=None):
+        self.file = file
+        self.input_args = input_args
+        self.executable = executable
+        self.cancel_token = cancel_token
+        self.timeout = timeout
+
+        # a command that writes what we decode to stdout as nut (eg sampled_packets_cmd), instead of reading the file
+        # NOTE : the input_args are then the source's business, and the taps only have what it gives them
+        self.source = source
+
+        self.taps = []
+        self.finished = False
+
+    def add(self, tap):
+        if self.finished:
+            raise RuntimeError("Can't add a tap to a decode that has already run")
+        tap.tag = 'f{}'.format(len(self.taps))
+        self.taps.append(tap)
+        return tap
+
+    def command(self):
+        chains = []
+
+        # how many taps want each stream
+        uses = {}
+        for tap in self.taps:
+            for specifier in tap.inputs:
+                uses[specifier] = uses.get(specifier, 0) + 1
+
+        pads = {}
+        for n, (specifier, count) in enumerate(uses.items()):
+            if count == 1:
+                pads[specifier] = ['0:{}'.format(specifier)]
+                continue
+            pads[specifier] = ['s{}_{}'.format(n, i) for i in range(count)]
+            chains.append('[0:{}]{}={}{}'.format(specifier,
+                                                 'asplit' if specifier.startswith('a') else 'split',
+                                                 count,
+                                                 ''.join(['[{}]'.format(x) for x in pads[specifier]])))
+
+        null_outputs = []
+        maps = []
+        for tap in self.taps:
+            inputs = [pads[x].pop(0) for x in tap.inputs]
+            outputs = ['{}o{}'.format(tap.tag, i) for i in range(len(tap.outputs))]
+            chains.append(tap.graph(tap.tag + '_', inputs, outputs))
+
+            for label, options in zip(outputs, tap.outputs):
+                if options is None:
+                    null_outputs.append(label)
+                else:
+                    maps.append('-map "[{}]" {}'.format(label, options))
+
+        if null_outputs:
+            maps.append('{} -f null -'.format(' '.join(['-map "[{}]"'.format(x) for x in null_outputs])))
+
+        if self.source:
+            return '{} | {} -nostats -hide_banner -y -f nut -i - -filter_complex "{}" {} 2>&1'.format(self.source,
+                                                                                                    self.executable,
+                                                                                                    ';'.join(chains),
+                                                                                                    ' '.join(maps))
+
+        return '{} -nostats -hide_banner -y {} -i "{}" -filter_complex "{}" {} 2>&1'.format(self.executable,
+                                                                                          self.input_args,
+                                                                                          self.file,
+                                                                                          ';'.join(chains),
+                                                                                          ' '.join(maps))
+
+    def run(self):
+        """
+        Lines from a filter start with its name, and anything it logs over several lines only has the name on the first
+        """
+        taps = {x.tag: x for x in self.taps}
+
+        # the logs can be a lot of text on a long file (eg ebur128 is ten lines a second), so we read them as they come
+        current = None
+        for line in iter_ffcmd_lines(self.command(), cancel_token=self.cancel_token, timeout=self.timeout):
+            line = line.rstrip('\r\n')
+            match = re.match(r'^\[(?P<name>[^\s\]]+) @ [^\]]+\]\s?(?P<message>.*)$', line)
+            if match:
+                current = match.group('name')
+                message = match.group('message')
+            else:
+                message = line
+
+            if not current:
+                continue
+
+            kind, _, instance = current.partition('@')
+            tag, _, name = instance.partition('_')
+            tap = taps.get(tag)
+            if tap is not None and tap.read is not None:
+                tap.read(kind, name, message)
+
+        self.finished = True
+        for tap in self.taps:
+            if tap.finish is not None:
+                tap.finish()
+
+
+# codecs (ffprobe's codec_name) where every frame decodes on its own, eg the mezzanine codecs masters come in
+INTRA_ONLY_CODECS = ('prores', 'dnxhd', 'mjpeg', 'jpeg2000', 'v210', 'v410', 'r210', 'rawvideo', 'huffyuv',
+                     'ffvhuff', 'utvideo', 'cfhd', 'hap', 'ffv1', 'qtrle', 'png', 'tiff', 'dpx', 'exr')
+
+
+def sampled_packets_cmd(file, every, input_args='', executable='ffmpeg'):
+    """
+    Copies every Nth packet of the first video stream to stdout as nut, without decoding anything
+    Whatever decodes that only ever decodes the frames we keep, where a select filter would decode them all to drop most
+    IMPORTANT : only for intra-only codecs (see INTRA_ONLY_CODECS), where every packet is a whole frame on its own
+        with anything else the frames we kept would need the ones we dropped to decode
+    NOTE : the drop expression of the noise bitstream filter needs ffmpeg 5.1 or newer
+    """
+    return '{} -nostats -hide_banner -loglevel error {} -i "{}" -map 0:v:0 -c copy -bsf:v "noise=drop=mod(n\\,{})" ' \
+           '-f nut -'.format(executable, input_args, file, every)
+
+
+def window_args(ss_from=0, to=0):
+    """
+    The input options to decode from ss_from to to (in seconds), where 0 is the start / end
+    """
+    args = ''
+    if ss_from:
+        args += '-ss {} '.format(ss_from)
+    if to:
+        args += '-to {} '.format(to)
+    return args
+
+
+def run_tap(file, tap, ss_from=0, to=0, decode=None, cancel_token=None, timeout=None):
+    """
+    Adds the tap to the decode, or if there isn't one, runs a decode of its own with just the tap in it
+    """
+    if decode is not None:
+        decode.add(tap)
+        return
+
+    decode = FusedDecode(file, window_args(ss_from, to), cancel_token=cancel_token, timeout=timeout)
+    decode.add(tap)
+    decode.run()
+
+
 class VolumeDetection:
-    def __init__(self, file, ss_from=0, to=0):
+    def __init__(self, file, ss_from=0, to=0, cancel_token=None, timeout=None, decode=None):
         self.file = file
 
-        from_cmd = ''
-        if ss_from:
-            from_cmd = '-ss {} '.format(ss_from)
+        self.raw = ''
+        self._messages = []
 
-        to_cmd = ''
-        if to:
-            to_cmd = '-to {} '.format(to)
+        self._n_samples = ''
+        self._mean_volume = ''
+        self._max_volume = ''
+
+        tap = FilterTap(['a:0'],
+                        lambda tag, inputs, outputs: '[{}]volumedetect@{}v[{}]'.format(inputs[0], tag, outputs[0]),
+                        read=lambda kind, name, message: self._messages.append(message),
+                        finish=self.read_results)
+        run_tap(file, tap, ss_from, to, decode=decode, cancel_token=cancel_token, timeout=timeout)
 
-        # todo test swapping quotes for windows
-        # self._cmd = "{} {} -i '{}' -af 'volumedetect' -f null /dev/null 2>&1".format(from_cmd, to_cmd, file)
-        self._cmd = '{} {} -i "{}" -af "volumedetect" -f null /dev/null 2>&1'.format(from_cmd, to_cmd, file)
-        self.raw = ffmpeg(self._cmd)
+    def read_results(self):
+        self.raw = '\n'.join(self._messages)
 
         # todo testing the speed of getting all information possible
         self._n_samples =      self.get_analysed_value("n_samples")
@@ -117,23 +309,30 @@ class VolumeDetection:
 
 
 class LoudnessDetection:
-    def __init__(self, file, ss_from=0, to=0):
+    def __init__(self, file, ss_from=0, to=0, cancel_token=None, timeout=None, decode=None):
         self.file = file
 
-        from_cmd = ''
-        if ss_from:
-            from_cmd = '-ss {} '.format(ss_from)
+        self.raw = ''
+        self._messages = []
 
-        to_cmd = ''
-        if to:
-            to_cmd = '-to {} '.format(to)
+        self.timeline = LoudnessTimeline()
+        self._integrated_loudness = None
+
+        tap = FilterTap(['a:0'],
+                        lambda tag, inputs, outputs: '[{}]ebur128@{}l=peak=true[{}]'.format(inputs[0],
+                                                                                            tag,
+                                                                                            outputs[0]),
+                        read=lambda kind, name, message: self._messages.append(message),
+                        finish=self.read_results)
+        run_tap(file, tap, ss_from, to, decode=decode, cancel_token=cancel_token, timeout=timeout)
 
-        # todo test swapping quotes for windows
-        # self._cmd = "-nostats {} {} -i '{}' -filter_complex ebur128 -f null /dev/null".format(from_cmd, to_cmd, file)
-        self._cmd = '-nostats {} {} -i "{}" -filter_complex ebur128 -f null /dev/null 2>&1'.format(from_cmd,
-                                                                                                   to_cmd,
-                                                                                                   file)
-        self.raw = ffmpeg(self._cmd)
+    def read_results(self):
+        self.raw = '\n'.join(self._messages)
+
+        for line in self._messages:
+            block = parse_ebur128_block(line)
+            if block:
+                self.timeline.append(*block)
 
         """
         This is a little bit borked because the ffmpeg call prints out an integrated loudness value progressively,
@@ -163,13 +362,342 @@ class LoudnessDetection:
             print('Malformed loudness information : {}'.format(e))
             return 0
 
+    def momentary_blocks(self):
+        """
+        ebur128 logs the momentary loudness every 100ms, each one measured over the 400ms up to that point
+        These are exactly the gating blocks that integrated loudness is built from,
+        so measurements of separate parts of a file can be combined by gating all their blocks together
 
-class CropDetection:
+        Returns a list of (seconds, momentary loudness) in the order they were logged
+        """
+        return list(zip(self.timeline.times, self.timeline.momentary))
+
+
+class LoudnessTimeline:
     """
-    This is an experimental function - I'm not very confident that this will provide consistent useful results
+    The loudness of a programme over time, as ebur128 logs it every 100ms
+        momentary - over the 400ms up to that point, these are the gating blocks that integrated loudness is built from
+        short_term - over the 3s up to that point, which loudness range is built from
+        true_peak - the highest true peak of any channel in the 100ms up to that point (dBTP)
+
+    Each is a float32 array alongside times (the seconds each block ends at), so a feature is only a few hundred KB
+    With these any part of the programme can be measured again (eg just the content), or drawn, without a decode
+    A value that isn't known (eg a short term block that isn't whole yet) is nan
     """
-    def __init__(self, file, ss_from=0, to=0):
+    def __init__(self):
+        self.times = array.array('f')
+        self.momentary = array.array('f')
+        self.short_term = array.array('f')
+        self.true_peak = array.array('f')
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, t, momentary, short_term, true_peak=float('nan')):
+        self.times.append(t)
+        self.momentary.append(momentary)
+        self.short_term.append(short_term)
+        self.true_peak.append(true_peak)
+
+    def window(self, seconds_from=None, seconds_to=None):
+        """
+        The range of blocks that end inside the window, as (first, last) indexes to slice with
+        """
+        first = 0 if seconds_from is None else bisect.bisect_left(self.times, seconds_from)
+        last = len(self.times) if seconds_to is None else bisect.bisect_right(self.times, seconds_to)
+        return first, max(first, last)
+
+    def momentary_between(self, seconds_from=None, seconds_to=None):
+        first, last = self.window(seconds_from, seconds_to)
+        return self.momentary[first:last]
+
+    def short_term_between(self, seconds_from=None, seconds_to=None):
+        first, last = self.window(seconds_from, seconds_to)
+        return self.short_term[first:last]
+
+    def true_peak_between(self, seconds_from=None, seconds_to=None):
+        first, last = self.window(seconds_from, seconds_to)
+        peaks = [x for x in self.true_peak[first:last] if not math.isnan(x)]
+        return max(peaks) if peaks else None
+
+    def tobytes(self):
+        return b''.join(x.tobytes() for x in (self.times, self.momentary, self.short_term, self.true_peak))
+
+    def frombytes(self, data):
+        """
+        The four arrays back to back, as tobytes writes them
+        """
+        size = len(data) // 4
+        if size * 4 != len(data) or size % self.times.itemsize:
+            raise ValueError("Loudness timeline is the wrong size")
+
+        for n, values in enumerate((self.times, self.momentary, self.short_term, self.true_peak)):
+            values.frombytes(data[n * size:(n + 1) * size])
+
+
+def parse_ebur128_block(message):
+    """
+    One of the lines ebur128 logs every 100ms, as (seconds, momentary, short term, true peak), or None if it isn't one
+    The true peak (FTPK, one value per channel) is only there when the filter has peak=true
+    """
+    block = re.search(r't:\s*(-?[\d.]+)\s+TARGET:.*?M:\s*(\S+)\s+S:\s*(\S+)', message)
+    if not block:
+        return None
+
+    try:
+        values = [float(x) for x in block.groups()]
+    except ValueError:
+        return None
+
+    true_peak = float('nan')
+    frame_peaks = re.search(r'FTPK:(.*?)dBFS', message)
+    if frame_peaks:
+        try:
+            true_peak = max(float(x) for x in frame_peaks.group(1).split())
+        except ValueError:
+            pass
+
+    return values[0], values[1], values[2], true_peak
+
+
+class AudioAnalysis:
+    """
+    Analyses every audio stream in the file, in a single decode
+
+    Rather than run volumedetect / ebur128 once per stream (and decode the file again for each),
+    one filtergraph takes every audio stream at once:
+        each track goes through astats (peak and rms per channel)
+        each programme (one or more tracks heard together) goes through ebur128 (loudness and true peak)
+    A track that is part of a bigger programme is split, so it can be analysed on its own and as part of the whole
+
+    Given the sample rate of each track, we also log its peak every envelope_resolution seconds (eg every 10ms)
+    This envelope is enough to answer how loud any stretch of the track is without decoding it again (eg silences)
+    It takes another astats that resets every block, which we have print its peak through ametadata
+    NOTE : this needs the measure_overall option of astats, which is ffmpeg 4.4 or later
+
+    programmes is a list of lists of audio stream indexes, eg [[0, 1], [2, 3, 4, 5, 6, 7]]
+    By default each track is its own programme
+
+    Every filter is named for its track or programme (eg astats@t0, ebur128@p1), which is how we tell the logs apart
+    Given a decode (see FusedDecode), all this rides along on someone else's decode of the file, eg the pixel strip
+    """
+    def __init__(self, file, track_count, programmes=None, ss_from=0, to=0, sample_rates=None,
+                 envelope_resolution=0.01, cancel_token=None, timeout=None, decode=None):
+        self.file = file
+        self.track_count = track_count
+        self.programmes = programmes or [[i] for i in range(track_count)]
+
+        self.tracks = [TrackResult(i, envelope_resolution) for i in range(track_count)]
+        self.programme_results = [ProgrammeResult(i, x) for i, x in enumerate(self.programmes)]
+
+        # whether the decode has run, for when it's someone else's decode
+        self.finished = False
+
+        # an output for each track, and for each programme of more than one track
+        output_count = track_count + len([x for x in self.programmes if len(x) > 1])
+        self.tap = FilterTap(['a:{}'.format(i) for i in range(track_count)],
+                             lambda tag, inputs, outputs: self.filtergraph(tag,
+                                                                           inputs,
+                                                                           outputs,
+                                                                           sample_rates,
+                                                                           envelope_resolution),
+                             read=self.read,
+                             outputs=[None] * output_count,
+                             finish=self.finish)
+        run_tap(file, self.tap, ss_from, to, decode=decode, cancel_token=cancel_token, timeout=timeout)
+
+    def filtergraph(self, tag, inputs, outputs, sample_rates=None, envelope_resolution=0.01):
+        """
+        inputs are the pads of each track, outputs the pads for each track and then each bigger programme
+        see FusedDecode for the tag
+        """
+        chains = []
+        outputs = list(outputs)
+
+        # how many times each track gets used, once for itself and once for each bigger programme it is in
+        uses = {i: 1 for i in range(self.track_count)}
+        for programme in self.programmes:
+            if len(programme) > 1:
+                for i in programme:
+                    uses[i] += 1
+
+        pads = {}
+        for i in range(self.track_count):
+            if uses[i] > 1:
+                pads[i] = ['{}t{}s{}'.format(tag, i, n) for n in range(uses[i])]
+                chains.append('[{}]asplit={}{}'.format(inputs[i],
+                                                       uses[i],
+                                                       ''.join(['[{}]'.format(x) for x in pads[i]])))
+            else:
+                pads[i] = [inputs[i]]
+
+        singles = {x[0]: n for n, x in enumerate(self.programmes) if len(x) == 1}
+
+        for i in range(self.track_count):
+            chain = '[{}]astats@{}t{}'.format(pads[i].pop(0), tag, i)
+
+            # a programme of one track can be measured in the same chain
+            if i in singles:
+                chain += ',ebur128@{}p{}=peak=true'.format(tag, singles[i])
+
+            # the envelope goes last, since cutting the audio into blocks doesn't matter to anything after it
+            if sample_rates and sample_rates[i]:
+                chain += ',asetnsamples@{tag}e{i}=n={}:p=0,' \
+                         'astats@{tag}e{i}=metadata=1:reset=1:measure_overall=Peak_level:measure_perchannel=none,' \
+                         'ametadata@{tag}e{i}=mode=print:key=lavfi.astats.Overall.Peak_level'.format(
+                             max(1, int(round(int(sample_rates[i]) * envelope_resolution))), tag=tag, i=i)
+
+            chains.append(chain + '[{}]'.format(outputs.pop(0)))
+
+        for n, programme in enumerate(self.programmes):
+            if len(programme) == 1:
+                continue
+            merge_inputs = ''.join(['[{}]'.format(pads[i].pop(0)) for i in programme])
+            chains.append('{}amerge=inputs={},ebur128@{}p{}=peak=true[{}]'.format(merge_inputs,
+                                                                                  len(programme),
+                                                                                  tag,
+                                                                                  n,
+                                                                                  outputs.pop(0)))
+
+        return ';'.join(chains)
+
+    def read(self, kind, key, message):
+        """
+        Every filter is named for its track or programme, eg t0 is the first track, p1 the second programme
+        """
+        if not key[1:].isdigit():
+            return
+        role, number = key[0], int(key[1:])
+
+        if kind == 'astats' and role == 't' and number < len(self.tracks):
+            self.tracks[number].read_astats(message)
+        elif kind == 'ametadata' and role == 'e' and number < len(self.tracks):
+            self.tracks[number].read_envelope(message)
+        elif kind == 'ebur128' and role == 'p' and number < len(self.programme_results):
+            self.programme_results[number].read_ebur128(message)
+
+    def finish(self):
+        self.finished = True
+
+    def peak(self):
+        peaks = [x.peak for x in self.tracks if x.peak is not None]
+        return max(peaks) if peaks else None
+
+
+class TrackResult:
+    def __init__(self, index, envelope_resolution=0.01):
+        self.index = index
+
+        # dBFS, overall and for each channel
+        self.peak = None
+        self.rms = None
+        self.channel_peaks = []
+
+        # the peak of each block of envelope_resolution seconds, in dBFS
+        self.envelope_resolution = envelope_resolution
+        self.envelope = array.array('f')
+
+        self._channel = None
+
+    def read_astats(self, message):
+        message = message.strip()
+        if message.startswith('Channel:'):
+            self._channel = int(message.split(':')[1])
+        elif message.startswith('Overall'):
+            self._channel = 'overall'
+        elif message.startswith('Peak level dB:'):
+            value = parse_level(message)
+            if self._channel == 'overall':
+                self.peak = value
+            else:
+                self.channel_peaks.append(value)
+        elif message.startswith('RMS level dB:') and self._channel == 'overall':
+            self.rms = parse_level(message)
+
+    def read_envelope(self, message):
+        # the blocks are all the same length and come in order, so we don't need their timestamps
+        if message.startswith('lavfi.astats.Overall.Peak_level='):
+            self.envelope.append(parse_level(message.replace('=', ':', 1)))
+
+
+class ProgrammeResult:
+    def __init__(self, index, tracks):
+        self.index = index
+        self.tracks = tracks
+
+        self.integrated_loudness = None
+        self.loudness_range = None
+        self.true_peak = None
+
+        self.timeline = LoudnessTimeline()
+
+        self._summary = False
+
+    def read_ebur128(self, message):
+        if message.startswith('Summary'):
+            self._summary = True
+            return
+
+        if not self._summary:
+            block = parse_ebur128_block(message)
+            if block:
+                self.timeline.append(*block)
+            return
+
+        integrated = re.search(r'^\s*I:\s*(-?[\d.]+|-inf)', message)
+        if integrated:
+            self.integrated_loudness = float(integrated.group(1))
+
+        loudness_range = re.search(r'^\s*LRA:\s*(-?[\d.]+)', message)
+        if loudness_range:
+            self.loudness_range = float(loudness_range.group(1))
+
+        true_peak = re.search(r'^\s*Peak:\s*(-?[\d.]+|-inf)', message)
+        if true_peak:
+            self.true_peak = float(true_peak.group(1))
+
+
+def parse_level(message):
+    value = message.split(':', 1)[1].strip()
+    try:
+        return float(value)
+    except ValueError:
+        # astats says -inf for digital silence
+        return float('-inf')
+
+
+class MetadataWatch:
+    """
+    Streams a per frame measurement out of ffmpeg, and stops the decode the moment a rule has definitively failed
+    For checks with a hard limit (eg a peak ceiling), a bad file usually gives itself away long before the end
+
+    inputs are stream specifiers (eg ['a:0', 'a:1']), each goes through filters,
+        which have to put key in the frame metadata
+        eg 'astats=metadata=1:reset=1' and 'lavfi.astats.Overall.Peak_level'
+    fails is given each value as it comes, and returns True once the rule has failed, eg lambda x: x >= -9
+
+    We print the metadata of every frame (ametadata / metadata), named for its input (eg ametadata@w1),
+        so we know which input failed, and from the pts_time line before it, when
+    If nothing fails, we have seen every value, so minimum and maximum are the true extremes of each input
+    """
+    def __init__(self, file, inputs, filters, key, fails, ss_from=0, to=0, cancel_token=None, timeout=None):
         self.file = file
+        self.inputs = inputs
+        self.key = key
+        self.fails = fails
+        self.ss_from = ss_from
+
+        self.failed = False
+        # in seconds from the start of the file
+        self.failed_at = None
+        self.failed_input = None
+        self.failed_value = None
+
+        self.maximum = [None] * len(inputs)
+        self.minimum = [None] * len(inputs)
+
+        # whether we got all the way through
+        self.finished = False
 
         from_cmd = ''
         if ss_from:
@@ -179,6 +707,80 @@ class CropDetection:
         if to:
             to_cmd = '-to {} '.format(to)
 
+        chains = []
+        for i, specifier in enumerate(inputs):
+            printer = 'ametadata' if specifier.startswith('a') else 'metadata'
+            chains.append('[0:{}]{},{}@w{}=mode=print:key={}[o{}]'.format(specifier, filters, printer, i, key, i))
+        maps = ' '.join(['-map "[o{}]"'.format(i) for i in range(len(inputs))])
+
+        self._cmd = '-nostats -hide_banner {} {} -i "{}" -filter_complex "{}" {} -f null - 2>&1'.format(from_cmd,
+                                                                                                       to_cmd,
+                                                                                                       file,
+                                                                                                       ';'.join(chains),
+                                                                                                       maps)
+
+        self._times = [None] * len(inputs)
+        lines = iter_ffcmd_lines('ffmpeg {}'.format(self._cmd), cancel_token=cancel_token, timeout=timeout)
+        try:
+            for line in lines:
+                if self.read_line(line):
+                    print("Stopped early, {} failed at {:.3f}s : {}".format(key, self.failed_at, file))
+                    break
+            else:
+                self.finished = True
+        finally:
+            # closing it early is what kills the process
+            lines.close()
+
+    def read_line(self, line):
+        """
+        Returns True once the rule has failed
+        """
+        match = re.match(r'^\[a?metadata@w(?P<input>\d+) @ [^\]]+\]\s?(?P<message>.*)$', line)
+        if not match:
+            return False
+
+        i = int(match.group('input'))
+        message = match.group('message').strip()
+        if i >= len(self.inputs):
+            return False
+
+        time_match = re.search(r'pts_time:\s*(-?[\d.]+)', message)
+        if time_match:
+            self._times[i] = float(time_match.group(1))
+            return False
+
+        if not message.startswith(self.key + '='):
+            return False
+
+        try:
+            value = float(message.split('=', 1)[1])
+        except ValueError:
+            return False
+
+        if self.maximum[i] is None or value > self.maximum[i]:
+            self.maximum[i] = value
+        if self.minimum[i] is None or value < self.minimum[i]:
+            self.minimum[i] = value
+
+        if not self.fails(value):
+            return False
+
+        self.failed = True
+        self.failed_input = i
+        self.failed_value = value
+        # the timestamps start from where we seeked to
+        self.failed_at = (self._times[i] or 0) + (self.ss_from or 0)
+        return True
+
+
+class CropDetection:
+    """
+    This is an experimental function - I'm not very confident that this will provide consistent useful results
+    """
+    def __init__(self, file, ss_from=0, to=0, cancel_token=None, timeout=None, decode=None):
+        self.file = file
+
         self._crop_value = '72:16:0'
         """
         FYI
@@ -210,13 +812,21 @@ class CropDetection:
             72:16:0
         
         """
-        # todo test swapping quotes for windows
-        # self._cmd = "{} {} -i '{}' -vf 'cropdetect={}' -f null /dev/null".format(from_cmd,
-        self._cmd = '{} {} -i "{}" -vf "cropdetect={}" -f null /dev/null 2>&1'.format(from_cmd,
-                                                                                      to_cmd,
-                                                                                      file,
-                                                                                      self._crop_value)
-        self.raw = ffmpeg(self._cmd)
+        self.raw = ''
+        self._messages = []
+        self._crop_infos = []
+
+        tap = FilterTap(['v:0'],
+                        lambda tag, inputs, outputs: '[{}]cropdetect@{}c={}[{}]'.format(inputs[0],
+                                                                                     tag,
+                                                                                     self._crop_value,
+                                                                                     outputs[0]),
+                        read=lambda kind, name, message: self._messages.append(message),
+                        finish=self.read_results)
+        run_tap(file, tap, ss_from, to, decode=decode, cancel_token=cancel_token, timeout=timeout)
+
+    def read_results(self):
+        self.raw = '\n'.join(self._messages)
 
         all_crop_infos = re.findall(r'crop=.*', self.raw)
         self._crop_infos = [CropInfo(x) for x in all_crop_infos]
@@ -234,14 +844,18 @@ class CropInfo:
 
 
 class Stream:
-    def __init__(self, file):
+    def __init__(self, file, cancel_token=None, timeout=None, probe_data=None):
         self.file = file
 
         # todo test reversing the quotes here for windows compliance
         # self._cmd = "-v quiet -print_format json -show_format -show_streams '{}'".format(file)
         self._cmd = '-v quiet -print_format json -show_format -show_streams "{}"'.format(file)
 
-        self.raw = ffprobe(self._cmd)
+        if probe_data is not None:
+            # the same info has already been read some other way (eg straight from the file header)
+            self.raw = json.dumps(probe_data)
+        else:
+            self.raw = ffprobe(self._cmd, cancel_token=cancel_token, timeout=timeout)
 
         try:
             self.json_dump = json.loads(self.raw)
@@ -281,9 +895,9 @@ class Stream:
         return [x for x in self.streams if x['codec_type'] == 'data']
 
     def audio_stream(self):
-        if not self.audio_stream():
+        if not self.audio_streams():
             return
-        return self.audio_stream()[0]
+        return self.audio_streams()[0]
 
     def audio_streams(self):
         return [x for x in self.streams if x['codec_type'] == 'audio']
@@ -292,6 +906,9 @@ class Stream:
     def video_codec(self, stream_index=0):
         return self.video_streams()[stream_index]['codec_long_name']
 
+    def video_codec_name(self, stream_index=0):
+        return self.video_streams()[stream_index].get('codec_name', '')
+
     def video_width(self, stream_index=0):
         return self.video_streams()[stream_index]['width']
 
@@ -338,10 +955,271 @@ class Stream:
     def audio_bitrate(self, stream_index=0):
         return self.audio_streams()[stream_index]['bits_per_sample']
 
+    def audio_channels(self, stream_index=0):
+        return int(self.audio_streams()[stream_index].get('channels', 0))
+
+    def audio_channel_layout(self, stream_index=0):
+        # not every container (or reader) names the layout, so go by the channel count if need be
+        layout = self.audio_streams()[stream_index].get('channel_layout')
+        if layout:
+            return layout
+        channels = self.audio_channels(stream_index)
+        return CHANNEL_COUNT_LAYOUTS.get(channels, '{} channels'.format(channels))
+
+    def audio_layout(self):
+        """
+        A description of all the audio streams together, eg '8 x mono' or 'stereo + 5.1'
+        """
+        layouts = [self.audio_channel_layout(i) for i in range(len(self.audio_streams()))]
+        if not layouts:
+            return ''
+        if len(layouts) > 1 and len(set(layouts)) == 1:
+            return '{} x {}'.format(len(layouts), layouts[0])
+        return ' + '.join(layouts)
+
     # format info
     def duration(self):
         return float(self.format_info('duration'))
 
+    def start_time(self):
+        # the timestamp of the very start of the file, which isn't always zero
+        try:
+            return float(self.format_info('start_time'))
+        except (TypeError, ValueError):
+            return 0.0
+
+
+def keyframes_after(file, times, search_seconds=10, cancel_token=None, timeout=None):
+    """
+    For each time, the time of the first video keyframe at or after it, or None if there isn't one close enough
+
+    Finding every keyframe means reading every packet in the file, which is slow on long media
+    So we only read a short interval after each time we're interested in, and ffprobe seeks between them
+    Times are in seconds from the start of the file, and so are the keyframes we return
+    """
+    if not times:
+        return []
+
+    probe = Stream(file, cancel_token=cancel_token, timeout=timeout)
+    start_time = probe.start_time()
+
+    intervals = ','.join(['{:.6f}%+{}'.format(start_time + t, search_seconds) for t in times])
+    cmd = '-v quiet -select_streams v:0 -read_intervals "{}" -show_entries packet=pts_time,flags ' \
+          '-print_format json "{}"'.format(intervals, file)
+    raw = ffprobe(cmd, cancel_token=cancel_token, timeout=timeout)
+
+    keyframes = []
+    try:
+        for packet in json.loads(raw)['packets']:
+            if 'K' in packet.get('flags', '') and 'pts_time' in packet:
+                keyframes.append(float(packet['pts_time']) - start_time)
+    except Exception as e:
+        print('Could not read keyframes from the packet info \n{}'.format(e))
+    keyframes.sort()
+
+    found = []
+    for t, limit in zip(times, [t + search_seconds for t in times]):
+        after = [k for k in keyframes if t <= k <= limit]
+        found.append(after[0] if after else None)
+    return found
+
+
+class PacketIndex:
+    """
+    One pass over the packets of a stream, without decoding anything
+    From that we get an exact frame count (even where the container doesn't list one, eg mkv),
+        the bitrate second by second, where the keyframes are, and whether the frame rate is variable
+
+    The ffprobe output is read line by line as it comes, so we never hold the whole text of it
+    The per packet timestamps, sizes and flags are kept in compact arrays, up to memory_budget bytes
+    Past that we stop keeping them (and complete is False), but everything else is summed as we go so it stays exact
+
+    NOTE : this counts packets, which is one frame per packet for everything we've seen
+        field coded streams may not be - but those are rare enough we'll deal with them if they come up
+    """
+    # bytes per packet kept, a double for the time, an unsigned int for the size, and a byte for the flags
+    BYTES_PER_PACKET = 8 + 4 + 1
+
+    # ten days, which is more than anything we'd reasonably be looking at
+    MAX_TIMELINE_SECONDS = 864000
+
+    def __init__(self, file, stream='v:0', memory_budget=64000000, cancel_token=None, timeout=None, data=None):
+        self.file = file
+        self.memory_budget = memory_budget
+
+        self.packet_count = 0
+        self.total_size = 0
+        self.first_time = None
+        self.first_pts = None
+        self.last_time = None
+
+        # bytes per whole second of the stream
+        self.second_sizes = array.array('d')
+
+        # times of the keyframes, in seconds from the first packet
+        self.keyframes = array.array('d')
+
+        # the gaps between frames, to tell constant from variable frame rate
+        self.min_frame_gap = None
+        self.max_frame_gap = None
+
+        self.complete = True
+        self.times = array.array('d')
+        self.sizes = array.array('I')
+        self.flags = array.array('B')
+
+        if data is not None:
+            # rebuilt from a previous scan
+            self.from_dict(data)
+            return
+
+        self._cmd = '-v quiet -select_streams {} -show_entries packet=pts_time,dts_time,size,flags ' \
+                    '-of compact=p=0 "{}"'.format(stream, file)
+
+        for line in iter_ffcmd_lines('ffprobe {}'.format(self._cmd), cancel_token=cancel_token, timeout=timeout):
+            self.add_packet(line)
+
+    def add_packet(self, line):
+        fields = dict(x.split('=', 1) for x in line.strip().split('|') if '=' in x)
+
+        # decode order is the order the timestamps are steady in, so prefer dts for the gaps between frames
+        t = parse_time(fields.get('dts_time'))
+        if t is None:
+            t = parse_time(fields.get('pts_time'))
+        if t is None:
+            return
+
+        size = int(fields.get('size') or 0)
+        keyframe = 'K' in fields.get('flags', '')
+
+        if self.first_time is None:
+            self.first_time = t
+        t -= self.first_time
+
+        # but keyframes are wanted for seeking, which goes by presentation time
+        pts = parse_time(fields.get('pts_time'))
+        if pts is not None and self.first_pts is None:
+            self.first_pts = pts
+
+        if self.last_time is not None:
+            gap = t - self.last_time
+            if gap > 0:
+                self.min_frame_gap = gap if self.min_frame_gap is None else min(self.min_frame_gap, gap)
+                self.max_frame_gap = gap if self.max_frame_gap is None else max(self.max_frame_gap, gap)
+        self.last_time = t
+
+        self.packet_count += 1
+        self.total_size += size
+
+        # a corrupt timestamp way off in the future shouldn't get to grow the timeline without limit
+        second = max(0, int(t))
+        if second < self.MAX_TIMELINE_SECONDS:
+            while len(self.second_sizes) <= second:
+                self.second_sizes.append(0)
+            self.second_sizes[second] += size
+
+        if keyframe:
+            self.keyframes.append(t if pts is None else pts - self.first_pts)
+
+        if self.complete:
+            if (self.packet_count * self.BYTES_PER_PACKET) > self.memory_budget:
+                print('Packet index is over its memory budget, only keeping the summary : {}'.format(self.file))
+                self.complete = False
+                self.times, self.sizes, self.flags = array.array('d'), array.array('I'), array.array('B')
+            else:
+                self.times.append(t)
+                self.sizes.append(size)
+                self.flags.append(1 if keyframe else 0)
+
+    # summaries
+    def framecount(self):
+        return self.packet_count
+
+    def duration(self):
+        if self.last_time is None:
+            return 0
+        # the last frame lasts about as long as the ones before it
+        return self.last_time + (self.min_frame_gap or 0)
+
+    def average_bitrate(self):
+        if not self.duration():
+            return 0
+        return int(self.total_size * 8 / self.duration())
+
+    def bitrate_timeline(self):
+        """
+        Bits per second, for each whole second of the stream
+        """
+        return [int(x * 8) for x in self.second_sizes]
+
+    def peak_bitrate(self):
+        # the last second is usually only partly there, so it doesn't count
+        timeline = self.bitrate_timeline()[:-1] or self.bitrate_timeline()
+        return max(timeline) if timeline else 0
+
+    def keyframe_times(self):
+        return list(self.keyframes)
+
+    def max_keyframe_interval(self):
+        """
+        The longest run between keyframes (or from the last keyframe to the end), in seconds
+        """
+        if not self.keyframes:
+            return self.duration()
+        points = list(self.keyframes) + [self.duration()]
+        return max(b - a for a, b in zip(points, points[1:])) if len(points) > 1 else 0
+
+    def is_variable_frame_rate(self, tolerance=0.001):
+        if self.min_frame_gap is None:
+            return False
+        return (self.max_frame_gap - self.min_frame_gap) > tolerance
+
+    # so it can be saved and rebuilt without scanning again
+    def to_dict(self):
+        """
+        Only the summary is saved, the per packet arrays are for whoever is holding the index at the time
+        """
+        return {
+            'packet_count': self.packet_count,
+            'total_size': self.total_size,
+            'first_time': self.first_time,
+            'first_pts': self.first_pts,
+            'last_time': self.last_time,
+            'second_sizes': list(self.second_sizes),
+            'keyframes': list(self.keyframes),
+            'min_frame_gap': self.min_frame_gap,
+            'max_frame_gap': self.max_frame_gap,
+        }
+
+    def from_dict(self, data):
+        self.packet_count = data['packet_count']
+        self.total_size = data['total_size']
+        self.first_time = data['first_time']
+        self.first_pts = data['first_pts']
+        self.last_time = data['last_time']
+        self.second_sizes = array.array('d', data['second_sizes'])
+        self.keyframes = array.array('d', data['keyframes'])
+        self.min_frame_gap = data['min_frame_gap']
+        self.max_frame_gap = data['max_frame_gap']
+        self.complete = False
+
+
+def parse_time(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # ffprobe says N/A for timestamps it doesn't have
+        return None
+
+
+# names ffprobe gives the common channel layouts
+CHANNEL_COUNT_LAYOUTS = {
+    1: 'mono',
+    2: 'stereo',
+    6: '5.1',
+    8: '7.1',
+}
+
 
 """
 # the commands
@@ -353,27 +1231,186 @@ I've now removed any reference to /usr/local/bin - just using the command serves
 """
 
 
-def ffmpeg(*args):
+def ffmpeg(*args, cancel_token=None, timeout=None):
     cmd = 'ffmpeg {}'.format(*args)
     print(cmd)
-    return run_ffcmd(cmd)
+    return run_ffcmd(cmd, cancel_token=cancel_token, timeout=timeout)
 
 
-def ffprobe(args):
+def ffprobe(args, cancel_token=None, timeout=None):
     cmd = 'ffprobe {}'.format(args)
     print(cmd)
-    return run_ffcmd(cmd)
+    return run_ffcmd(cmd, cancel_token=cancel_token, timeout=timeout)
+
+
+"""
+# cancellation
+
+Any of the commands can be given a cancel_token, and/or a timeout in seconds
+The cancel_token can be any object with an is_cancelled() method, so you can bring your own
+
+While the command runs we keep an eye on both, and if either trips we kill the process (and anything it spawned)
+This is what stops a corrupt file from hanging a thread forever
+"""
+
+# how often we check in on a running command, in seconds
+POLL_INTERVAL = 0.25
+
+
+class FFmpegCancelled(Exception):
+    """
+    Raised when a running command is killed because its cancel_token was cancelled
+    """
+    pass
+
 
+class FFmpegTimeout(Exception):
+    """
+    Raised when a running command is killed because it ran past its timeout
+    """
+    pass
+
+
+def run_ffcmd(cmd, cancel_token=None, timeout=None, binary=False):
+    """
+    binary gives back the raw bytes of stdout, for commands that write media to it (eg image2pipe)
+    """
+    if cancel_token is not None and cancel_token.is_cancelled():
+        raise FFmpegCancelled(cmd)
 
-def run_ffcmd(cmd):
     p = subprocess.Popen(cmd,
                          stdin=subprocess.PIPE,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE,
-                         shell=True)
-    out, err = p.communicate()
+                         shell=True,
+                         **new_process_group_kwargs())
+
+    started = time.monotonic()
+    while True:
+        try:
+            out, err = p.communicate(timeout=POLL_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+
+        if cancel_token is not None and cancel_token.is_cancelled():
+            kill_process_tree(p)
+            raise FFmpegCancelled(cmd)
 
+        if timeout and time.monotonic() - started > timeout:
+            kill_process_tree(p)
+            raise FFmpegTimeout(cmd)
+
+    if binary:
+        return out
     return out.decode('ASCII')
 
 
+def iter_ffcmd_lines(cmd, cancel_token=None, timeout=None):
+    """
+    Like run_ffcmd, but yields the output a line at a time as the command goes, for output too big to hold all at once
+    """
+    def read(stdout):
+        for line in stdout:
+            yield line.decode('ASCII', errors='replace')
+
+    return watched_output(cmd, read, cancel_token=cancel_token, timeout=timeout)
+
 
+def iter_ffcmd_chunks(cmd, size, cancel_token=None, timeout=None):
+    """
+    Like iter_ffcmd_lines, but yields stdout in chunks of exactly size bytes, eg one rawvideo frame at a time
+    Anything left over at the end that doesn't make a whole chunk is dropped
+    """
+    def read(stdout):
+        while True:
+            chunk = stdout.read(size)
+            if len(chunk) < size:
+                return
+            yield chunk
+
+    return watched_output(cmd, read, cancel_token=cancel_token, timeout=timeout)
+
+
+def watched_output(cmd, read, cancel_token=None, timeout=None):
+    """
+    Runs the command and yields whatever read makes of its stdout, as it comes
+    We can't poll between reads (a read blocks until there is something), so a watchdog thread does the killing
+    """
+    if cancel_token is not None and cancel_token.is_cancelled():
+        raise FFmpegCancelled(cmd)
+
+    print(cmd)
+    p = subprocess.Popen(cmd,
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL,
+                         shell=True,
+                         **new_process_group_kwargs())
+
+    finished = threading.Event()
+    killed_for = []
+
+    def watchdog():
+        started = time.monotonic()
+        while not finished.wait(POLL_INTERVAL):
+            if cancel_token is not None and cancel_token.is_cancelled():
+                killed_for.append(FFmpegCancelled)
+            elif timeout and time.monotonic() - started > timeout:
+                killed_for.append(FFmpegTimeout)
+            else:
+                continue
+            kill_process_group(p)
+            return
+
+    threading.Thread(target=watchdog, daemon=True).start()
+
+    try:
+        for item in read(p.stdout):
+            yield item
+    finally:
+        finished.set()
+        if p.poll() is None:
+            # whoever was reading stopped early
+            kill_process_group(p)
+        p.stdout.close()
+        p.wait()
+
+    if killed_for:
+        raise killed_for[0](cmd)
+
+
+def new_process_group_kwargs():
+    """
+    Because we run through a shell, killing the process we spawned only kills the shell
+    Putting it in its own process group means we can take ffmpeg down with it
+    """
+    if sys.platform.startswith('win32'):
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+
+def kill_process_tree(p):
+    """
+    Kill a process started with new_process_group_kwargs, and everything it spawned
+    """
+    kill_process_group(p)
+
+    # reap it, so it doesn't hang around as a zombie
+    p.communicate()
+
+
+def kill_process_group(p):
+    """
+    The killing part of kill_process_tree, for when something else is still reading from the process
+    """
+    try:
+        if sys.platform.startswith('win32'):
+            subprocess.call('taskkill /F /T /PID {}'.format(p.pid),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        # it has already gone
+        pass
@@ -0,0 +1,490 @@
+"""
+Single python file
+Only builtin libraries
+
+Reads the basic stream info of QuickTime / MP4 (ISO BMFF) files straight out of the moov box
+Everything ffprobe would tell us about the resolution, frame count, frame rate, codecs and start timecode is in there,
+    so we can skip spawning a process for it - which adds up fast over a folder of thousands of movies
+
+The file is memory mapped, and we only ever touch the box headers and the moov box itself
+So it doesn't matter how big the media data is, or whether the moov is at the start or the end
+
+probe() returns the same shape of data as ffprobe -print_format json -show_format -show_streams
+    (only the handful of fields we actually use, not all of them)
+It returns None for anything it isn't sure about, so the caller can fall back to ffprobe
+
+For reference :
+    https://developer.apple.com/documentation/quicktime-file-format (2024)
+    ISO/IEC 14496-12 (2022)
+"""
+
+import mmap
+import struct
+from fractions import Fraction
+
+# CONSTANTS
+
+# boxes we look inside of, to find the ones we want
+CONTAINER_BOXES = [b'moov', b'trak', b'mdia', b'minf', b'stbl']
+
+# the handler type of a track tells us what kind of stream it is, in ffprobe's terms
+HANDLER_CODEC_TYPES = {
+    b'vide': 'video',
+    b'soun': 'audio',
+    b'tmcd': 'data',
+}
+
+# sample description formats, and the codec long name ffprobe would give them
+VIDEO_CODECS = {
+    b'avc1': 'H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10',
+    b'avc3': 'H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10',
+    b'hvc1': 'H.265 / HEVC (High Efficiency Video Coding)',
+    b'hev1': 'H.265 / HEVC (High Efficiency Video Coding)',
+    b'apch': 'Apple ProRes (iCodec Pro)',
+    b'apcn': 'Apple ProRes (iCodec Pro)',
+    b'apcs': 'Apple ProRes (iCodec Pro)',
+    b'apco': 'Apple ProRes (iCodec Pro)',
+    b'ap4h': 'Apple ProRes (iCodec Pro)',
+    b'ap4x': 'Apple ProRes (iCodec Pro)',
+    b'AVdn': 'VC3/DNxHD',
+    b'AVdh': 'VC3/DNxHD',
+    b'mp4v': 'MPEG-4 part 2',
+    b'jpeg': 'Motion JPEG',
+    b'mjpa': 'Motion JPEG',
+    b'av01': 'Alliance for Open Media AV1',
+    b'vp09': 'Google VP9',
+}
+
+# and the codec name ffprobe would give them
+VIDEO_CODEC_NAMES = {
+    b'avc1': 'h264',
+    b'avc3': 'h264',
+    b'hvc1': 'hevc',
+    b'hev1': 'hevc',
+    b'apch': 'prores',
+    b'apcn': 'prores',
+    b'apcs': 'prores',
+    b'apco': 'prores',
+    b'ap4h': 'prores',
+    b'ap4x': 'prores',
+    b'AVdn': 'dnxhd',
+    b'AVdh': 'dnxhd',
+    b'mp4v': 'mpeg4',
+    b'jpeg': 'mjpeg',
+    b'mjpa': 'mjpeg',
+    b'av01': 'av1',
+    b'vp09': 'vp9',
+}
+
+AUDIO_CODECS = {
+    b'ac-3': 'ATSC A/52A (AC-3)',
+    b'ec-3': 'ATSC A/52B (AC-3, E-AC-3)',
+    b'.mp3': 'MP3 (MPEG audio layer 3)',
+    b'alac': 'ALAC (Apple Lossless Audio Codec)',
+}
+
+# mp4a covers a few codecs, the object type in its esds says which one
+MP4A_OBJECT_TYPES = {
+    0x40: 'AAC (Advanced Audio Coding)',
+    0x66: 'AAC (Advanced Audio Coding)',
+    0x67: 'AAC (Advanced Audio Coding)',
+    0x68: 'AAC (Advanced Audio Coding)',
+    0x69: 'MP3 (MPEG audio layer 3)',
+    0x6B: 'MP3 (MPEG audio layer 3)',
+}
+
+# uncompressed audio formats, and (bits, big endian) for each
+PCM_FORMATS = {
+    b'raw ': (8, False),
+    b'twos': (16, True),
+    b'sowt': (16, False),
+    b'in24': (24, True),
+    b'in32': (32, True),
+}
+
+
+class Box:
+    def __init__(self, data, box_type, start, end):
+        self.data = data
+        self.type = box_type
+
+        # where the body of the box starts and ends, after the header
+        self.start = start
+        self.end = end
+
+    def body(self):
+        return self.data[self.start:self.end]
+
+    def children(self):
+        return list(iter_boxes(self.data, self.start, self.end))
+
+    def find(self, *path):
+        """
+        The first box at the given path of box types below this one, or None
+        """
+        box = self
+        for box_type in path:
+            box = next((x for x in box.children() if x.type == box_type), None)
+            if box is None:
+                return None
+        return box
+
+    def find_all(self, box_type):
+        return [x for x in self.children() if x.type == box_type]
+
+
+def iter_boxes(data, start, end):
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+        header = 8
+
+        if size == 1:
+            # 64 bit size, for boxes over 4GB (which mdat often is)
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+            header = 16
+        elif size == 0:
+            # runs to the end of whatever it is in
+            size = end - offset
+
+        if size < header or offset + size > end:
+            # malformed, or a truncated file - don't trust anything after here
+            return
+
+        yield Box(data, box_type, offset + header, offset + size)
+        offset += size
+
+
+def probe(path):
+    """
+    Returns ffprobe shaped info about the file, or None if we can't read it this way
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # can't open it, or it is empty
+        return None
+
+    try:
+        return read_movie(data)
+    except (struct.error, IndexError, ValueError, ZeroDivisionError) as e:
+        print('Could not read the movie header, falling back \n{}'.format(e))
+        return None
+    finally:
+        data.close()
+
+
+def read_movie(data):
+    root = Box(data, b'', 0, len(data))
+
+    moov = root.find(b'moov')
+    if moov is None:
+        return None
+
+    # fragmented files keep their sample tables in the fragments, which we don't read
+    if moov.find(b'mvex') is not None:
+        return None
+
+    mvhd = moov.find(b'mvhd')
+    if mvhd is None:
+        return None
+    timescale, duration = read_header_times(mvhd)
+
+    streams = []
+    for trak in moov.find_all(b'trak'):
+        stream = read_track(data, trak)
+        if stream is False:
+            # a track we should understand, but don't - let ffprobe have it
+            return None
+        if stream:
+            stream['index'] = len(streams)
+            streams.append(stream)
+
+    video = [x for x in streams if x['codec_type'] == 'video']
+    if not video:
+        return None
+
+    # ffprobe puts the start timecode on the video stream as well
+    for stream in streams:
+        if 'timecode' in stream['tags']:
+            for v in video:
+                v['tags'].setdefault('timecode', stream['tags']['timecode'])
+
+    return {
+        'streams': streams,
+        'format': {
+            'duration': '{:.6f}'.format(float(duration) / timescale),
+            'start_time': '0.000000',
+            'nb_streams': len(streams),
+        }
+    }
+
+
+def read_header_times(box):
+    """
+    mvhd and mdhd both start with the same fields, returns their timescale and duration
+    """
+    body = box.body()
+    if body[0] == 1:
+        return struct.unpack('>IQ', body[20:32])
+    return struct.unpack('>II', body[12:20])
+
+
+def read_track(data, trak):
+    """
+    Returns the stream info for a track, None for a track we don't care about,
+    or False for a track we ought to be able to read, but couldn't
+    """
+    hdlr = trak.find(b'mdia', b'hdlr')
+    if hdlr is None:
+        return None
+
+    codec_type = HANDLER_CODEC_TYPES.get(hdlr.body()[8:12])
+    if not codec_type:
+        return None
+
+    mdhd = trak.find(b'mdia', b'mdhd')
+    stbl = trak.find(b'mdia', b'minf', b'stbl')
+    if mdhd is None or stbl is None:
+        return False
+
+    timescale, duration = read_header_times(mdhd)
+
+    stsd = stbl.find(b'stsd')
+    entries = list(iter_boxes(data, stsd.start + 8, stsd.end)) if stsd else []
+    if len(entries) != 1:
+        return False
+    entry = entries[0]
+
+    stream = {
+        'codec_type': codec_type,
+        'codec_tag_string': entry.type.decode('latin-1'),
+        'tags': {},
+    }
+
+    if codec_type == 'video':
+        return read_video_track(stream, entry, stbl, timescale, duration)
+    if codec_type == 'audio':
+        return read_audio_track(stream, entry, stbl, timescale, duration)
+    return read_timecode_track(stream, data, entry, stbl)
+
+
+def read_video_track(stream, entry, stbl, timescale, duration):
+    if entry.type not in VIDEO_CODECS:
+        return False
+
+    width, height = struct.unpack('>HH', entry.body()[24:28])
+
+    deltas = read_time_to_sample(stbl)
+    nb_frames = sum(count for count, delta in deltas)
+    if not nb_frames or not duration:
+        return False
+
+    # a constant frame rate comes straight from the sample duration, otherwise it's the average
+    if len(deltas) == 1:
+        r_frame_rate = Fraction(timescale, deltas[0][1])
+    else:
+        r_frame_rate = Fraction(nb_frames * timescale, duration)
+    avg_frame_rate = Fraction(nb_frames * timescale, duration)
+
+    stream.update({
+        'codec_name': VIDEO_CODEC_NAMES[entry.type],
+        'codec_long_name': VIDEO_CODECS[entry.type],
+        'width': width,
+        'height': height,
+        'nb_frames': str(nb_frames),
+        'r_frame_rate': '{}/{}'.format(r_frame_rate.numerator, r_frame_rate.denominator),
+        'avg_frame_rate': '{}/{}'.format(avg_frame_rate.numerator, avg_frame_rate.denominator),
+        'duration': '{:.6f}'.format(float(duration) / timescale),
+        'bit_rate': str(int(read_total_sample_size(stbl) * 8 * timescale / duration)),
+    })
+    return stream
+
+
+def read_audio_track(stream, entry, stbl, timescale, duration):
+    body = entry.body()
+    version = struct.unpack('>H', body[8:10])[0]
+
+    if version == 2:
+        # the sample rate is a double, and lpcm describes itself with flags
+        sample_rate = struct.unpack('>d', body[32:40])[0]
+        channels, _, bits, flags = struct.unpack('>IIII', body[40:56])
+    else:
+        channels, bits = struct.unpack('>HH', body[16:20])
+        sample_rate = struct.unpack('>I', body[24:28])[0] / 65536.0
+        flags = 0
+
+    codec_long_name = audio_codec_long_name(entry, bits, flags)
+    if not codec_long_name:
+        return False
+
+    # compressed audio doesn't have a meaningful sample size, and ffprobe says as much
+    if not codec_long_name.startswith('PCM'):
+        bits = 0
+
+    stream.update({
+        'codec_long_name': codec_long_name,
+        'sample_rate': str(int(sample_rate)),
+        'channels': channels,
+        'bits_per_sample': bits,
+        'duration': '{:.6f}'.format(float(duration) / timescale) if timescale else '0.000000',
+    })
+    return stream
+
+
+def audio_codec_long_name(entry, bits, flags):
+    if entry.type in AUDIO_CODECS:
+        return AUDIO_CODECS[entry.type]
+
+    if entry.type == b'mp4a':
+        return MP4A_OBJECT_TYPES.get(read_object_type(entry))
+
+    if entry.type == b'lpcm':
+        is_float = flags & 0x1
+        big_endian = flags & 0x2
+        if is_float:
+            return pcm_long_name(bits, big_endian, is_float=True)
+        return pcm_long_name(bits, big_endian)
+
+    if entry.type in PCM_FORMATS:
+        bits, big_endian = PCM_FORMATS[entry.type]
+        # an enda box in the extensions can flip the byte order
+        enda = entry.body().find(b'enda')
+        if enda >= 4 and entry.body()[enda + 5:enda + 6] == b'\x01':
+            big_endian = False
+        return pcm_long_name(bits, big_endian)
+
+    if entry.type in [b'fl32', b'fl64']:
+        return pcm_long_name(32 if entry.type == b'fl32' else 64, True, is_float=True)
+
+    return None
+
+
+def pcm_long_name(bits, big_endian, is_float=False):
+    if bits == 8 and not is_float:
+        return 'PCM signed 8-bit'
+
+    endian = 'big-endian' if big_endian else 'little-endian'
+    if is_float:
+        return 'PCM {}-bit floating point {}'.format(bits, endian)
+    return 'PCM signed {}-bit {}'.format(bits, endian)
+
+
+def read_object_type(entry):
+    """
+    Digs the object type out of the esds box of an mp4a sample description
+    """
+    body = entry.body()
+    esds = body.find(b'esds')
+    if esds < 0:
+        return None
+
+    # the esds is a tree of descriptors, and the object type is the first byte of the decoder config (tag 4)
+    i = esds + 8
+    while i < len(body):
+        tag = body[i]
+        i += 1
+
+        # descriptor lengths are 7 bits per byte, with the top bit meaning there is more to come
+        while i < len(body) and body[i] & 0x80:
+            i += 1
+        i += 1
+
+        if tag == 0x04:
+            return body[i] if i < len(body) else None
+        if tag == 0x03:
+            # the es descriptor has an id and some flags before its children
+            flags = body[i + 2]
+            i += 3
+            if flags & 0x80:
+                i += 2
+            if flags & 0x40:
+                i += 1 + body[i]
+            if flags & 0x20:
+                i += 2
+            continue
+        return None
+    return None
+
+
+def read_timecode_track(stream, data, entry, stbl):
+    if entry.type != b'tmcd':
+        return None
+
+    body = entry.body()
+    flags, tc_timescale, frame_duration, frames_per_second = struct.unpack('>IIIB', body[12:25])
+    drop_frame = bool(flags & 0x1)
+
+    # the first (and usually only) sample is the frame number that the timecode starts on
+    offsets = read_chunk_offsets(stbl)
+    if not offsets or offsets[0] + 4 > len(data):
+        return None
+    frame_number = struct.unpack('>i', data[offsets[0]:offsets[0] + 4])[0]
+
+    stream.update({
+        'codec_long_name': 'unknown',
+        'tags': {'timecode': timecode_from_frames(frame_number, frames_per_second, drop_frame)},
+    })
+    return stream
+
+
+def read_time_to_sample(stbl):
+    """
+    Returns the stts entries, as (sample count, sample duration) pairs
+    """
+    stts = stbl.find(b'stts')
+    if stts is None:
+        return []
+    body = stts.body()
+    count = struct.unpack('>I', body[4:8])[0]
+    return [struct.unpack('>II', body[8 + i * 8:16 + i * 8]) for i in range(count)]
+
+
+def read_total_sample_size(stbl):
+    stsz = stbl.find(b'stsz')
+    if stsz is None:
+        return 0
+    body = stsz.body()
+    sample_size, count = struct.unpack('>II', body[4:12])
+    if sample_size:
+        return sample_size * count
+    return sum(struct.unpack('>{}I'.format(count), body[12:12 + count * 4]))
+
+
+def read_chunk_offsets(stbl):
+    stco = stbl.find(b'stco')
+    if stco is not None:
+        body = stco.body()
+        count = struct.unpack('>I', body[4:8])[0]
+        return list(struct.unpack('>{}I'.format(count), body[8:8 + count * 4]))
+
+    co64 = stbl.find(b'co64')
+    if co64 is not None:
+        body = co64.body()
+        count = struct.unpack('>I', body[4:8])[0]
+        return list(struct.unpack('>{}Q'.format(count), body[8:8 + count * 8]))
+
+    return []
+
+
+def timecode_from_frames(frame_number, fps, drop_frame=False):
+    """
+    Formats a frame number as timecode, the same way ffmpeg does
+    Drop frame timecode skips frame numbers at the start of each minute, except every tenth minute
+    """
+    if not fps:
+        return ''
+
+    if drop_frame and fps % 30 == 0:
+        drop_frames = fps // 30 * 2
+        frames_per_10mins = fps // 30 * 17982
+        d, m = divmod(frame_number, frames_per_10mins)
+        frame_number += 9 * drop_frames * d + drop_frames * (max(0, m - drop_frames) // (frames_per_10mins // 10))
+
+    separator = ';' if drop_frame else ':'
+    return '{:02d}:{:02d}:{:02d}{}{:02d}'.format(frame_number // (fps * 3600) % 24,
+                                                 frame_number // (fps * 60) % 60,
+                                                 frame_number // fps % 60,
+                                                 separator,
+                                                 frame_number % fps)
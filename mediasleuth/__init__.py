@@ -7,6 +7,9 @@ This is the big object that holds, and queries all of our information
 mediainspection_display
 This is purely concerned with initializing and displaying the qc_result
 
+registry
+This maps each property to the check that produces it, so we only run the checks for what is being shown
+
 properties
 This contain all the properties, which ensure that we store the data we gather in an ideal way to be displayed
 
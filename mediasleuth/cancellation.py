@@ -0,0 +1,83 @@
+"""
+Cooperative cancellation for the checks
+
+Every MediaInspection has a CancelToken, and every check it runs gets a child of that token with its own deadline
+The token gets passed all the way down to wherever we spawn a process, which polls it and kills the process if it trips
+So cancelling the inspection (eg when it gets refreshed) takes down everything it has running,
+    and a check on a corrupt file that runs past its deadline gets killed rather than hanging forever
+"""
+
+import threading
+import time
+
+
+class CheckCancelled(Exception):
+    """
+    Raised by a check that notices it has been cancelled between processes
+    """
+    pass
+
+
+class CancelToken:
+    def __init__(self, parent=None, timeout=None):
+        self.parent = parent
+
+        self._event = threading.Event()
+
+        self.deadline = None
+        if timeout:
+            self.deadline = time.monotonic() + timeout
+
+    def cancel(self):
+        self._event.set()
+
+    def child(self, timeout=None):
+        """
+        Returns a new token that is cancelled along with this one, and can have a deadline of its own
+        """
+        return CancelToken(parent=self, timeout=timeout)
+
+    def cancelled(self):
+        """
+        True if this token, or any of its parents, has been cancelled outright
+        """
+        if self._event.is_set():
+            return True
+        if self.parent is not None:
+            return self.parent.cancelled()
+        return False
+
+    def timed_out(self):
+        """
+        True if this token, or any of its parents, has run past its deadline
+        """
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            return True
+        if self.parent is not None:
+            return self.parent.timed_out()
+        return False
+
+    def is_cancelled(self):
+        """
+        This is what the processes poll - we stop work for either reason
+        """
+        return self.cancelled() or self.timed_out()
+
+    def remaining(self):
+        """
+        Seconds until the nearest deadline, or None if there isn't one
+        """
+        deadlines = []
+        token = self
+        while token is not None:
+            if token.deadline is not None:
+                deadlines.append(token.deadline)
+            token = token.parent
+
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def raise_if_cancelled(self):
+        if self.is_cancelled():
+            raise CheckCancelled()
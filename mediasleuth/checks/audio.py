@@ -5,9 +5,7 @@ Currently:
     volume maximum
     durations of silence
     loudness values
-
-TBD
-    number of tracks
+    all of the above for every track (and every programme of tracks) at once, see analyse_audio
 
 For reference :
     https://lokomotion.com.au/tv-commercial-broadcast-standards/ (2019)
@@ -16,40 +14,635 @@ For reference :
     Also 12 frames of silence in the vision at head and tail - eg from 01:00:00:00 to 01:00:00:12 should be silent
 
     All the above is baked into the MediaInspection
+
+The whole clip measurements can be given segments (see segments.py), to measure each part of a long file in parallel
+Peaks combine by just taking the loudest, but loudness has to be gated over all the blocks at once
+    https://www.itu.int/rec/R-REC-BS.1770 (2023)
+    https://tech.ebu.ch/publications/tech3342 (2023) - for loudness range
 """
 
+# builtin
+import math
+import array
+import bisect
+
+# internal
 import ext.ffmpeg as ffmpeg
 
+from mediasleuth.cancellation import CancelToken
+
+# CONSTANTS
+
+# BS.1770 gating
+ABSOLUTE_GATE = -70
+RELATIVE_GATE = -10
+
+# EBU 3342 gating for loudness range, and the percentiles that it spans
+LRA_RELATIVE_GATE = -20
+LRA_LOW_PERCENTILE = 0.10
+LRA_HIGH_PERCENTILE = 0.95
+
+# a loudness block is 400ms long, so a segment has to start this much early for its first block to be whole
+LOUDNESS_PREROLL = 0.3
+LOUDNESS_BLOCK = 0.4
+
+# likewise the short term loudness is 3s long, the analysis prerolls enough for both
+SHORT_TERM_BLOCK = 3.0
+ANALYSIS_PREROLL = 2.9
 
-def get_max_volume(file):
-    return ffmpeg.VolumeDetection(file).max_volume()
+# the peak of each audio frame, for watching a ceiling as the file decodes (see watch_peak)
+PEAK_WATCH_FILTER = 'astats=metadata=1:reset=1:measure_overall=Peak_level:measure_perchannel=none'
+PEAK_WATCH_KEY = 'lavfi.astats.Overall.Peak_level'
 
 
-def is_max_volume_less_than(file, volume_max=-9):
-    a = ffmpeg.VolumeDetection(file)
+def get_max_volume(file, cancel_token=None, segments=None):
+    if segments:
+        return max(segments.map(
+            lambda s: ffmpeg.VolumeDetection(file, s.start, s.end, cancel_token=cancel_token).max_volume(),
+            cancel_token=cancel_token))
+    return ffmpeg.VolumeDetection(file, cancel_token=cancel_token).max_volume()
 
-    if a.max_volume() < volume_max:
+
+def is_max_volume_less_than(file, volume_max=-9, cancel_token=None, segments=None, track_count=1):
+    # this only needs to know if it goes over, so we can stop looking once it does
+    peak, failed_at, track = watch_peak(file, volume_max, track_count, cancel_token=cancel_token, segments=segments)
+    if failed_at is None:
         return True
     return False
 
 
-def get_max_volume_for_duration(file, seconds_from, seconds_to):
-    checked_duration = ffmpeg.VolumeDetection(file, seconds_from, seconds_to)
-    return checked_duration.max_volume()
+def watch_peak(file, ceiling=-9, track_count=1, cancel_token=None, segments=None):
+    """
+    Decodes every track until any of them peaks at or above the ceiling, and stops right there
+    Returns (peak, failed_at, track) - the loudest peak we saw, and the seconds and track where it first went over
+        (failed_at and track are None if it never did, in which case peak is the true peak of the file)
+
+    With segments, each one is watched in parallel, and the first to fail stops the rest
+    Any of them failing is a fail, but the earliest failure we saw isn't necessarily the first in the file
+    """
+    inputs = ['a:{}'.format(i) for i in range(track_count)]
+
+    if not segments:
+        watch = ffmpeg.MetadataWatch(file, inputs, PEAK_WATCH_FILTER, PEAK_WATCH_KEY, lambda x: x >= ceiling,
+                                     cancel_token=cancel_token)
+        watches = [watch]
+
+    else:
+        # a token of our own, so a failing segment can stop the others without cancelling anything else
+        stop = cancel_token.child() if isinstance(cancel_token, CancelToken) else CancelToken()
+
+        def watch_segment(s):
+            try:
+                watch = ffmpeg.MetadataWatch(file, inputs, PEAK_WATCH_FILTER, PEAK_WATCH_KEY, lambda x: x >= ceiling,
+                                             ss_from=s.start, to=s.end, cancel_token=stop)
+            except ffmpeg.FFmpegCancelled:
+                if cancel_token is not None and cancel_token.is_cancelled():
+                    raise
+                # another segment failed, and stopped this one
+                return None
+
+            if watch.failed:
+                stop.cancel()
+            return watch
+
+        watches = [x for x in segments.map(watch_segment, cancel_token=cancel_token) if x is not None]
 
+    peaks = [x for watch in watches for x in watch.maximum if x is not None]
+    peak = max(peaks) if peaks else None
 
-def check_duration_for_silence(file, seconds_from, seconds_to):
-    checked_duration = ffmpeg.VolumeDetection(file, seconds_from, seconds_to)
+    failures = sorted([x for x in watches if x.failed], key=lambda x: x.failed_at)
+    if not failures:
+        return peak, None, None
+    return peak, failures[0].failed_at, failures[0].failed_input
 
+
+def get_max_volume_for_duration(file, seconds_from, seconds_to, cancel_token=None, report=None):
+    # if the whole file has been analysed already, this is just a look up
+    if report is not None:
+        peak = report.peak_between(seconds_from, seconds_to)
+        if peak is not None:
+            return peak
+
+    checked_duration = ffmpeg.VolumeDetection(file, seconds_from, seconds_to, cancel_token=cancel_token)
+    return checked_duration.max_volume()
+
+
+def check_duration_for_silence(file, seconds_from, seconds_to, cancel_token=None, report=None):
     silence = -91
-    if checked_duration.max_volume() <= silence:
+    if get_max_volume_for_duration(file, seconds_from, seconds_to, cancel_token=cancel_token, report=report) <= silence:
         return True
     return False
 
 
-def is_loudness_in_bounds(file, lower_bound=-24, upper_bound=-22):
-    checked_duration = ffmpeg.LoudnessDetection(file)
+def get_integrated_loudness(file, cancel_token=None, segments=None):
+    if not segments:
+        return ffmpeg.LoudnessDetection(file, cancel_token=cancel_token).integrated_loudness()
+
+    def segment_blocks(s):
+        preroll = min(LOUDNESS_PREROLL, s.start)
+        ld = ffmpeg.LoudnessDetection(file, s.start - preroll, s.end, cancel_token=cancel_token)
+
+        # only keep the blocks that are whole, and end inside this segment
+        # the preroll means those follow on from the last block of the segment before
+        # NOTE : ebur128 logs times a hair under the block boundary, hence the slack
+        return [m for t, m in ld.momentary_blocks() if t >= LOUDNESS_BLOCK - 0.01]
+
+    blocks = []
+    for x in segments.map(segment_blocks, cancel_token=cancel_token):
+        blocks += x
+
+    return gated_loudness(blocks)
+
+
+def gated_loudness(blocks):
+    """
+    Integrated loudness from a list of momentary block loudnesses, gated as per BS.1770
+    Blocks below the absolute gate are dropped, then anything more than 10 LU below the average of what's left
+    Returns -inf if nothing is loud enough to make it through the gate
+    """
+    def mean_loudness(values):
+        mean_power = sum(10 ** ((x + 0.691) / 10) for x in values) / len(values)
+        return -0.691 + 10 * math.log10(mean_power)
+
+    gated = [x for x in blocks if x > ABSOLUTE_GATE]
+    if not gated:
+        return float('-inf')
+
+    relative_gate = mean_loudness(gated) + RELATIVE_GATE
+    gated = [x for x in gated if x > relative_gate]
+
+    loudness = round(mean_loudness(gated), 1)
+    print("Loudness : {} LUFS across {} blocks".format(loudness, len(blocks)))
+    return loudness
+
 
-    if lower_bound < checked_duration.integrated_loudness() < upper_bound:
+def is_loudness_in_bounds(file, lower_bound=-24, upper_bound=-22, cancel_token=None, segments=None):
+    loudness = get_integrated_loudness(file, cancel_token=cancel_token, segments=segments)
+
+    if lower_bound < loudness < upper_bound:
         return True
     return False
+
+
+def loudness_range(short_term_blocks):
+    """
+    Loudness range from a list of short term (3s) loudnesses, as per EBU 3342
+    The spread between the 10th and 95th percentile of what makes it through the gates
+    """
+    gated = [x for x in short_term_blocks if x > ABSOLUTE_GATE]
+    if not gated:
+        return 0.0
+
+    mean_power = sum(10 ** (x / 10) for x in gated) / len(gated)
+    relative_gate = 10 * math.log10(mean_power) + LRA_RELATIVE_GATE
+    gated = sorted(x for x in gated if x > relative_gate)
+
+    low = gated[int(round((len(gated) - 1) * LRA_LOW_PERCENTILE))]
+    high = gated[int(round((len(gated) - 1) * LRA_HIGH_PERCENTILE))]
+    return round(high - low, 1)
+
+
+def window_loudness(timeline, seconds_from=None, seconds_to=None):
+    """
+    Integrated loudness, loudness range and true peak of just part of a programme, from its loudness timeline
+    Returns (integrated loudness, loudness range, true peak)
+
+    Only the momentary and short term blocks that fit entirely inside the window count, same as if it had been cut out
+    The true peak is the loudest of the 100ms windows that overlap it
+    NOTE : the blocks are every 100ms, so the edges of the window are only that accurate
+    """
+    slack = 0.01
+    momentary_from = short_term_from = peak_from = None
+    if seconds_from is not None:
+        momentary_from = seconds_from + LOUDNESS_BLOCK - slack
+        short_term_from = seconds_from + SHORT_TERM_BLOCK - slack
+        peak_from = seconds_from + slack
+
+    momentary_to = peak_to = None
+    if seconds_to is not None:
+        momentary_to = seconds_to + slack
+        peak_to = seconds_to + 0.1 - slack
+
+    return (gated_loudness(timeline.momentary_between(momentary_from, momentary_to)),
+            loudness_range(timeline.short_term_between(short_term_from, momentary_to)),
+            timeline.true_peak_between(peak_from, peak_to))
+
+
+"""
+Multi track analysis
+
+Broadcast masters often carry a handful of tracks - eg a stereo mix, then M&E, or 8 discrete mono tracks
+Every track gets checked on its own (peak, silence), and each programme (the tracks heard together) for loudness
+"""
+
+
+def audio_programmes(layouts, pair_mono=True):
+    """
+    Works out which tracks are heard together, given the channel layout of each track
+
+    Anything with more than one channel is a programme on its own
+    Mono tracks are usually laid out in pairs (left, right), so by default each two in a row are treated as stereo
+    Returns a list of lists of track indexes
+    """
+    programmes = []
+    pending = None
+
+    for i, layout in enumerate(layouts):
+        if pair_mono and layout == 'mono':
+            if pending is None:
+                pending = [i]
+            else:
+                programmes.append(pending + [i])
+                pending = None
+            continue
+
+        if pending is not None:
+            programmes.append(pending)
+            pending = None
+        programmes.append([i])
+
+    if pending is not None:
+        programmes.append(pending)
+
+    return programmes
+
+
+def programme_name(tracks):
+    # tracks are A1, A2... same as an edit timeline would call them
+    return '+'.join(['A{}'.format(x + 1) for x in tracks])
+
+
+class SilenceIndex:
+    """
+    Answers how loud any stretch of a track is, from the peak envelope we logged while analysing it
+    So a question like 'are the 12 frames after the content starts silent' is a look up, rather than another decode
+
+    The envelope is the peak of every block (eg every 10ms), so answers are only as fine as that
+    Any block that overlaps the window counts, which errs on the side of not calling something silent
+
+    The silences (runs of blocks below the threshold, at least min_duration long) are worked out up front,
+    and kept sorted so we can find the one at any point in time by bisecting
+    """
+    # blocks per chunk, we keep the peak of each chunk so a long window doesn't mean looking at every block
+    CHUNK = 100
+
+    def __init__(self, envelope, resolution, threshold=-50, min_duration=0.01):
+        self.envelope = envelope
+        self.resolution = resolution
+        self.threshold = threshold
+
+        self.chunk_peaks = array.array('f', [max(envelope[i:i + self.CHUNK])
+                                             for i in range(0, len(envelope), self.CHUNK)])
+
+        self.silences = self.find_silences(threshold, min_duration)
+        self._starts = [x[0] for x in self.silences]
+
+    def duration(self):
+        return len(self.envelope) * self.resolution
+
+    def find_silences(self, threshold, min_duration):
+        silences = []
+        start = None
+
+        for i, peak in enumerate(self.envelope):
+            if peak < threshold:
+                if start is None:
+                    start = i
+                continue
+            if start is not None:
+                silences.append([start * self.resolution, i * self.resolution])
+                start = None
+
+        if start is not None:
+            silences.append([start * self.resolution, self.duration()])
+
+        return [x for x in silences if x[1] - x[0] >= min_duration]
+
+    def peak(self, seconds_from, seconds_to):
+        """
+        The loudest block in the window, or None if the window isn't covered by the envelope
+        """
+        first = max(0, int(seconds_from / self.resolution))
+        last = int(math.ceil(seconds_to / self.resolution))
+        if last > len(self.envelope) or first >= last:
+            return None
+
+        # whole chunks by their peaks, and the blocks either side one by one
+        first_chunk = -(-first // self.CHUNK)
+        last_chunk = last // self.CHUNK
+        if first_chunk >= last_chunk:
+            return max(self.envelope[first:last])
+
+        peaks = list(self.chunk_peaks[first_chunk:last_chunk])
+        peaks += self.envelope[first:first_chunk * self.CHUNK]
+        peaks += self.envelope[last_chunk * self.CHUNK:last]
+        return max(peaks)
+
+    def is_silent(self, seconds_from, seconds_to, threshold=None):
+        peak = self.peak(seconds_from, seconds_to)
+        if peak is None:
+            return None
+        return peak < (self.threshold if threshold is None else threshold)
+
+    def silence_at(self, seconds):
+        """
+        The [start, end] of the silence at this point in time, or None if it isn't silent there
+        """
+        i = bisect.bisect_right(self._starts, seconds) - 1
+        if i >= 0 and self.silences[i][1] > seconds:
+            return self.silences[i]
+        return None
+
+
+class AudioReport:
+    """
+    The results of analysing all the audio tracks, whether that was done in one go or in segments
+    tracks and programmes are ffmpeg.TrackResult and ffmpeg.ProgrammeResult
+    """
+    def __init__(self, tracks, programmes):
+        self.tracks = tracks
+        self.programmes = programmes
+
+        # a SilenceIndex for each track, once build_indexes has been called
+        self.indexes = []
+
+    def build_indexes(self, threshold=-50, min_duration=0.01):
+        self.indexes = [SilenceIndex(x.envelope, x.envelope_resolution, threshold, min_duration)
+                        for x in self.tracks if len(x.envelope)]
+
+        # without an envelope for every track we can't speak for all of them
+        if len(self.indexes) != len(self.tracks):
+            self.indexes = []
+
+    def peak(self):
+        peaks = [x.peak for x in self.tracks if x.peak is not None]
+        return max(peaks) if peaks else None
+
+    def peak_between(self, seconds_from, seconds_to):
+        """
+        The loudest any track gets in the window, or None if we can't say from the envelopes
+        """
+        if not self.indexes:
+            return None
+        peaks = [x.peak(seconds_from, seconds_to) for x in self.indexes]
+        if None in peaks:
+            return None
+        return max(peaks)
+
+    def is_silent(self, seconds_from, seconds_to, threshold=None):
+        if not self.indexes:
+            return None
+        silent = [x.is_silent(seconds_from, seconds_to, threshold) for x in self.indexes]
+        if None in silent:
+            return None
+        return all(silent)
+
+    def to_dict(self):
+        """
+        Everything but the envelopes, those are much bigger so they're saved as raw floats alongside
+        """
+        return {
+            'tracks': [{'index': x.index,
+                        'peak': x.peak,
+                        'rms': x.rms,
+                        'channel_peaks': x.channel_peaks,
+                        'envelope_resolution': x.envelope_resolution} for x in self.tracks],
+            'programmes': [{'index': x.index,
+                            'tracks': x.tracks,
+                            'integrated_loudness': x.integrated_loudness,
+                            'loudness_range': x.loudness_range,
+                            'true_peak': x.true_peak} for x in self.programmes]
+        }
+
+    def from_dict(self, data, envelopes, timelines):
+        """
+        envelopes are the bytes of each track's envelope, in track order
+        and timelines the bytes of each programme's loudness timeline, likewise
+        """
+        self.tracks = []
+        for track, envelope in zip(data['tracks'], envelopes):
+            result = ffmpeg.TrackResult(track['index'], track['envelope_resolution'])
+            result.peak = track['peak']
+            result.rms = track['rms']
+            result.channel_peaks = track['channel_peaks']
+            result.envelope.frombytes(envelope)
+            self.tracks.append(result)
+
+        if len(self.tracks) != len(data['tracks']):
+            raise ValueError("Missing envelopes for some of the tracks")
+
+        self.programmes = []
+        for programme, timeline in zip(data['programmes'], timelines):
+            result = ffmpeg.ProgrammeResult(programme['index'], programme['tracks'])
+            result.integrated_loudness = programme['integrated_loudness']
+            result.loudness_range = programme['loudness_range']
+            result.true_peak = programme['true_peak']
+            result.timeline.frombytes(timeline)
+            self.programmes.append(result)
+
+        if len(self.programmes) != len(data['programmes']):
+            raise ValueError("Missing loudness timelines for some of the programmes")
+
+    def envelopes(self):
+        return [x.envelope.tobytes() for x in self.tracks]
+
+    def timelines(self):
+        return [x.timeline.tobytes() for x in self.programmes]
+
+    def loudness_timeline(self, programme=0):
+        """
+        The momentary, short term and true peak timeline of a programme, see ffmpeg.LoudnessTimeline
+        """
+        return self.programmes[programme].timeline
+
+    def window_loudness(self, seconds_from=None, seconds_to=None):
+        """
+        (integrated loudness, loudness range, true peak) of each programme over the window, see window_loudness
+        """
+        return [window_loudness(x.timeline, seconds_from, seconds_to) for x in self.programmes]
+
+    def window_summary(self, seconds_from=None, seconds_to=None):
+        """
+        A line for each programme over the window, for display
+        """
+        lines = []
+        for programme, (loudness, lra, true_peak) in zip(self.programmes,
+                                                          self.window_loudness(seconds_from, seconds_to)):
+            lines.append('{}: {} LUFS, LRA {} LU, true peak {} dBTP'.format(programme_name(programme.tracks),
+                                                                            loudness,
+                                                                            lra,
+                                                                            '-inf' if true_peak is None else true_peak))
+        return lines
+
+    def summary(self):
+        """
+        A line for each programme, for display
+        """
+        lines = []
+        for programme in self.programmes:
+            peaks = [self.tracks[i].peak for i in programme.tracks if self.tracks[i].peak is not None]
+            lines.append('{}: {} LUFS, peak {} dB'.format(programme_name(programme.tracks),
+                                                          programme.integrated_loudness,
+                                                          max(peaks) if peaks else '-inf'))
+        return lines
+
+
+def analyse_audio(file, layouts, sample_rates, config, cancel_token=None, segments=None):
+    """
+    Peak, loudness and silence for every audio track in the file, in a single decode (or one per segment)
+    """
+    if not segments:
+        return audio_report_from(fused_audio_analysis(file, layouts, sample_rates, config, cancel_token=cancel_token),
+                                 config)
+
+    programmes = audio_programmes(layouts, pair_mono=config.getboolean('Audio', 'pair_mono_tracks', fallback=True))
+    envelope_resolution = config.getfloat('Audio', 'envelope_resolution_ms', fallback=10) / 1000
+
+    def analyse_segment(s):
+        preroll = min(ANALYSIS_PREROLL, s.start)
+        analysis = ffmpeg.AudioAnalysis(file,
+                                        len(layouts),
+                                        programmes=programmes,
+                                        ss_from=s.start - preroll,
+                                        to=s.end,
+                                        sample_rates=sample_rates,
+                                        envelope_resolution=envelope_resolution,
+                                        cancel_token=cancel_token)
+        return s, preroll, analysis
+
+    report = merge_segment_analyses(segments.map(analyse_segment, cancel_token=cancel_token),
+                                    len(layouts),
+                                    programmes,
+                                    envelope_resolution)
+    return index_audio_report(report, config)
+
+
+def fused_audio_analysis(file, layouts, sample_rates, config, decode=None, cancel_token=None):
+    """
+    The analysis of every audio track in the file, as analyse_audio does it without segments
+    Given a decode (see ffmpeg.FusedDecode) it's only added to it, and is ready once whoever owns the decode runs it
+    """
+    return ffmpeg.AudioAnalysis(file,
+                                len(layouts),
+                                programmes=audio_programmes(layouts, pair_mono=config.getboolean('Audio',
+                                                                                                 'pair_mono_tracks',
+                                                                                                 fallback=True)),
+                                sample_rates=sample_rates,
+                                envelope_resolution=config.getfloat('Audio', 'envelope_resolution_ms',
+                                                                    fallback=10) / 1000,
+                                cancel_token=cancel_token,
+                                decode=decode)
+
+
+def audio_report_from(analysis, config):
+    """
+    The AudioReport of an analysis of the whole file
+    """
+    return index_audio_report(AudioReport(analysis.tracks, analysis.programme_results), config)
+
+
+def index_audio_report(report, config):
+    report.build_indexes(config.getfloat('Audio', 'silence_threshold_db', fallback=-50),
+                         config.getfloat('Audio', 'min_silence_seconds', fallback=0.01))
+    return report
+
+
+def load_audio_report(config, store, path):
+    """
+    The AudioReport kept in the measurement store for this file, silence index and all, or None if we don't have one
+    """
+    stored = store.get(path, 'audio_report')
+    if not stored:
+        return None
+
+    envelopes = [store.get_blob(path, 'envelope_{}'.format(i)) for i in range(len(stored.get('tracks', [])))]
+    timelines = [store.get_blob(path, 'loudness_{}'.format(i)) for i in range(len(stored.get('programmes', [])))]
+    if None in envelopes + timelines:
+        return None
+
+    try:
+        report = AudioReport([], [])
+        report.from_dict(stored, envelopes, timelines)
+    except (KeyError, TypeError, ValueError) as e:
+        print("Stored audio report is out of date, it'll be analysed again \n{}".format(e))
+        return None
+
+    return index_audio_report(report, config)
+
+
+def store_audio_report(store, path, report):
+    """
+    The envelopes and timelines go first, so nobody finds the report without them
+    """
+    for i, envelope in enumerate(report.envelopes()):
+        store.put_blob(path, 'envelope_{}'.format(i), envelope)
+    for i, timeline in enumerate(report.timelines()):
+        store.put_blob(path, 'loudness_{}'.format(i), timeline)
+    store.put(path, 'audio_report', report.to_dict())
+
+
+def merge_segment_analyses(results, track_count, programmes, envelope_resolution=0.01):
+    """
+    Stitches per segment analyses back into one report
+
+    Peaks are the loudest of any segment, and rms is averaged by energy over the segments
+    Envelopes skip their preroll (it overlaps the last segment), and are laid in at the block their segment starts on
+    Loudness timelines only keep the blocks that are whole and end inside their own segment,
+        so loudness and loudness range can be gated over all the segments together
+    A short term block in a segment's preroll isn't whole yet, so it goes in as nan
+    """
+    tracks = [ffmpeg.TrackResult(i, envelope_resolution) for i in range(track_count)]
+    merged_programmes = [ffmpeg.ProgrammeResult(i, x) for i, x in enumerate(programmes)]
+    rms_energy = [0.0] * track_count
+    total_duration = 0.0
+
+    for s, preroll, analysis in results:
+        offset = s.start - preroll
+        total_duration += s.duration()
+
+        for track, result in zip(tracks, analysis.tracks):
+            if result.peak is not None:
+                track.peak = result.peak if track.peak is None else max(track.peak, result.peak)
+
+            for c, peak in enumerate(result.channel_peaks):
+                if c < len(track.channel_peaks):
+                    track.channel_peaks[c] = max(track.channel_peaks[c], peak)
+                else:
+                    track.channel_peaks.append(peak)
+
+            if result.rms is not None:
+                rms_energy[track.index] += (10 ** (result.rms / 10)) * s.duration()
+
+            # placing each segment by its own start means rounding can't add up over the segments
+            first_block = int(round(s.start / envelope_resolution))
+            skip = int(round(preroll / envelope_resolution))
+            count = int(round(s.end / envelope_resolution)) - first_block
+
+            del track.envelope[first_block:]
+            while len(track.envelope) < first_block:
+                track.envelope.append(track.envelope[-1] if len(track.envelope) else float('-inf'))
+            track.envelope.extend(result.envelope[skip:skip + count])
+
+        for programme, result in zip(merged_programmes, analysis.programme_results):
+            momentary_from = max(LOUDNESS_BLOCK, preroll + 0.1) - 0.01
+            short_term_from = max(SHORT_TERM_BLOCK, preroll + 0.1) - 0.01
+            timeline = result.timeline
+            for n in range(len(timeline)):
+                t = timeline.times[n]
+                if t < momentary_from:
+                    continue
+                programme.timeline.append(t + offset,
+                                          timeline.momentary[n],
+                                          timeline.short_term[n] if t >= short_term_from else float('nan'),
+                                          timeline.true_peak[n])
+
+    for track in tracks:
+        if rms_energy[track.index] and total_duration:
+            track.rms = round(10 * math.log10(rms_energy[track.index] / total_duration), 2)
+
+    for programme in merged_programmes:
+        programme.integrated_loudness = gated_loudness(programme.timeline.momentary)
+        programme.loudness_range = loudness_range(programme.timeline.short_term)
+        programme.true_peak = programme.timeline.true_peak_between()
+
+    return AudioReport(tracks, merged_programmes)
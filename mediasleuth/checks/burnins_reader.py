@@ -0,0 +1,209 @@
+# builtin
+import re
+import bisect
+
+# external
+from PIL import Image, ImageOps
+
+# internal
+import ext.ffmpeg as ffmpeg
+
+from mediasleuth.platform import ffmpeg_cmd
+from mediasleuth.ocr import get_ocr_engine, get_region_pool
+from mediasleuth.checks.slate_reader import TextBox, group_lines
+
+# CONSTANTS
+
+# burnt in timecode changes every frame, so any timecode reads as the same thing
+TIMECODE_PATTERN = r'\d{2}[:;.]\d{2}[:;.]\d{2}[:;.]\d{2}'
+
+
+class TextOccurrence:
+    """
+    One piece of text, seen in one region, from start to end (in seconds)
+    """
+    def __init__(self, text, region, start, end):
+        self.text = text
+        self.region = region
+        self.start = start
+        self.end = end
+
+    def summary(self):
+        return '{} ({}) {:.1f}s - {:.1f}s'.format(self.text, self.region, self.start, self.end)
+
+    def to_dict(self):
+        return {'text': self.text, 'region': self.region, 'start': self.start, 'end': self.end}
+
+
+class BurninsReader:
+    """
+    This reads text burnt into the picture, all the way through a movie (as hinted at by the SlateReader)
+        eg burnt in timecode, watermarks, "NOT FOR BROADCAST" supers
+
+    Reading every frame would take forever, so:
+        we only look at a frame every sample_seconds, scaled down and in grey, straight off a pipe from ffmpeg
+        burn ins sit at the edges of frame, so we only read the regions set in the config (eg the top and bottom)
+        if the luma chunks from the pixel strip say the picture hasn't changed since the last sample,
+            we don't read it again
+        the regions of each sample are read side by side, by the shared OCR engine (see ocr.py)
+
+    What we end up with is a timeline of each piece of text, and when and where it was on screen
+    Any timecode is read as just 'timecode', and any of the watch phrases as that phrase, so they count as one thing
+    """
+    def __init__(self, config, file, resolution, fps, luma_chunk_spans=None, cancel_token=None, segments=None):
+        self.config = config
+        self.file = file
+        self.fps = fps
+        self.cancel_token = cancel_token
+        self.segments = segments
+
+        self.ffmpeg_log_level = config["FFmpeg"]["log_level"]
+
+        self.sample_seconds = config.getfloat('Burnins', 'sample_seconds', fallback=2)
+        self.min_confidence = config.getfloat('Burnins', 'min_confidence', fallback=60)
+        self.tesseract_lang = config.get('Slate Reader', 'tesseract_lang', fallback='eng')
+        self.tesseract_config = config.get('Slate Reader', 'tesseract_config', fallback='')
+
+        phrases = config.get('Burnins', 'phrases', fallback="'not for broadcast'")
+        self.phrases = [x.strip().strip("'").lower() for x in phrases.split(',') if x.strip()]
+
+        # the size we read the frames at, keeping the aspect and an even height
+        self.width = config.getint('Burnins', 'read_width', fallback=960)
+        self.height = max(2, int(round(self.width * resolution[1] / resolution[0] / 2)) * 2)
+
+        # each region is name:top:bottom, as fractions of the frame height
+        self.regions = []
+        for region in config.get('Burnins', 'regions', fallback='top:0:0.15, bottom:0.85:1').split(','):
+            name, top, bottom = region.strip().split(':')
+            box = (0, int(float(top) * self.height), self.width, int(float(bottom) * self.height))
+            self.regions.append((name, box))
+
+        # (first frame, last frame) of each run of frames that look the same, from the pixel strip
+        self.luma_chunk_spans = luma_chunk_spans or []
+        self._chunk_starts = [x[0] for x in self.luma_chunk_spans]
+
+        self.occurrences = []
+
+    def read(self):
+        """
+        Samples the whole movie, a segment at a time in parallel if we have them, and builds the timeline
+        """
+        if self.segments:
+            windows = [(x.start, x.input_args()) for x in self.segments.segments]
+            samples = []
+            for x in self.segments.map(self.read_window, windows, cancel_token=self.cancel_token):
+                samples += x
+        else:
+            samples = self.read_window((0, ''))
+
+        self.occurrences = build_timeline(samples, self.sample_seconds)
+        return self.occurrences
+
+    def read_window(self, window):
+        """
+        Returns a (seconds, region name, text) for each line of text read in each sample of the window
+        """
+        start, input_args = window
+        frame_size = self.width * self.height
+
+        cmd = '{} {} {} -i "{}" -vf "fps=1/{:g},scale={}:{},format=gray" -an -f rawvideo -'.format(
+            ffmpeg_cmd(),
+            self.ffmpeg_log_level,
+            input_args,
+            self.file,
+            self.sample_seconds,
+            self.width,
+            self.height
+        )
+
+        samples = []
+        last_chunk = None
+        last_read = []
+        for n, data in enumerate(ffmpeg.iter_ffcmd_chunks(cmd, frame_size, cancel_token=self.cancel_token)):
+            seconds = start + n * self.sample_seconds
+
+            # if the picture hasn't changed since the last sample, neither has the text on it
+            chunk = self.chunk_at(seconds)
+            if chunk is not None and chunk == last_chunk:
+                samples += [(seconds, region, text) for _, region, text in last_read]
+                continue
+
+            frame = Image.frombytes('L', (self.width, self.height), data)
+            last_read = [(seconds, region, text) for region, text in self.read_frame(frame)]
+            last_chunk = chunk
+            samples += last_read
+
+        return samples
+
+    def read_frame(self, frame):
+        """
+        (region name, text) for each line of text in the regions of the frame
+        """
+        crops = []
+        for name, box in self.regions:
+            crop = ImageOps.autocontrast(frame.crop(box))
+
+            # tesseract wants dark text on light, and burn ins are mostly light text (on dark, if they're boxed)
+            histogram = crop.histogram()
+            if sum(i * x for i, x in enumerate(histogram)) / max(1, sum(histogram)) < 128:
+                crop = ImageOps.invert(crop)
+            crops.append((name, crop))
+
+        engine = get_ocr_engine(self.config)
+        futures = [(name, get_region_pool(self.config).submit(engine.image_to_data,
+                                                              crop,
+                                                              lang=self.tesseract_lang,
+                                                              config=self.tesseract_config,
+                                                              cancel_token=self.cancel_token)) for name, crop in crops]
+
+        lines = []
+        for name, future in futures:
+            d = future.result()
+            words = [TextBox(d['left'][i], d['top'][i], d['width'][i], d['height'][i], t)
+                     for i, t in enumerate(d['text'])
+                     if t.strip() and float(d['conf'][i]) >= self.min_confidence]
+            lines += [(name, self.normalise(x)) for x in group_lines(words)]
+        return [x for x in lines if x[1]]
+
+    def normalise(self, text):
+        text = ' '.join(text.split())
+        if re.search(TIMECODE_PATTERN, text):
+            return 'timecode'
+        for phrase in self.phrases:
+            if phrase in text.lower():
+                return phrase
+        return text
+
+    def chunk_at(self, seconds):
+        """
+        The index of the luma chunk this point in time falls in, or None if the pixel strip didn't cover it
+        """
+        frame = int(seconds * self.fps)
+        i = bisect.bisect_right(self._chunk_starts, frame) - 1
+        if i >= 0 and frame <= self.luma_chunk_spans[i][1]:
+            return i
+        return None
+
+    def summary(self):
+        return [x.summary() for x in self.occurrences]
+
+
+def build_timeline(samples, sample_seconds):
+    """
+    Joins up the samples of the same text in the same region into occurrences, wherever they follow on
+    Each sample stands for sample_seconds from when it was taken
+    """
+    occurrences = []
+    open_occurrences = {}
+    for seconds, region, text in sorted(samples, key=lambda x: x[0]):
+        key = (region, text)
+        occurrence = open_occurrences.get(key)
+        if occurrence is not None and seconds - occurrence.end < sample_seconds * 0.5:
+            occurrence.end = seconds + sample_seconds
+            continue
+
+        occurrence = TextOccurrence(text, region, seconds, seconds + sample_seconds)
+        open_occurrences[key] = occurrence
+        occurrences.append(occurrence)
+
+    return occurrences
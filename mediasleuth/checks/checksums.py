@@ -0,0 +1,163 @@
+"""
+Checksums of the whole file (for delivery manifests), and a quick fingerprint of it
+
+The checksums want every byte of the file, and so do the decodes, so we try not to read it twice for them
+    if the file is being staged (see staging.py) the checksums are handed the blocks as they're read
+    otherwise the file is read for them by a thread of its own, in big reads, while the blocks before are hashed
+Every hash of a block runs side by side (hashlib and xxhash let go of the GIL), so the slowest sets the pace
+
+The partial fingerprint is only the size and a hash of the first and last blocks of the file
+    it's no checksum, but it's near instant, and two files that don't share one certainly aren't the same
+    the sampled fingerprint is a few blocks from through the middle as well, see library.py
+
+xxhash is optional, https://github.com/ifduyue/python-xxhash - without it, that checksum is just left empty
+"""
+
+# builtin
+import os
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# internal
+from mediasleuth.staging import advise
+from mediasleuth.cancellation import CheckCancelled
+
+# CONSTANTS
+
+ALGORITHMS = ('md5', 'sha256', 'xxh64')
+
+# reads are whole MiB, so they stay aligned to the pages and sectors underneath
+MIB = 1024 * 1024
+
+
+class Checksums:
+    """
+    Any number of hashes, fed the same blocks, anything with an update(bytes) can feed it (eg the stager)
+    """
+    def __init__(self, algorithms=ALGORITHMS):
+        self.hashers = {}
+        for name in algorithms:
+            hasher = new_hasher(name)
+            if hasher is not None:
+                self.hashers[name] = hasher
+
+        # how much has been hashed, so we can tell if it was all of the file
+        self.bytes = 0
+
+    def update(self, block):
+        if len(self.hashers) > 1:
+            list(get_hash_pool().map(lambda x: x.update(block), self.hashers.values()))
+        else:
+            for hasher in self.hashers.values():
+                hasher.update(block)
+        self.bytes += len(block)
+
+    def hexdigests(self):
+        return {name: hasher.hexdigest() for name, hasher in self.hashers.items()}
+
+
+def new_hasher(name):
+    if name.startswith('xxh'):
+        if not xxhash_available():
+            return None
+        import xxhash
+        return getattr(xxhash, name)()
+    return hashlib.new(name)
+
+
+def hash_file(path, checksums, read_size=8 * MIB, cancel_token=None):
+    """
+    Reads the file on a thread of its own into one of two buffers, while the other is being hashed
+    NOTE : unlike staging, we don't tell the kernel to drop what we've read, the decodes are likely reading it too
+    """
+    free = queue.Queue()
+    full = queue.Queue()
+    for _ in range(2):
+        free.put(bytearray(read_size))
+
+    def read():
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                advise(f, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+                while True:
+                    buffer = free.get()
+                    # the hashing has stopped, so there's nothing to read for
+                    if buffer is None:
+                        return
+                    count = f.readinto(buffer)
+                    full.put((buffer, count))
+                    if not count:
+                        return
+        except Exception as e:
+            full.put((e, 0))
+
+    threading.Thread(target=read, daemon=True, name='checksum-read').start()
+
+    try:
+        while True:
+            if cancel_token is not None and cancel_token.is_cancelled():
+                raise CheckCancelled()
+
+            buffer, count = full.get()
+            if isinstance(buffer, Exception):
+                raise buffer
+            if not count:
+                break
+
+            checksums.update(memoryview(buffer)[:count])
+            free.put(buffer)
+    finally:
+        free.put(None)
+
+    return checksums
+
+
+def partial_fingerprint(path, block_size=MIB):
+    """
+    eg '1048576000-3f2a...', the size and a sha256 of the first and last block_size bytes
+    """
+    size = os.path.getsize(path)
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        hasher.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(block_size, size - block_size))
+            hasher.update(f.read(block_size))
+    return '{}-{}'.format(size, hasher.hexdigest()[:32])
+
+
+def sampled_fingerprint(path, blocks=16, block_size=64 * 1024):
+    """
+    A sha256 of blocks spread evenly through the file, for telling apart files the partial fingerprint can't
+        eg two versions of a spot, the same length, with the same slate and black at the tail
+    """
+    size = os.path.getsize(path)
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for i in range(blocks):
+            f.seek(size * i // blocks)
+            hasher.update(f.read(block_size))
+    return hasher.hexdigest()[:32]
+
+
+def xxhash_available():
+    try:
+        import xxhash
+        return True
+    except ImportError:
+        return False
+
+
+# The one pool for every inspection's hashing, a thread for each algorithm is all it ever needs
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def get_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=len(ALGORITHMS), thread_name_prefix='hash')
+    return _hash_pool
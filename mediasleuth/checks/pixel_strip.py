@@ -13,10 +13,10 @@ TODO a strip that checks the contrast from frame to frame (similar to the way ik
 
 # builtin
 
-import os
-import subprocess
+import re
 import uuid
 import math
+import array
 
 # external
 
@@ -25,9 +25,10 @@ from PIL import Image, ImageFile
 # internal
 
 import ext.ffmpeg as ffmpeg
-import ext.systools as systools
 
-from mediasleuth.platform import ffmpeg_cmd, temp_directory
+from mediasleuth.platform import ffmpeg_cmd
+from mediasleuth.probe import get_stream
+from mediasleuth.workspace import get_workspace
 
 
 class PixelSingle:
@@ -37,6 +38,13 @@ class PixelSingle:
         self.pixel_data = pixel
         self.luma = ColourManagement.calculate_pixel_lum(pixel[0], pixel[1], pixel[2])
 
+        # how many frames this pixel stands for - always 1 for a full decode
+        # when we only decode some frames, each one stands in for the frames up until the next one we decoded
+        self.span = 1
+
+    def last_frame_number(self):
+        return self.frame_number + self.span - 1
+
 
 class PixelChunk:
     # Manages chunks of single pixels and easily lets you calculate info about them
@@ -64,105 +72,429 @@ class PixelChunk:
         self.singles.append(item)
 
     def get_framecount(self):
-        return len(self)
+        return sum(x.span for x in self.singles)
 
     def get_duration_seconds(self):
-        return float(len(self)) / self.parent.fps
+        return float(self.get_framecount()) / self.parent.fps
+
+    def first_frame_number(self):
+        return self.singles[0].frame_number
+
+    def last_frame_number(self):
+        return self.singles[-1].last_frame_number()
+
+    def end_uncertainty(self):
+        """
+        How many frames out our estimate of where this chunk ends could be
+        The change to the next chunk happened somewhere in the frames after the last one we decoded
+        """
+        return self.singles[-1].span - 1
 
     def avg_luma(self):
-        luma_vals = [x.luma for x in self.singles]
-        return sum(luma_vals) / len(self)
+        # weighted by span, so sampled pixels count for all the frames they stand for
+        luma_vals = [x.luma * x.span for x in self.singles]
+        return sum(luma_vals) / self.get_framecount()
+
+
+class DecodeWindow:
+    """
+    A run of frames to decode into a pixel strip
+    input_args go before the input in the ffmpeg command, so any seeking is done on the input (which is fast)
+    fit_tile sizes the strip to the window rather than the default - reading back mostly padding is wasted work
+    start_seconds is where the seek lands us, if we can't be sure it lands on first_frame (eg -sseof)
+        then the frames are numbered from their timestamps, rather than counted from first_frame
+    """
+    def __init__(self, name, first_frame, frame_count, input_args='', fit_tile=False, start_seconds=None):
+        self.name = name
+        self.first_frame = first_frame
+        self.frame_count = frame_count
+        self.input_args = input_args
+        self.fit_tile = fit_tile
+        self.start_seconds = start_seconds
+
+    def frame_at(self, pts_time, fps):
+        """
+        The frame number of a decoded frame, from its timestamp (which starts from 0 where the seek landed)
+        """
+        if self.start_seconds is None:
+            return self.first_frame + int(round(pts_time * fps))
+        return int(round((self.start_seconds + pts_time) * fps))
+
+    def tile_size(self, every=1):
+        if not self.fit_tile:
+            return 0
+        # with a spare row, in case the window has a frame or two more than we thought
+        return int(math.ceil(math.sqrt(math.ceil(self.frame_count / float(every))))) + 1
 
 
 class PixelStrip:
-    def __init__(self, config, movie_filepath):
+    """
+    There are a few ways to decode the strip, set by decode_mode in the config:
+
+    full
+        Every frame is decoded - exact, but as slow as decoding the whole movie
+    keyframe
+        Only keyframes are decoded (-skip_frame nokey), the decoder skips everything else so this is very quick
+        Boundaries are only accurate to the keyframe interval, which depends entirely on how the movie was encoded
+        NOTE : in an intra-only codec (eg ProRes) every frame is a keyframe, so there we sample instead (see below)
+    sampled
+        Every Nth frame is decoded, so boundaries are accurate to N frames
+        In an intra-only codec (see ffmpeg.INTRA_ONLY_CODECS) the other frames are dropped as packets, before decoding
+            which is where this actually saves time, see ffmpeg.sampled_packets_cmd (needs ffmpeg 5.1 or newer)
+        NOTE : anything else (eg h264) still decodes every frame, as each needs the ones before it
+            all that saves is the scaling and reading, so it is next to no quicker than full
+    adaptive
+        Every Nth frame is decoded, then wherever a steady section (eg slate, black) starts or ends,
+        the frames in between are decoded in full - so the boundaries that matter come out exact
+
+    Either way, each PixelSingle knows how many frames it stands for (its span)
+    So chunk durations stay honest, and each chunk can tell you how uncertain its end is
+
+    Given segments (see segments.py), a long movie is decoded a segment at a time in parallel,
+        and stitched back together
+    Otherwise, other checks can share our decode of the whole movie (eg the audio analysis), see fuse
+
+    Given the singles of a strip we decoded before (see singles_from_bytes), nothing is decoded at all
+    Given the framecount, we use that rather than ask the stream, which not every container lists (eg mkv, mxf)
+    """
+    def __init__(self, config, movie_filepath, cancel_token=None, workspace_owner=None, segments=None, fuse=None,
+                 singles=None, framecount=None):
         # make a pixel strip and then pack the data into a queryable format here
         # fun
         # profit
         self.config = config
         self.movie_filepath = movie_filepath
+        self.cancel_token = cancel_token
+        self.segments = segments
+
+        # fuse(decode) is given the decode of the whole movie, if we do it in one go, to add taps of its own to
+        self.fuse = fuse
 
         self.fps = 0
-        self.framecount = 0
+        self.framecount = framecount or 0
+        self.intra_only = False
         self.get_info_from_movie()
 
-        self.pixel_strip_path = temp_directory("pixel_strip")
         self.uuid = uuid.uuid1()
 
-        self.tile_default_size = config["Pixel Strip"]["proxy_image_resolution"]
+        self.tile_default_size = int(config["Pixel Strip"]["proxy_image_resolution"])
         self.proxy_frame_filetype = config["FFmpeg"]["proxy_filetype"]
         self.ffmpeg_log_level = config["FFmpeg"]["log_level"]
 
-        self.create_pixel_strip(movie_filepath)
+        self.decode_mode = config.get('Pixel Strip', 'decode_mode', fallback='full')
+        self.sample_every = config.getint('Pixel Strip', 'sample_every', fallback=12)
+        self.adaptive_tolerance = config.getfloat('Pixel Strip', 'adaptive_tolerance', fallback=1)
+        self.adaptive_max_refinements = config.getint('Pixel Strip', 'adaptive_max_refinements', fallback=32)
+        self.drop_packets = config.getboolean('Pixel Strip', 'drop_packets', fallback=True)
 
-        # todo why this? commenting out for now, but I expect that it was to mitigate some kind of crash
-        # time.sleep(1)
+        # in fast mode we only decode the head and tail of the movie, as that is where the slate and black are
+        self.fast_mode = config.getboolean('Fast Mode', 'enabled', fallback=False)
+        self.head_seconds = config.getfloat('Fast Mode', 'head_seconds', fallback=15)
+        self.tail_seconds = config.getfloat('Fast Mode', 'tail_seconds', fallback=10)
+
+        # the strip belongs to whoever asked for it, and gets cleaned up when they're finished
+        self.workspace = get_workspace(config)
+        self.workspace_owner = workspace_owner or self.uuid
 
         # todo this throws errors on inspection
         #  but I also don't want to waste the effort instatiating a null image here
         self.image = ''
         self.width = 0
         self.height = 0
-        self.read_image_from_pixel_strip()
+
+        if singles is not None:
+            self.single_pixels = singles
+            return
 
         self.single_pixels = []
-        self.get_single_pixels()
+        for singles in self.map_windows(self.decode_window, self.get_decode_windows()):
+            self.single_pixels += singles
+
+    def covers_whole_movie(self):
+        return not self.fast_mode or len(self.get_decode_windows()) == 1
 
     def get_info_from_movie(self):
-        s = ffmpeg.Stream(self.movie_filepath)
+        s = get_stream(self.config, self.movie_filepath, cancel_token=self.cancel_token)
         self.fps = s.video_fps()
-        self.framecount = s.video_framecount()
+        if not self.framecount:
+            self.framecount = s.video_framecount()
+        self.intra_only = s.video_codec_name() in ffmpeg.INTRA_ONLY_CODECS
+
+    def get_decode_windows(self):
+        """
+        Normally we decode the whole movie in one go
+
+        In fast mode we only decode the head and the tail, seeking straight to the tail from the end of the input
+        If the movie is short enough that the head and tail would overlap, we may as well just do the whole thing
+        """
+        if not self.fast_mode:
+            if self.segments:
+                return [DecodeWindow('segment_{}'.format(x.index),
+                                     x.first_frame,
+                                     x.frame_count,
+                                     x.input_args(),
+                                     fit_tile=True)
+                        for x in self.segments.segments]
+            return [DecodeWindow('full', 0, self.framecount)]
+
+        head_frames = int(round(self.head_seconds * self.fps))
+        tail_frames = int(round(self.tail_seconds * self.fps))
+
+        if head_frames + tail_frames >= self.framecount:
+            return [DecodeWindow('full', 0, self.framecount)]
+
+        # -sseof lands on a keyframe, so we can't count on getting exactly tail_frames back, see DecodeWindow
+        return [
+            DecodeWindow('head', 0, head_frames, '-t {}'.format(self.head_seconds)),
+            DecodeWindow('tail',
+                         self.framecount - tail_frames,
+                         tail_frames,
+                         '-sseof -{}'.format(self.tail_seconds),
+                         start_seconds=self.framecount / self.fps - self.tail_seconds),
+        ]
+
+    def map_windows(self, fn, windows):
+        """
+        Run fn over the windows, in parallel if we have segments to share the work with
+        """
+        if self.segments and len(windows) > 1:
+            return self.segments.map(fn, windows, cancel_token=self.cancel_token)
+        return [fn(x) for x in windows]
+
+    def decode_window(self, window):
+        """
+        Decode a window of the movie according to our decode mode, and return its single pixels
+        """
+        if self.decode_mode == 'keyframe' and self.sample_packets():
+            # every frame is a keyframe, so skipping the rest would skip nothing
+            singles = self.decode_samples(window, self.sample_every)
+        elif self.decode_mode == 'keyframe':
+            singles = self.decode_keyframes(window)
+        elif self.decode_mode == 'sampled':
+            singles = self.decode_samples(window, self.sample_every)
+        elif self.decode_mode == 'adaptive':
+            singles = self.decode_samples(window, self.sample_every)
+            singles = self.refine_transitions(window, singles)
+        else:
+            singles = self.decode_samples(window, 1)
+
+        assign_spans(singles, window.first_frame + window.frame_count)
+        return singles
+
+    def sample_packets(self):
+        return self.drop_packets and self.intra_only
+
+    def decode_samples(self, window, every):
+        """
+        Decode every Nth frame of the window (where N of 1 is every frame)
+        In an intra-only codec the others are dropped before they get to the decoder, otherwise they are decoded
+            and thrown away by a select filter
+        """
+        select_filter = ''
+        source = None
+        if every > 1 and self.sample_packets():
+            source = ffmpeg.sampled_packets_cmd(self.movie_filepath, every, window.input_args, executable=ffmpeg_cmd())
+        elif every > 1:
+            select_filter = "select='not(mod(n,{}))'".format(every)
+
+        pixels, pts_times = self.create_pixel_strip(self.movie_filepath,
+                                                    window.input_args,
+                                                    select_filter,
+                                                    window.name,
+                                                    tile_size=window.tile_size(every),
+                                                    log_timestamps=window.start_seconds is not None,
+                                                    source=source)
+
+        if window.start_seconds is not None:
+            return self.singles_from_timestamps(window, pixels, pts_times)
+
+        count = int(math.ceil(window.frame_count / float(every)))
+        return [PixelSingle(window.first_frame + (i * every), coords, pixel)
+                for i, (coords, pixel) in enumerate(pixels[:count])]
+
+    def decode_keyframes(self, window):
+        """
+        Decode only the keyframes of the window
+        We don't know ahead of time where they are, so we have ffmpeg tell us their timestamps as it goes
+        """
+        pixels, pts_times = self.create_pixel_strip(self.movie_filepath,
+                                                    '-skip_frame nokey {}'.format(window.input_args),
+                                                    '',
+                                                    window.name,
+                                                    tile_size=window.tile_size(),
+                                                    log_timestamps=True)
+
+        return self.singles_from_timestamps(window, pixels, pts_times)
+
+    def singles_from_timestamps(self, window, pixels, pts_times):
+        """
+        The pixels numbered by the timestamps of the frames they came from, see DecodeWindow.frame_at
+        NOTE : anything from before the start or past the end of the movie (eg the decoder's preroll) is dropped
+        """
+        singles = []
+        for (coords, pixel), pts_time in zip(pixels, pts_times):
+            frame_number = window.frame_at(pts_time, self.fps)
+            if 0 <= frame_number < self.framecount:
+                singles.append(PixelSingle(frame_number, coords, pixel))
+        return singles
+
+    def refine_transitions(self, window, samples):
+        """
+        Wherever a steady run of samples starts or stops, decode all the frames in between the two samples
+        We only bother where there is a steady run on one side - in busy content every sample is a change,
+        and refining those would just be a full decode with extra steps
+        """
+        refine_windows = []
+
+        for i in range(len(samples) - 1):
+            if abs(samples[i + 1].luma - samples[i].luma) <= self.adaptive_tolerance:
+                continue
+
+            steady_before = i > 0 and abs(samples[i].luma - samples[i - 1].luma) <= self.adaptive_tolerance
+            steady_after = (i + 2 < len(samples)
+                            and abs(samples[i + 2].luma - samples[i + 1].luma) <= self.adaptive_tolerance)
+            if not steady_before and not steady_after:
+                continue
+
+            first_frame = samples[i].frame_number + 1
+            frame_count = samples[i + 1].frame_number - first_frame
+            if frame_count < 1:
+                continue
+
+            if len(refine_windows) >= self.adaptive_max_refinements:
+                print("Too many transitions to refine, the rest are left sampled : {}".format(self.movie_filepath))
+                break
+
+            # seek straight to the frames in question, from the start of the movie regardless of our window
+            input_args = '-ss {:.6f} -t {:.6f}'.format(first_frame / self.fps, frame_count / self.fps)
+            refine_windows.append(DecodeWindow('{}_refine_{}'.format(window.name, len(refine_windows) + 1),
+                                               first_frame,
+                                               frame_count,
+                                               input_args,
+                                               fit_tile=True))
+
+        # this is already running as one of the segments, so the refinements are decoded right here
+        refined = []
+        for refine_window in refine_windows:
+            refined += self.decode_refinement(refine_window)
+
+        return sorted(samples + refined, key=lambda x: x.frame_number)
+
+    def decode_refinement(self, window):
+        pixels, pts_times = self.create_pixel_strip(self.movie_filepath,
+                                                    window.input_args,
+                                                    '',
+                                                    window.name,
+                                                    tile_size=window.tile_size())
+
+        return [PixelSingle(window.first_frame + j, coords, pixel)
+                for j, (coords, pixel) in enumerate(pixels[:window.frame_count])]
+
+    def create_pixel_strip(self, movie_filepath, input_args, select_filter, name, tile_size=0, log_timestamps=False,
+                           source=None):
+        """
+        Run ffmpeg to make a pixel strip, and read it back in
+        Returns the pixels in the order they were decoded, along with their timestamps if log_timestamps is set
+        source is a command to decode the output of instead of the movie, see ffmpeg.FusedDecode
+        """
+        tile_size = tile_size or self.tile_default_size
+
+        pixel_strip_filepath = self.workspace.new_artifact(self.workspace_owner,
+                                                           "pixel_strip",
+                                                           self.proxy_frame_filetype,
+                                                           name=name)
+
+        # showinfo logs each frame as it goes through, which is how we know which frames we got
+        messages = []
+
+        def graph(tag, inputs, outputs):
+            filters = [select_filter, 'scale=1:1', 'tile={}x{}'.format(tile_size, tile_size)]
+            if log_timestamps:
+                filters.insert(1, 'showinfo@{}i'.format(tag))
+            return '[{}]{}[{}]'.format(inputs[0], ','.join([x for x in filters if x]), outputs[0])
+
+        decode = ffmpeg.FusedDecode(movie_filepath,
+                                    input_args,
+                                    executable=ffmpeg_cmd(),
+                                    cancel_token=self.cancel_token,
+                                    source=source)
+        decode.add(ffmpeg.FilterTap(['v:0'],
+                                    graph,
+                                    read=lambda kind, instance, message: messages.append(message),
+                                    outputs=['-frames 1 "{}"'.format(pixel_strip_filepath)]))
+
+        # anything else that wants the whole movie decoded can come along for the ride, see ffmpeg.FusedDecode
+        # NOTE : not when we only have some of the video packets, there is no audio in those
+        if name == 'full' and self.fuse is not None and source is None:
+            self.fuse(decode)
+
+        decode.run()
+        self.workspace.written(pixel_strip_filepath)
 
-    def create_pixel_strip(self, movie_filepath):
-        systools.mkdir(self.pixel_strip_path)
+        # todo why this? commenting out for now, but I expect that it was to mitigate some kind of crash
+        # time.sleep(1)
 
-        pixel_strip_filepath = os.path.join(self.pixel_strip_path, "{}.{}".format(self.uuid, self.proxy_frame_filetype))
+        image = self.read_image_from_pixel_strip(pixel_strip_filepath)
 
-        cmd = '{} {} -y -i "{}" -frames 1 -vf "scale=1:1,tile={}x{}" "{}"'.format(ffmpeg_cmd(),
-                                                                                  self.ffmpeg_log_level,
-                                                                                  movie_filepath,
-                                                                                  self.tile_default_size,
-                                                                                  self.tile_default_size,
-                                                                                  pixel_strip_filepath)
-        print(cmd)
+        pts_times = []
+        if log_timestamps:
+            pts_times = [float(x) for x in re.findall(r'pts_time:\s*(-?[\d.]+)', '\n'.join(messages))]
 
-        subprocess.call(cmd, shell=True)
+        return self.get_pixels(image), pts_times
 
-    def read_image_from_pixel_strip(self):
+    def read_image_from_pixel_strip(self, pixel_strip_filepath):
         ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-        pixel_strip_filepath = os.path.join(self.pixel_strip_path, "{}.{}".format(self.uuid, self.proxy_frame_filetype))
+        image = Image.open(pixel_strip_filepath)
 
-        self.image = Image.open(pixel_strip_filepath)
-        self.width, self.height = self.image.size
+        # read it all in now, so the working file is free to be cleaned up
+        image.load()
 
-    def get_single_pixels(self):
-        self.single_pixels = []
-        for y in range(self.height):
-            for x in range(self.width):
+        # NOTE : with segments, strips are read in parallel, so this is only ever the latest one
+        self.image = image
+        self.width, self.height = image.size
 
-                frame_number = x + (y * 512)
-                if frame_number >= self.framecount:
-                    continue
+        return image
 
-                coords = (x, y)
-                pixel = self.image.getpixel(coords)
+    def get_pixels(self, image=None):
+        """
+        All the pixels in a strip image in decode order, as (coords, pixel) pairs
+        NOTE : the tile is padded out with black, so it's up to the caller to know how many of these are real
+        """
+        image = image or self.image
+        width, height = image.size
 
-                new_pixel_single = PixelSingle(frame_number, coords, pixel)
+        pixels = []
+        for y in range(height):
+            for x in range(width):
+                coords = (x, y)
+                pixels.append((coords, image.getpixel(coords)))
+        return pixels
 
-                self.single_pixels.append(new_pixel_single)
+    def max_boundary_uncertainty(self, chunks):
+        """
+        The most frames any of the boundaries between these chunks could be out by
+        """
+        if not chunks:
+            return 0
+        return max(c.end_uncertainty() for c in chunks)
 
     def get_luma_chunks(self, tolerance=0):
         # returns chunks of pixelsingles sorted by matching luma
         # you can provide a tolerance to group near matches
 
         chunks = []
-        chunk_index = 0
-        last_luma = 0
+        last_luma = None
+        last_frame_number = None
         tolerance = abs(tolerance)
 
         for p in self.single_pixels:
-            if not last_luma:
+            # a chunk never spans frames we didn't decode (eg between the head and tail in fast mode)
+            contiguous = last_frame_number is None or p.frame_number == last_frame_number + 1
+            last_frame_number = p.last_frame_number()
+
+            # NOTE : black has a luma of 0, so be careful not to treat it as the start
+            if last_luma is None or not contiguous:
                 last_luma = p.luma
                 # new_chunk = [p, ]
                 new_chunk = PixelChunk(self, p)
@@ -173,14 +505,13 @@ class PixelStrip:
             luma_max = last_luma + tolerance
 
             if luma_max >= p.luma >= luma_min:
-                chunks[chunk_index].append(p)
+                chunks[-1].append(p)
                 continue
             else:
                 last_luma = p.luma
                 # new_chunk = [p, ]
                 new_chunk = PixelChunk(self, p)
                 chunks.append(new_chunk)
-                chunk_index += 1
 
         return chunks
 
@@ -205,7 +536,7 @@ class PixelStrip:
 
         for c in chunks:
             # if it's bigger than the limit just add it to the pile without staging
-            if len(c) >= count:
+            if c.get_framecount() >= count:
 
                 if staged_chunk:
                     # also add the last staged chunk in front
@@ -223,7 +554,7 @@ class PixelStrip:
                 staged_chunk = c
                 continue
 
-            if len(c) < count:
+            if c.get_framecount() < count:
                 # print "Appending chunk : ", c.print_self()
                 staged_chunk += c
             else:
@@ -244,7 +575,7 @@ class PixelStrip:
         """
         chunks = self.get_luma_chunks(tolerance=tolerance)
         for c in chunks:
-            print(c[0].luma, ' ', len(c), ' frames ', c.get_duration_seconds(), ' seconds')
+            print(c[0].luma, ' ', c.get_framecount(), ' frames ', c.get_duration_seconds(), ' seconds')
         return chunks
 
     def describe_normalized_luma_chunks(self, tolerance=0, count=24, seconds=0):
@@ -256,10 +587,44 @@ class PixelStrip:
         chunks = self.get_luma_chunks(tolerance=tolerance)
         chunks = self.normalize_chunks(chunks, count=count)
         for c in chunks:
-            print(c.avg_luma(), ' ', len(c), ' frames ', c.get_duration_seconds(), ' seconds')
+            print(c.avg_luma(), ' ', c.get_framecount(), ' frames ', c.get_duration_seconds(), ' seconds')
         return chunks
 
 
+def assign_spans(singles, end_frame):
+    """
+    Each single stands for the frames up until the next one, and the last one stands for frames up to end_frame
+    """
+    for i, single in enumerate(singles):
+        if i + 1 < len(singles):
+            next_frame = singles[i + 1].frame_number
+        else:
+            next_frame = end_frame
+        single.span = max(1, next_frame - single.frame_number)
+
+
+def singles_to_bytes(singles):
+    """
+    The frame number, span and pixel of each single, to keep in the measurement store
+    """
+    values = array.array('i')
+    for x in singles:
+        values.extend((x.frame_number, x.span) + tuple(x.pixel_data[:3]))
+    return values.tobytes()
+
+
+def singles_from_bytes(data):
+    values = array.array('i')
+    values.frombytes(data)
+
+    singles = []
+    for i in range(0, len(values) - 4, 5):
+        single = PixelSingle(values[i], None, tuple(values[i + 2:i + 5]))
+        single.span = values[i + 1]
+        singles.append(single)
+    return singles
+
+
 class ColourManagement:
     @staticmethod
     def calculate_pixel_lum(r, g, b, method=0):
@@ -1,43 +1,52 @@
 # builtin
-import os
+import io
 import re
-import uuid
-import subprocess
 # from pprint import pprint
 
 # external
-from PIL import Image
-import pytesseract
+from PIL import Image, ImageFilter, ImageStat
 
 # internal
 import ext.ffmpeg as ffmpeg
-import ext.systools as systools
 
-from mediasleuth.platform import ffmpeg_cmd, temp_directory
+from mediasleuth.platform import ffmpeg_cmd
+from mediasleuth.ocr_cache import get_ocr_cache
+from mediasleuth.ocr import get_ocr_engine, get_region_pool, read_regions
+
+# CONSTANTS
+
+# every png ends with an empty IEND chunk (and its crc), which is how we tell where one frame ends in a stream of them
+PNG_END = b'IEND\xaeB`\x82'
 
 
 class SlateReader:
     """
     This class takes a file in, expected to be some kind of movie file
-        Strips off the first frame
+        Strips off the first frame (or the best few frames of the slate, see read_slate)
         Pulls information from that frame
         Reads the text on it
         Allows you to return that info
 
-    If we wanted to bump up the usefulness, we could make something that can read text all throughout a video
-        eg BurninsReader
+    For text all throughout a video, see BurninsReader
     """
 
-    def __init__(self, config, file):
+    def __init__(self, config, file, cancel_token=None):
         print(file)
         self.config = config
         self.file = file
-        self.uuid = uuid.uuid1()
+        self.cancel_token = cancel_token
 
-        self.proxy_frame_filetype = config["FFmpeg"]["proxy_filetype"]
         self.ffmpeg_log_level = config["FFmpeg"]["log_level"]
 
-        self.head_frame_path = ''
+        # the filtered head frame, as a PIL image
+        self.head_frame = None
+        self.edge_crop = None
+
+        self.tesseract_lang = self.config.get('Slate Reader', 'tesseract_lang', fallback='eng')
+        self.tesseract_config = self.config.get('Slate Reader', 'tesseract_config', fallback='')
+
+        # only read the bands of the frame that look like they have text in them, see find_text_bands
+        self.text_bands = self.config.getboolean('Slate Reader', 'text_bands', fallback=True)
 
         keys = self.config["Slate Reader"]["keys"]
         self.keys = [key.strip("'") for key in keys.split(',')]
@@ -57,20 +66,7 @@ class SlateReader:
             a bounding box
         """
 
-        # make our temp directory, and filename
-        head_frame_path = temp_directory("head_frame")
-        systools.mkdir(head_frame_path)
-
-        head_frame_filename = "{}.{}".format(self.uuid, self.proxy_frame_filetype)
-        head_frame_path = os.path.join(head_frame_path, head_frame_filename)
-        print("Outputting head frame for OCR read : {}".format(head_frame_path))
-
-        # define our crop area
-        # this is designed with a specific slate in mind - ideally this should be configurable
-        resolution = ffmpeg.resolution(self.file)
-        out_w = resolution[0] - (edge_crop * 2)
-        out_h = resolution[1] - (edge_crop * 2)
-        x, y = edge_crop, edge_crop
+        print("Outputting head frame for OCR read : {}".format(self.file))
 
         """
         This grabs the first frame of the video as the 'slate'
@@ -91,37 +87,175 @@ class SlateReader:
             eq=saturation=0:gamma=0.05:contrast=1.2
         """
 
-        cmd = '{} -ss 0 {} -y -i "{}" -vf "crop={}:{}:{}:{}, {}" -t 0.01 "{}"'.format(
+        """
+        The frame comes back as a png on stdout, straight into PIL, so it never touches the disk
+        png because it says how big it is, and is lossless
+        """
+        cmd = '{} -ss 0 {} -i "{}" -vf "{}" -frames:v 1 -f image2pipe -c:v png -'.format(
+            ffmpeg_cmd(),
+            self.ffmpeg_log_level,
+            self.file,
+            self.slate_filter(edge_crop)
+        )
+
+        print(cmd)
+        data = ffmpeg.run_ffcmd(cmd, cancel_token=self.cancel_token, binary=True)
+        if not data:
+            print("ffmpeg didn't give us a head frame : {}".format(self.file))
+            return
+
+        self.head_frame = Image.open(io.BytesIO(data))
+        self.head_frame.load()
+        self.edge_crop = edge_crop
+
+    def slate_filter(self, edge_crop=80):
+        """
+        The crop and the OCR filter for a slate frame, as an ffmpeg filter chain
+        """
+        # define our crop area
+        # this is designed with a specific slate in mind - ideally this should be configurable
+        # ffmpeg works it out from the input size (iw / ih), so we don't need to probe for the resolution first
+        out_w = 'iw-{}'.format(edge_crop * 2)
+        out_h = 'ih-{}'.format(edge_crop * 2)
+        x, y = edge_crop, edge_crop
+
+        return 'crop={}:{}:{}:{}, {}'.format(out_w, out_h, x, y, self.config["Slate Reader"]["slate_filter"])
+
+    def output_frames(self, frame_numbers, edge_crop=80):
+        """
+        Like output_head_frame, but for any frames of the movie, all in the one decode
+        Returns (frame number, PIL image) for each frame we got back, in frame order
+        """
+        frame_numbers = sorted(frame_numbers)
+        print("Outputting {} slate frames for OCR read : {}".format(len(frame_numbers), self.file))
+
+        # the frames come back one png after another, and ffmpeg stops decoding after the last one we want
+        select = '+'.join(['eq(n,{})'.format(n) for n in frame_numbers])
+        cmd = '{} {} -i "{}" -vf "select=\'{}\', {}" -vsync 0 -frames:v {} -f image2pipe -c:v png -'.format(
             ffmpeg_cmd(),
             self.ffmpeg_log_level,
             self.file,
-            out_w, out_h, x, y,
-            self.config["Slate Reader"]["slate_filter"],
-            head_frame_path
+            select,
+            self.slate_filter(edge_crop),
+            len(frame_numbers)
         )
 
         print(cmd)
-        subprocess.call(cmd, shell=True)
+        data = ffmpeg.run_ffcmd(cmd, cancel_token=self.cancel_token, binary=True)
+
+        frames = []
+        for n, png in zip(frame_numbers, split_pngs(data or b'')):
+            frame = Image.open(io.BytesIO(png))
+            frame.load()
+            frames.append((n, frame))
+
+        self.edge_crop = edge_crop
+        return frames
+
+    def read_slate(self, slate_lumas=None):
+        """
+        Reads the slate off the best few frames inside it, if we know where it is (see find_slate_chunk)
+            otherwise off the head frame, as it always has been
+
+        A fade in, or a flash frame at the head, used to cost us the whole read
+        So we pick the steadiest frames of the slate by their luma, decode them, and read the sharpest first
+        Each frame only adds the keys we haven't found yet, and once we've found them all we stop reading
+        """
+        frames = []
+        if slate_lumas:
+            count = self.config.getint('Slate Reader', 'candidate_frames', fallback=5)
+            edge = self.config.getfloat('Slate Reader', 'candidate_edge', fallback=0.1)
+            candidates = pick_candidate_frames(slate_lumas, count=count, edge=edge)
+            frames = self.output_frames(candidates, edge_crop=self.config.getint('Slate Reader', 'edge_crop',
+                                                                                  fallback=80))
+
+        if not frames:
+            self.output_head_frame()
+            self.read_tesseract()
+            return
+
+        frames.sort(key=lambda x: sharpness(x[1]), reverse=True)
 
-        # todo should confirm that the command ran correctly ?
-        self.head_frame_path = head_frame_path
+        slate_info = {}
+        for n, frame in frames:
+            print("Reading slate frame {} : {}".format(n, self.file))
+            self.head_frame = frame
+            self.read_tesseract()
+            for key, value in self.slate_info.items():
+                slate_info.setdefault(key, value)
+
+            if all(key in slate_info for key in self.keys):
+                print("Found every slate key by frame {} : {}".format(n, self.file))
+                break
+
+        self.slate_info = slate_info
+
+    def ocr_settings(self):
+        """
+        Everything that changes what tesseract would read off the head frame, besides the frame itself
+        """
+        return {
+            'edge_crop':        self.edge_crop,
+            'slate_filter':     self.config["Slate Reader"]["slate_filter"],
+            'tesseract_lang':   self.tesseract_lang,
+            'tesseract_config': self.tesseract_config,
+            'text_bands':       self.text_bands
+        }
+
+    def image_to_data(self, im):
+        """
+        The pytesseract read of the frame, or what we read off a frame that looks the same last time (see ocr_cache.py)
+        Only the parts of the read that we use are kept
+        """
+        cache = get_ocr_cache(self.config)
+        image_hash = cache.image_hash(im)
+
+        d = cache.get(image_hash, self.ocr_settings())
+        if d is not None:
+            return d
+
+        # most of a slate is empty background, so where we can, we only give tesseract the lines of text
+        regions = None
+        if self.text_bands:
+            regions = find_text_bands(im,
+                                      threshold=self.config.getint('Slate Reader', 'band_threshold', fallback=128),
+                                      min_ink=self.config.getfloat('Slate Reader', 'band_min_ink', fallback=0.002),
+                                      gap=self.config.getint('Slate Reader', 'band_gap', fallback=4),
+                                      margin=self.config.getint('Slate Reader', 'band_margin', fallback=8))
+            print("Found {} bands of text on the slate".format(len(regions)))
+
+        # this goes to the shared OCR engine, which batches reads or keeps tesseract warm between them (see ocr.py)
+        engine = get_ocr_engine(self.config)
+        if regions:
+            d = read_regions(engine, get_region_pool(self.config), im, regions,
+                             lang=self.tesseract_lang,
+                             config=self.tesseract_config,
+                             cancel_token=self.cancel_token)
+        else:
+            d = engine.image_to_data(im,
+                                     lang=self.tesseract_lang,
+                                     config=self.tesseract_config,
+                                     cancel_token=self.cancel_token)
+
+        cache.put(image_hash, self.ocr_settings(), d)
+        return d
 
     def read_tesseract(self):
-        print("Reading head frame tesseract text recognition : {}".format(self.head_frame_path))
+        print("Reading head frame tesseract text recognition : {}".format(self.file))
 
-        if not self.head_frame_path:
+        if self.head_frame is None:
             print("Failed to locate frame for OCR read - something went wrong")
             return
 
-        im = Image.open(self.head_frame_path)
+        im = self.head_frame
 
         # This is definitely the goal heuristic -
         # CBB package this up so that it's not a direct part of the slate reader
         # really this can take any kind of sparse text across a page and put it into lines
         # the part that I think belongs here is the reading of keys, and splitting into key value pairs
 
-        # 1. Do the pytesseract read
-        d = pytesseract.image_to_data(im, output_type=pytesseract.Output.DICT)
+        # 1. Do the pytesseract read (or find it in the cache)
+        d = self.image_to_data(im)
 
         # 2. Take the text coordinates from the pytesseract read, and store them as bounding boxes
         text_coord = []
@@ -132,34 +266,10 @@ class SlateReader:
 
         print("Individual text box content :\n {}".format([x[-1] for x in text_coord]))
 
-        # 3. Find greater bounding boxes for any text boxes overlapping in the y-axis (that might constitute a line)
+        # 3. Collate the text of any boxes overlapping in the y-axis into lines
         # todo implement tolerances for x and y overlap
         # cbb is there ever a case that we might want to consider columns? hopefully not
-        bounding_boxes = []
-        for item in text_coord:
-            overlaps_with = []
-
-            for other in text_coord:
-                if item == other:
-                    continue
-
-                if item.overlaps(other):
-                    overlaps_with.append(other)
-
-            bounding_boxes.append(get_greatest_bounding_box(overlaps_with+[item, ]))
-
-        # filter them for uniqueness
-        uniq_bounding_boxes = set(bounding_boxes)
-
-        # 4. For each bounding box, collate the text of any overlapping boxes into a line
-        lines = []
-        for bounding_box in uniq_bounding_boxes:
-            newline = ''
-            for text_box in text_coord:
-                if text_box.overlaps(bounding_box):
-                    newtext = text_box.text
-                    newline += ' {}'.format(newtext)
-            lines.append(newline)
+        lines = group_lines(text_coord)
 
         # get only unique lines
         uniq_lines = set(lines)
@@ -185,21 +295,134 @@ class SlateReader:
         self.slate_info = slate_info
 
 
-def get_greatest_bounding_box(boxes):
+def group_lines(text_boxes):
+    """
+    Joins up the text of boxes that overlap in the y-axis (or overlap a box that does, and so on) into lines
+
+    Sorted by their tops, each box either overlaps the line so far or starts the next one
+    So this is a single sweep down the page, rather than checking every box against every other
+    The words of each line stay in the order they were read
+    """
+    order = sorted(range(len(text_boxes)), key=lambda i: text_boxes[i].y)
+
+    groups = []
+    bottom = None
+    for i in order:
+        box = text_boxes[i]
+        if groups and box.y <= bottom:
+            groups[-1].append(i)
+            bottom = max(bottom, box.y + box.h)
+        else:
+            groups.append([i])
+            bottom = box.y + box.h
+
+    return [''.join([' {}'.format(text_boxes[i].text) for i in sorted(group)]) for group in groups]
+
+
+def find_slate_chunk(chunks, fps, slate, search_seconds=10, min_seconds=1):
     """
-    Considering all the boxes create and return a new box based on the greatest bounds of each
+    The luma chunk (see PixelStrip.get_luma_chunks) that the slate is in, or None if there doesn't look to be one
+    If we know there is a slate, it's the first chunk
+    Otherwise it's the longest steady chunk starting in the first search_seconds, if it's at least min_seconds long
+        eg a slate that fades in, or comes after a flash frame, wouldn't pass for a slate but is still worth a read
     """
-    if not boxes:
+    if not chunks:
+        return None
+    if slate:
+        return chunks[0]
+
+    near_head = [x for x in chunks if x.first_frame_number() < search_seconds * fps]
+    if not near_head:
+        return None
+    longest = max(near_head, key=lambda x: x.get_framecount())
+    if longest.get_duration_seconds() < min_seconds:
         return None
+    return longest
+
+
+def pick_candidate_frames(lumas, count=5, edge=0.1):
+    """
+    The count steadiest frames of the slate, from the (frame number, luma) of each frame we have for it
+    Steady meaning their luma is closest to their neighbours', so not mid fade or mid flash
+    The edge (a fraction) at either end is left out, that's where the slate fades in and out
+    The frames are kept apart from each other, so one bad patch doesn't give us every candidate
+    """
+    skip = int(len(lumas) * edge)
+    inner = list(range(skip, len(lumas) - skip)) or list(range(len(lumas)))
+
+    def steadiness(i):
+        before = lumas[i - 1][1] if i > 0 else lumas[i][1]
+        after = lumas[i + 1][1] if i + 1 < len(lumas) else lumas[i][1]
+        return abs(lumas[i][1] - before) + abs(lumas[i][1] - after)
 
-    bx, by, bw, bh = boxes[0].x, boxes[0].y, boxes[0].w, boxes[0].h
-    for b in boxes:
-        bx = min(b.x, bx)
-        by = min(b.y, by)
-        bw = max(b.w, bw)
-        bh = max(b.h, bh)
+    spacing = max(1, len(inner) // (count * 2))
+    picked = []
+    for i in sorted(inner, key=steadiness):
+        if all(abs(i - j) >= spacing for j in picked):
+            picked.append(i)
+        if len(picked) == count:
+            break
+    return [lumas[i][0] for i in picked]
 
-    return Box(bx, by, bw, bh)
+
+def sharpness(image):
+    """
+    How much edge there is in the frame, the variance of an edge filter - blurry frames have soft edges
+    """
+    return ImageStat.Stat(image.convert('L').filter(ImageFilter.FIND_EDGES)).var[0]
+
+
+def split_pngs(data):
+    """
+    Splits a stream of png files (eg from image2pipe) back into each file
+    """
+    pngs = []
+    start = 0
+    while True:
+        end = data.find(PNG_END, start)
+        if end < 0:
+            break
+        pngs.append(data[start:end + len(PNG_END)])
+        start = end + len(PNG_END)
+    return pngs
+
+
+def find_text_bands(image, threshold=128, min_ink=0.002, gap=4, margin=8):
+    """
+    Finds the horizontal bands of the frame that have text in them, as (left, top, right, bottom) boxes
+    The frame has been filtered to dark text on white by now, so anything darker than threshold is ink
+
+    This is a projection profile - the amount of ink in each row of pixels
+        rows with more than min_ink (a fraction of the row) are text, and runs of them closer than gap rows are one band
+        then the same again across each band, to trim it to where its text starts and ends
+    PIL does the summing (resizing with a box filter is an average), so it is quick even on a full frame
+    Each band gets margin pixels around it, as tesseract reads better with a bit of room
+    """
+    grey = image.convert('L')
+    width, height = grey.size
+    ink = grey.point(lambda x: 255 if x < threshold else 0)
+
+    rows = list(ink.resize((1, height), Image.BOX).getdata())
+    runs = []
+    for y, value in enumerate(rows):
+        if value / 255 <= min_ink:
+            continue
+        if runs and y - runs[-1][1] <= gap:
+            runs[-1][1] = y + 1
+        else:
+            runs.append([y, y + 1])
+
+    bands = []
+    for top, bottom in runs:
+        columns = list(ink.crop((0, top, width, bottom)).resize((width, 1), Image.BOX).getdata())
+        inked = [x for x, value in enumerate(columns) if value]
+        if not inked:
+            continue
+        bands.append((max(0, inked[0] - margin),
+                      max(0, top - margin),
+                      min(width, inked[-1] + 1 + margin),
+                      min(height, bottom + margin)))
+    return bands
 
 
 class Box:
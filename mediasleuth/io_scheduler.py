@@ -0,0 +1,236 @@
+"""
+Keeps the inspections from thrashing the disks they read from
+
+Drop a whole drive of media on the table and every file starts decoding at once
+On SSDs that's fine, but on spinning disks (RAID, a NAS...) each reader is sequential on its own,
+    and a lot of them together have the heads seeking back and forth between files - slower than one after another
+So every check that reads the media waits for a reader slot on the device the file is on, see gate
+    the slots are per device, and separate to how many cores we decode with (see [Segments] workers)
+
+Each device starts with readers_per_device slots, and with auto_tune on, every few checks we try one more (or one less)
+    we keep going the way that made the device read faster, and turn back when it made it slower
+The read rate comes from the kernel's count of what has been read from the device, over the time it was busy
+    /proc/diskstats for disks, /proc/self/mountstats for NFS
+    where we don't have a count (eg macOS, Windows, SMB) the slots just stay at readers_per_device
+Devices can be set by hand with [IO Scheduler] devices, as path prefix=slots (eg /Volumes/RAID=1, /mnt/ssd=8)
+    files under a prefix share its slots, and those are never tuned
+"""
+
+# builtin
+import os
+import time
+import threading
+
+# CONSTANTS
+
+# how much slower a device has to get before we think it was the last change that did it, rather than noise
+TUNE_TOLERANCE = 0.05
+
+# diskstats counts in sectors of 512 bytes, whatever the device's own sectors are
+DISKSTATS_SECTOR = 512
+
+
+class DeviceGate:
+    def __init__(self, name, readers, max_readers=8, counter=None, tune_window=4):
+        self.name = name
+        self.readers = readers
+        self.max_readers = max_readers
+        self.tune_window = tune_window
+
+        # counter() is the total bytes read from the device so far, None if we can't know it (so we don't tune)
+        self.counter = counter
+
+        self.active = 0
+        self.condition = threading.Condition()
+
+        # we only count the time the device had a reader on it, so a quiet spell doesn't look like a slow device
+        self.busy = 0
+        self.busy_since = None
+
+        self.finished = 0
+        self.window = None
+        self.last_rate = None
+        self.step = 1
+
+    def acquire(self, cancel_token=None):
+        with self.condition:
+            while self.active >= self.readers:
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                self.condition.wait(0.25)
+
+            if self.active == 0:
+                self.busy_since = time.monotonic()
+            self.active += 1
+
+            if self.window is None and self.counter is not None:
+                self.window = (self.busy_seconds(), self.counter())
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            if self.active == 0:
+                self.busy += time.monotonic() - self.busy_since
+                self.busy_since = None
+
+            self.finished += 1
+            if self.counter is not None and self.window is not None and self.finished >= self.tune_window:
+                self.tune()
+
+            self.condition.notify_all()
+
+    def busy_seconds(self):
+        if self.busy_since is None:
+            return self.busy
+        return self.busy + time.monotonic() - self.busy_since
+
+    def tune(self):
+        """
+        Called with the condition held, once every tune_window checks
+        """
+        busy, read = self.busy_seconds(), self.counter()
+        rate = (read - self.window[1]) / max(busy - self.window[0], 0.001)
+
+        if self.last_rate is not None and rate < self.last_rate * (1 - TUNE_TOLERANCE):
+            # that made it slower, so go back the other way
+            self.step = -self.step
+
+        readers = min(self.max_readers, max(1, self.readers + self.step))
+        if readers != self.readers:
+            print("{} reading at {:.1f} MB/s, trying {} readers at a time".format(self.name, rate / 1000000, readers))
+
+        self.readers = readers
+        self.last_rate = rate
+        self.finished = 0
+        self.window = (busy, read)
+
+    def waiting_on(self):
+        """
+        For display, eg '2 / 3'
+        """
+        return '{} / {}'.format(self.active, self.readers)
+
+
+class IOScheduler:
+    def __init__(self, config):
+        self.enabled = config.getboolean('IO Scheduler', 'enabled', fallback=True)
+        self.readers = config.getint('IO Scheduler', 'readers_per_device', fallback=2)
+        self.max_readers = config.getint('IO Scheduler', 'max_readers_per_device', fallback=8)
+        self.auto_tune = config.getboolean('IO Scheduler', 'auto_tune', fallback=True)
+        self.tune_window = config.getint('IO Scheduler', 'tune_window', fallback=4)
+
+        # [(path prefix, readers)], longest prefix first so the most specific one wins
+        self.devices = []
+        for device in config.get('IO Scheduler', 'devices', fallback='').split(','):
+            if '=' in device:
+                prefix, readers = device.rsplit('=', 1)
+                self.devices.append((os.path.realpath(prefix.strip()), int(readers)))
+        self.devices.sort(key=lambda x: len(x[0]), reverse=True)
+
+        self.gates = {}
+        self.lock = threading.Lock()
+
+    def gate(self, path):
+        """
+        The gate for the device the file is on, or None if we aren't scheduling
+        """
+        if not self.enabled:
+            return None
+
+        path = os.path.realpath(path)
+        for prefix, readers in self.devices:
+            if path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep):
+                with self.lock:
+                    if prefix not in self.gates:
+                        self.gates[prefix] = DeviceGate(prefix, readers, max_readers=readers)
+                    return self.gates[prefix]
+
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            return None
+
+        with self.lock:
+            if device not in self.gates:
+                mount_point = find_mount_point(path)
+                counter = read_counter(device, mount_point) if self.auto_tune else None
+                self.gates[device] = DeviceGate(mount_point,
+                                                self.readers,
+                                                max_readers=self.max_readers,
+                                                counter=counter,
+                                                tune_window=self.tune_window)
+                print("Reading from {}, {} readers at a time{}".format(mount_point,
+                                                                      self.readers,
+                                                                      '' if counter else ' (not tuned)'))
+            return self.gates[device]
+
+
+def find_mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def read_counter(device, mount_point):
+    """
+    A function giving the bytes read from the device so far, or None if the platform doesn't keep count
+    """
+    if os.path.isfile('/proc/diskstats') and os.major(device) != 0:
+        major, minor = os.major(device), os.minor(device)
+        if diskstats_read_bytes(major, minor) is not None:
+            return lambda: diskstats_read_bytes(major, minor) or 0
+
+    # network filesystems have no block device (their major is 0), NFS keeps its own count per mount
+    if os.path.isfile('/proc/self/mountstats') and nfs_read_bytes(mount_point) is not None:
+        return lambda: nfs_read_bytes(mount_point) or 0
+
+    return None
+
+
+def diskstats_read_bytes(major, minor):
+    """
+    Bytes read from a block device, the third count after the name is sectors read
+    """
+    try:
+        with open('/proc/diskstats', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 5 and fields[0] == str(major) and fields[1] == str(minor):
+                    return int(fields[5]) * DISKSTATS_SECTOR
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def nfs_read_bytes(mount_point):
+    """
+    Bytes read from the server for an NFS mount, the fifth count on its bytes: line (serverread)
+    """
+    try:
+        with open('/proc/self/mountstats', 'r') as f:
+            mount = None
+            for line in f:
+                if line.startswith('device '):
+                    mount = line.split(' mounted on ')[-1].split(' with fstype')[0] if ' mounted on ' in line else None
+                elif mount == mount_point and line.strip().startswith('bytes:'):
+                    return int(line.split()[5])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+# There is just the one scheduler per running instance, so every inspection shares the devices' slots
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_io_scheduler(config):
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = IOScheduler(config)
+    return _scheduler
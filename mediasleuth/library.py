@@ -0,0 +1,344 @@
+"""
+Remembers every file we've inspected, so we can tell when a new one is something we've already seen
+
+The same spot turns up again and again, under another name, or re-delivered with only a new audio mix
+So each file leaves an entry here, with a few signatures of it:
+    its partial and sampled fingerprints (see checksums.py), which find the files that could be byte for byte the same
+    a picture signature, from the luma of every frame of the content in the pixel strip
+    an audio signature, from the peak envelopes of the audio tracks over the same stretch
+A new file is then one of
+    identical to X                      same bytes, so we reuse everything measured of X (see MeasurementStore.adopt)
+                                        the fingerprints only find the candidates,
+                                        a checksum of the whole file confirms it
+                                        eg a new audio mix can leave a ProRes master the same size, with the same head,
+                                        tail and sampled blocks
+    same picture and audio as X         eg re-wrapped, or renamed and re-encoded
+    same picture as X, different audio  eg a new mix
+    new
+
+The signatures are the content cut into SIGNATURE_BITS + 1 equal stretches, and the average level of each
+    each bit is whether the next stretch is brighter (or louder) than this one, so they don't mind a re-encode
+    and a change of less than the dead band is no change, so a still picture doesn't come out as noise
+Close signatures are found with a BK-tree over how many bits they differ by, so a match takes milliseconds
+    https://en.wikipedia.org/wiki/BK-tree
+    those that are close enough are then checked on their levels, and the length of their content
+
+The index is one json file, read the once and written back whenever it changes
+"""
+
+# builtin
+import os
+import json
+import time
+import threading
+
+# internal
+import ext.systools as systools
+
+from mediasleuth.platform import config_directory
+
+# CONSTANTS
+
+SIGNATURE_BITS = 64
+
+# quieter than this is as good as silence, and keeps -inf out of the sums
+LEVEL_FLOOR = -90.0
+
+# what each match is called, for display
+MATCH_TEXT = {
+    'identical': 'identical to {}',
+    'same':      'same picture and audio as {}',
+    'picture':   'same picture as {}, different audio',
+}
+
+
+class BKTree:
+    """
+    Hashes (as ints) kept so that all those within a number of bits of another can be found without trying them all
+    Each node's children are kept by how far they are from it, and the triangle inequality rules out most of them
+    """
+    def __init__(self):
+        # [hash, items, {distance: node}]
+        self.root = None
+
+    def add(self, key, item):
+        if self.root is None:
+            self.root = [key, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = [key, [item], {}]
+                return
+            node = node[2][distance]
+
+    def search(self, key, radius):
+        """
+        (distance, item) of everything within radius bits of the key
+        """
+        found = []
+        if self.root is None:
+            return found
+
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(key, node[0])
+            if distance <= radius:
+                found += [(distance, x) for x in node[1]]
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+        return found
+
+
+class LibraryIndex:
+    def __init__(self, config):
+        self.enabled = config.getboolean('Library', 'enabled', fallback=True)
+        self.max_picture_distance = config.getint('Library', 'max_picture_distance', fallback=8)
+        self.max_audio_distance = config.getint('Library', 'max_audio_distance', fallback=8)
+        self.picture_tolerance = config.getfloat('Library', 'picture_level_tolerance', fallback=3)
+        self.audio_tolerance = config.getfloat('Library', 'audio_level_tolerance_db', fallback=1)
+        self.duration_tolerance = config.getfloat('Library', 'duration_tolerance_seconds', fallback=0.5)
+
+        self.path = os.path.join(config_directory('library'), 'library.json')
+        self.lock = threading.Lock()
+
+        # read the once, and written back whenever it changes
+        self.entries = {}
+        if self.enabled:
+            systools.mkdir(os.path.dirname(self.path))
+            self.entries = self.read()
+
+        # the paths with each pair of fingerprints, and the picture signatures to search
+        self.exact = {}
+        self.pictures = BKTree()
+        for entry in self.entries.values():
+            self.index(entry)
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return {}
+
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("Could not read the library index, starting afresh \n{}".format(e))
+            return {}
+
+    def write(self):
+        # write it alongside and swap it in, so nobody ever reads half a file
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print("Could not write the library index \n{}".format(e))
+
+    def index(self, entry):
+        self.exact.setdefault(exact_key(entry), set()).add(entry['path'])
+        if entry.get('picture'):
+            # NOTE : a BK-tree can't let go of anything, so a replaced entry's old picture is skipped when found
+            self.pictures.add(int(entry['picture'], 16), entry['path'])
+
+    def get(self, path):
+        with self.lock:
+            return self.entries.get(path)
+
+    def candidates(self, path, partial, sampled):
+        """
+        The paths of other files with the same fingerprints as this one, which may or may not be the same bytes
+        """
+        if not self.enabled:
+            return []
+
+        key = exact_key({'partial': partial, 'sampled': sampled})
+        with self.lock:
+            others = [x for x in self.exact.get(key, ()) if x != path and exact_key(self.entries[x]) == key]
+
+        # it has to still be there, and not have changed since
+        size = partial.split('-')[0]
+        return [x for x in sorted(others) if os.path.isfile(x) and str(os.path.getsize(x)) == size]
+
+    def match(self, entry, identical_to=None):
+        """
+        (kind, path) of the closest file to the entry in the library, see MATCH_TEXT, or (None, None) if it's new
+        identical_to is a file whose whole contents have been checked to be the same, see candidates
+        """
+        if not self.enabled:
+            return None, None
+
+        if identical_to:
+            return 'identical', identical_to
+
+        if not entry.get('picture'):
+            return None, None
+
+        with self.lock:
+            found = self.pictures.search(int(entry['picture'], 16), self.max_picture_distance)
+            candidates = []
+            for distance, path in sorted(found):
+                candidate = self.entries.get(path)
+                if path == entry['path'] or candidate is None or candidate.get('picture') is None:
+                    continue
+                # the entry was replaced since, and this is its old picture
+                if hamming(int(candidate['picture'], 16), int(entry['picture'], 16)) != distance:
+                    continue
+                candidates.append(candidate)
+
+        best = None
+        for candidate in candidates:
+            if abs(candidate['seconds'] - entry['seconds']) > self.duration_tolerance:
+                continue
+            if level_difference(candidate['picture_levels'], entry['picture_levels']) > self.picture_tolerance:
+                continue
+            if not os.path.isfile(candidate['path']):
+                continue
+
+            if self.same_audio(candidate, entry):
+                return 'same', candidate['path']
+            if best is None:
+                best = candidate
+
+        if best is not None:
+            return 'picture', best['path']
+        return None, None
+
+    def same_audio(self, a, b):
+        if a.get('audio') is None or b.get('audio') is None:
+            # no audio in either is the same audio, but we can't say either way if only one was measured
+            return a.get('audio_tracks') == b.get('audio_tracks') == 0
+        if hamming(int(a['audio'], 16), int(b['audio'], 16)) > self.max_audio_distance:
+            return False
+        return level_difference(a['audio_levels'], b['audio_levels']) <= self.audio_tolerance
+
+    def add(self, entry):
+        """
+        entry has to be something json can hold, see new_entry
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            old = self.entries.get(entry['path'])
+            if old is not None:
+                self.exact.get(exact_key(old), set()).discard(old['path'])
+
+            entry['seen'] = time.time()
+            self.entries[entry['path']] = entry
+            self.index(entry)
+            self.write()
+
+
+def new_entry(path, partial, sampled, seconds=None, picture=None, audio=None, audio_tracks=None):
+    """
+    picture and audio are (bits, levels) from the signature functions, or None if we don't have them
+    """
+    return {
+        'path':           path,
+        'partial':        partial,
+        'sampled':        sampled,
+        'seconds':        seconds,
+        'picture':        picture[0] if picture else None,
+        'picture_levels': picture[1] if picture else None,
+        'audio':          audio[0] if audio else None,
+        'audio_levels':   audio[1] if audio else None,
+        'audio_tracks':   audio_tracks,
+    }
+
+
+def picture_signature(singles, first_frame, last_frame, dead_band=1.0, min_coverage=0.9):
+    """
+    The signature of the frames first_frame to last_frame, from the (frame number, span, luma) of the pixel strip
+    None if the strip doesn't cover enough of them (eg fast mode), or there are too few to cut up
+    """
+    bins = SIGNATURE_BITS + 1
+    frames = last_frame - first_frame + 1
+    if frames < bins:
+        return None
+
+    totals = [0.0] * bins
+    counts = [0] * bins
+    for frame_number, span, luma in singles:
+        for frame in range(max(frame_number, first_frame), min(frame_number + span, last_frame + 1)):
+            i = (frame - first_frame) * bins // frames
+            totals[i] += luma
+            counts[i] += 1
+
+    if sum(counts) < frames * min_coverage or 0 in counts:
+        return None
+
+    levels = [round(total / count, 2) for total, count in zip(totals, counts)]
+    return rising_bits(levels, dead_band), levels
+
+
+def audio_signature(envelopes, resolution, start_seconds, end_seconds, dead_band=1.0):
+    """
+    The signature of the loudest of the envelopes (dBFS, one block every resolution seconds) between the two times
+    None if there is too little of it to cut up
+    """
+    bins = SIGNATURE_BITS + 1
+    first = int(start_seconds / resolution)
+    blocks = int(end_seconds / resolution) - first
+    if blocks < bins or not envelopes:
+        return None
+
+    levels = [LEVEL_FLOOR] * bins
+    for envelope in envelopes:
+        for i in range(bins):
+            part = envelope[first + i * blocks // bins:first + (i + 1) * blocks // bins]
+            if len(part):
+                levels[i] = max(levels[i], max(part))
+
+    levels = [round(x, 2) for x in levels]
+    return rising_bits(levels, dead_band), levels
+
+
+def rising_bits(levels, dead_band):
+    value = 0
+    for a, b in zip(levels, levels[1:]):
+        value = (value << 1) | (1 if b > a + dead_band else 0)
+    return '{:0{}x}'.format(value, SIGNATURE_BITS // 4)
+
+
+def level_difference(a, b):
+    """
+    The average difference between two lists of levels
+    """
+    if not a or not b or len(a) != len(b):
+        return float('inf')
+    return sum(abs(x - y) for x, y in zip(a, b)) / len(a)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def exact_key(entry):
+    return '{}|{}'.format(entry['partial'], entry['sampled'])
+
+
+def describe_match(kind, path):
+    if kind is None:
+        return 'new'
+    return MATCH_TEXT[kind].format(os.path.basename(path))
+
+
+# There is just the one index per running instance
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_library_index(config):
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = LibraryIndex(config)
+    return _index
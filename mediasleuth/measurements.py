@@ -0,0 +1,163 @@
+"""
+Keeps the measurements that are expensive to make (eg anything that reads the whole file), so we only make them once
+
+Each file gets its own little json file, named for the identity of the media file - its path, size and modified time
+    (plus a .bin file for each of the bigger measurements, see put_blob)
+So if the file changes in any way we'd notice, its old measurements just stop being found, and we measure it again
+Anything that can't be read back is treated as not being there, this is a cache and never the source of truth
+"""
+
+# builtin
+import os
+import json
+import hashlib
+import threading
+
+# internal
+import ext.systools as systools
+
+from mediasleuth.platform import config_directory
+
+# CONSTANTS
+
+# measurements of the file's bytes themselves, which have to be measured of each file and never taken from another
+NEVER_ADOPTED = ('checksums',)
+
+
+class MeasurementStore:
+    def __init__(self, config):
+        self.enabled = config.getboolean('Measurements', 'enabled', fallback=True)
+        self.path = config_directory('measurements')
+        self.lock = threading.Lock()
+
+        if self.enabled:
+            systools.mkdir(self.path)
+
+    def identity(self, media_path):
+        """
+        A name that changes if the file does, or None if the file isn't there to identify
+        """
+        try:
+            stat = os.stat(media_path)
+        except OSError:
+            return None
+
+        key = '{}|{}|{}'.format(os.path.abspath(media_path), stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def store_path(self, media_path):
+        identity = self.identity(media_path)
+        if not identity:
+            return None
+        return os.path.join(self.path, '{}.json'.format(identity))
+
+    def read_all(self, media_path):
+        store_path = self.store_path(media_path)
+        if not self.enabled or not store_path or not os.path.isfile(store_path):
+            return {}
+
+        try:
+            with open(store_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("Could not read stored measurements, they'll be measured again \n{}".format(e))
+            return {}
+
+    def get(self, media_path, key):
+        """
+        Returns the stored measurement, or None if we don't have it
+        """
+        with self.lock:
+            return self.read_all(media_path).get(key)
+
+    def put(self, media_path, key, value):
+        """
+        Store a measurement, it has to be something json can hold
+        """
+        store_path = self.store_path(media_path)
+        if not self.enabled or not store_path:
+            return
+
+        with self.lock:
+            measurements = self.read_all(media_path)
+            measurements[key] = value
+
+            # write it alongside and swap it in, so nobody ever reads half a file
+            temp_path = '{}.{}.tmp'.format(store_path, os.getpid())
+            try:
+                with open(temp_path, 'w') as f:
+                    json.dump(measurements, f)
+                os.replace(temp_path, store_path)
+            except OSError as e:
+                print("Could not store measurements \n{}".format(e))
+
+    def blob_path(self, media_path, key):
+        identity = self.identity(media_path)
+        if not identity:
+            return None
+        return os.path.join(self.path, '{}.{}.bin'.format(identity, key))
+
+    def get_blob(self, media_path, key):
+        """
+        Returns the stored bytes, or None if we don't have them
+        For measurements too big to sit in the json (eg anything with a value every few milliseconds)
+        """
+        blob_path = self.blob_path(media_path, key)
+        if not self.enabled or not blob_path or not os.path.isfile(blob_path):
+            return None
+
+        try:
+            with open(blob_path, 'rb') as f:
+                return f.read()
+        except OSError as e:
+            print("Could not read stored measurements, they'll be measured again \n{}".format(e))
+            return None
+
+    def put_blob(self, media_path, key, data):
+        blob_path = self.blob_path(media_path, key)
+        if not self.enabled or not blob_path:
+            return
+
+        temp_path = '{}.{}.{}.tmp'.format(blob_path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, blob_path)
+        except OSError as e:
+            print("Could not store measurements \n{}".format(e))
+
+    def adopt(self, media_path, other_path):
+        """
+        Takes on every measurement of another file that is the same as this one (see library.py)
+        Anything already measured for this file is kept as it is, and the checksums are never taken, see NEVER_ADOPTED
+        IMPORTANT : only for files whose whole contents have been checked to be the same, fingerprints aren't enough
+        """
+        identity = self.identity(media_path)
+        other_identity = self.identity(other_path)
+        if not self.enabled or not identity or not other_identity or identity == other_identity:
+            return
+
+        prefix = '{}.'.format(other_identity)
+        for name in os.listdir(self.path):
+            if name.startswith(prefix) and name.endswith('.bin'):
+                key = name[len(prefix):-len('.bin')]
+                if self.get_blob(media_path, key) is None:
+                    self.put_blob(media_path, key, self.get_blob(other_path, key))
+
+        # the json goes last, so nobody finds a measurement without its blobs
+        for key, value in self.read_all(other_path).items():
+            if key not in NEVER_ADOPTED and self.get(media_path, key) is None:
+                self.put(media_path, key, value)
+
+
+# There is just the one store per running instance
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_measurement_store(config):
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MeasurementStore(config)
+    return _store
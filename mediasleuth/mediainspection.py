@@ -2,6 +2,7 @@
 
 import os
 import uuid
+import threading
 
 # EXTERNAL
 
@@ -10,10 +11,22 @@ import pytesseract
 
 # INTERNAL
 
-from mediasleuth.checks.slate_reader import SlateReader
-from mediasleuth.checks.pixel_strip import PixelStrip
+from mediasleuth.checks.slate_reader import SlateReader, find_slate_chunk
+from mediasleuth.checks.burnins_reader import BurninsReader
+from mediasleuth.checks.pixel_strip import PixelStrip, singles_to_bytes, singles_from_bytes
+from mediasleuth.checks.checksums import Checksums, hash_file, partial_fingerprint, sampled_fingerprint, MIB
 from mediasleuth.checks.audio import *
 from mediasleuth.properties import *
+from mediasleuth.registry import CHECKS, COST_DEMUX, COST_DECODE, properties_for_check
+from mediasleuth.cancellation import CancelToken, CheckCancelled
+from mediasleuth.workspace import get_workspace
+from mediasleuth.segments import plan_segments
+from mediasleuth.probe import get_stream
+from mediasleuth.measurements import get_measurement_store
+from mediasleuth.specs import load_specs, compliance_result
+from mediasleuth.staging import get_stager
+from mediasleuth.io_scheduler import get_io_scheduler
+from mediasleuth.library import get_library_index, new_entry, picture_signature, audio_signature, describe_match
 
 # CONSTANTS
 
@@ -54,11 +67,20 @@ class MediaInspection:
             'fps':               BasicProperty(),
             'resolution':        BasicProperty(),
             'audio_peak':        BasicProperty(),
+            'audio_layout':      BasicProperty(),
+            'audio_programmes':  ListProperty(),
             'video_bitrate':     BasicProperty(),
             'video_codec':       BasicProperty(),
             'audio_codec':       BasicProperty(),
             'audio_bitrate':     BasicProperty(),
-            'audio_sample_rate': BasicProperty()
+            'audio_sample_rate': BasicProperty(),
+            'frame_rate_mode':   BasicProperty(),
+            'peak_bitrate':      BasicProperty(),
+            'max_keyframe_interval': TimeProperty(),
+            'md5':               BasicProperty(),
+            'sha256':            BasicProperty(),
+            'xxh64':             BasicProperty(),
+            'partial_fingerprint': BasicProperty()
         }
 
         self.estimated_properties = {
@@ -66,7 +88,11 @@ class MediaInspection:
             'content_start_frame':    BasicProperty(),
             'content_end_frame':      BasicProperty(),
             'content_duration':       TimeProperty(),
+            'content_boundary_uncertainty': UncertaintyProperty(),
             'black_at_tail':          TimeProperty(),
+            'content_loudness':       ListProperty(),
+            'burnins':                ListProperty(),
+            'library_match':          BasicProperty(),
             'slate_agency':           BasicProperty(),
             'slate_aspect':           BasicProperty(),
             'slate_client':           BasicProperty(),
@@ -92,6 +118,54 @@ class MediaInspection:
         # INFORMATION FOR CREATING PROXY FILES
 
         self.uuid = uuid.uuid1()
+
+        # cancelling this cancels every check that is running, or yet to run
+        self.cancel_token = CancelToken()
+
+        # in fast mode, only the head and tail are decoded up front, and the whole clip measurements follow later
+        self.fast_mode = config.getboolean('Fast Mode', 'enabled', fallback=False)
+
+        # in fast mode, the head and tail issues found for each compliance check, waiting on their follow up
+        self.window_issues = {}
+
+        # the compliance specs (OP48, OP59...) are config, see specs.py
+        self.specs = load_specs(config)
+
+        # long media is split into segments to decode in parallel, planned once by whichever check gets there first
+        self._segments = None
+        self._segments_planned = False
+        self._segments_lock = threading.Lock()
+
+        # the packet index is shared by a few checks, and only scanned once (or never, if it was stored last time)
+        self._packet_index = None
+        self._packet_index_lock = threading.Lock()
+
+        # likewise every audio track is analysed in the one decode, and shared by the audio checks
+        self._audio_report = None
+        self._audio_report_lock = threading.Lock()
+
+        # the checks the display has asked for, so work for one can be done in passing by another
+        self.checks_requested = set()
+
+        # the checksums, if they're being fed by the staging read rather than reading the file for themselves
+        self._staging_checksums = None
+        self._staging_checksums_lock = threading.Lock()
+
+        # the sampled fingerprint, the files in the library with the same fingerprints,
+        # and the one of them this one is byte for byte the same as, see library.py
+        self.sampled_fingerprint = None
+        self.identical_candidates = []
+        self.identical_to = None
+
+        # (frame number, span, luma) of every frame, if the pixel strip covered the whole movie
+        self.picture_singles = None
+
+        # (first frame, last frame) of each run of similar frames from the pixel strip, so the burn ins can skip them
+        self.luma_chunk_spans = None
+
+        # (frame number, luma) of each frame of the slate we have from the pixel strip, so the slate reader can pick
+        self.slate_lumas = None
+
         self.proxy_frame_filetype = config["FFmpeg"]["proxy_filetype"]
         self.ffmpeg_log_level = config["FFmpeg"]["log_level"]
 
@@ -163,7 +237,229 @@ class MediaInspection:
     def uuid_filename(self, extension):
         return "{}.{}".format(self.uuid, extension)
 
-    def do_ffmpeg_checks(self):
+    #
+    # Checks
+    #
+
+    def cancel(self):
+        """
+        Stop all the work on this inspection, killing any processes that are running
+        """
+        self.cancel_token.cancel()
+        self.release_working_files()
+
+    def release_working_files(self):
+        """
+        Let go of any working files the checks made, once the checks are done with them
+        """
+        get_workspace(self.config).release(self.uuid)
+        get_stager(self.config).release(self.uuid)
+
+    def media_path(self, cancel_token=None):
+        """
+        The path to decode the media from - a local copy if it's on network storage, see staging.py
+        The path property stays the file itself, that's what it is known by (eg in the measurement store)
+        NOTE : fast mode only reads the head and tail, so copying the whole file would cost more than it saves
+        """
+        if self.fast_mode:
+            return self.get_value('path')
+        return get_stager(self.config).stage(self.get_value('path'),
+                                             self.uuid,
+                                             consumers=self.staging_consumers(),
+                                             cancel_token=cancel_token)
+
+    def staging_consumers(self):
+        """
+        Whatever wants the bytes of the file as the stager reads them, so it doesn't have to read them again
+        """
+        if 'checksums' not in self.checks_requested and not self.identical_candidates:
+            return ()
+        with self._staging_checksums_lock:
+            if self._staging_checksums is None:
+                self._staging_checksums = self.new_checksums()
+        return (self._staging_checksums,)
+
+    def new_checksums(self):
+        algorithms = self.config.get('Checksums', 'algorithms', fallback='md5, sha256, xxh64')
+        return Checksums([x.strip() for x in algorithms.split(',') if x.strip()])
+
+    def check_timeout(self, name):
+        """
+        How long a check gets before we consider it hung, in seconds
+        Anything that reads the whole of the media gets extra time in proportion to the media duration
+        """
+        timeout = self.config.getfloat('Watchdog', 'minimum_timeout', fallback=120)
+
+        duration = self.get_value('full_duration')
+        if CHECKS[name].cost >= COST_DEMUX and duration:
+            timeout += duration * self.config.getfloat('Watchdog', 'duration_factor', fallback=4)
+
+        return timeout
+
+    def segments(self, cancel_token=None):
+        """
+        dependant on : do_ffmpeg_checks
+
+        The segments to split the decoding checks over, or None if the media is too short to bother
+        """
+        with self._segments_lock:
+            if not self._segments_planned:
+                # if the packets have already been indexed, we know where every keyframe is
+                known_keyframes = None
+                if self._packet_index is not None:
+                    known_keyframes = self._packet_index.keyframe_times()
+
+                try:
+                    self._segments = plan_segments(self.config,
+                                                   self.media_path(cancel_token=cancel_token),
+                                                   self.get_value('full_duration'),
+                                                   self.get_value('fps'),
+                                                   self.get_value('framecount'),
+                                                   cancel_token=cancel_token,
+                                                   known_keyframes=known_keyframes)
+                except (ffmpeg.FFmpegCancelled, ffmpeg.FFmpegTimeout):
+                    raise
+                except Exception as e:
+                    print("Could not plan segments, decoding in one go \n{}".format(e))
+                    self._segments = None
+                self._segments_planned = True
+        return self._segments
+
+    def packet_index(self, cancel_token=None):
+        """
+        A scan of all the video packets in the file, see ffmpeg.PacketIndex
+        This reads the whole file (though it doesn't decode it), so we keep what it found for next time
+        """
+        with self._packet_index_lock:
+            if self._packet_index is not None:
+                return self._packet_index
+
+            path = self.get_value('path')
+            store = get_measurement_store(self.config)
+
+            stored = store.get(path, 'packet_index')
+            if stored:
+                try:
+                    self._packet_index = ffmpeg.PacketIndex(path, data=stored)
+                    return self._packet_index
+                except (KeyError, TypeError) as e:
+                    print("Stored packet index is out of date, scanning again \n{}".format(e))
+
+            budget = self.config.getfloat('Measurements', 'packet_index_budget_mb', fallback=64) * 1000000
+            self._packet_index = ffmpeg.PacketIndex(self.media_path(cancel_token=cancel_token),
+                                                    memory_budget=budget,
+                                                    cancel_token=cancel_token)
+            store.put(path, 'packet_index', self._packet_index.to_dict())
+
+        return self._packet_index
+
+    def audio_report(self, cancel_token=None):
+        """
+        dependant on : do_ffmpeg_checks
+
+        Peak, loudness and silence for every audio track, see audio.analyse_audio
+        Kept in the measurement store, envelopes and loudness timelines and all,
+            so nothing needs another decode next time
+        """
+        with self._audio_report_lock:
+            if self._audio_report is not None:
+                return self._audio_report
+
+            path = self.get_value('path')
+            store = get_measurement_store(self.config)
+
+            self._audio_report = load_audio_report(self.config, store, path)
+            if self._audio_report is not None:
+                return self._audio_report
+
+            track_count = len(self.stream.audio_streams())
+            self._audio_report = analyse_audio(self.media_path(cancel_token=cancel_token),
+                                               [self.stream.audio_channel_layout(i) for i in range(track_count)],
+                                               [self.stream.audio_sample_rate(i) for i in range(track_count)],
+                                               self.config,
+                                               cancel_token=cancel_token,
+                                               segments=self.segments(cancel_token=cancel_token))
+            store_audio_report(store, path, self._audio_report)
+
+        return self._audio_report
+
+    def fuse_audio_wanted(self):
+        """
+        Whether the audio analysis should ride along on the pixel strip's decode, see do_pil_checks
+        Not in fast mode, the pixel strip only decodes the head and tail then, and the audio wants the whole clip
+        Nor if the audio has already been analysed (or was stored last time)
+        """
+        if not self.config.getboolean('Fused Decode', 'enabled', fallback=True) or self.fast_mode:
+            return False
+
+        if not self.stream.audio_streams():
+            return False
+
+        with self._audio_report_lock:
+            if self._audio_report is None:
+                self._audio_report = load_audio_report(self.config,
+                                                       get_measurement_store(self.config),
+                                                       self.get_value('path'))
+            return self._audio_report is None
+
+    def loudness_timeline(self, programme=0, cancel_token=None):
+        """
+        dependant on : do_ffmpeg_checks
+
+        The momentary / short term loudness and true peak of a programme over time, eg for a graph
+        """
+        return self.audio_report(cancel_token=cancel_token).loudness_timeline(programme)
+
+    def run_check(self, name):
+        """
+        Runs a check by its registry name
+
+        Each check gets its own cancel token, which trips if the inspection is cancelled or the check runs too long
+        If the check falls over, we null out everything it was responsible for rather than leaving it loading
+        """
+        if self.cancel_token.cancelled():
+            return
+
+        # checks that read the media wait for a reader on its disk, see io_scheduler.py
+        # the deadline only starts once we have one, waiting our turn isn't hanging
+        gate = self.read_gate(name)
+        if gate is not None:
+            try:
+                gate.acquire(cancel_token=self.cancel_token)
+            except CheckCancelled:
+                print("Cancelled check {} for {}".format(name, self.get_value('path')))
+                return
+
+        cancel_token = self.cancel_token.child(timeout=self.check_timeout(name))
+
+        try:
+            getattr(self, CHECKS[name].method)(cancel_token=cancel_token)
+        except (ffmpeg.FFmpegCancelled, CheckCancelled):
+            if self.cancel_token.cancelled():
+                print("Cancelled check {} for {}".format(name, self.get_value('path')))
+                return
+            print("Check {} ran past its deadline for {}".format(name, self.get_value('path')))
+            self.set_null_properties(*properties_for_check(name))
+        except Exception as e:
+            print("Something went wrong, could not complete check {} \n{}".format(name, e))
+            self.set_null_properties(*properties_for_check(name))
+        finally:
+            if gate is not None:
+                gate.release()
+
+    def read_gate(self, name):
+        """
+        The reader gate for the disk a check will read the media from, or None if it doesn't read much of it
+        Once the file has been staged the checks read the local copy, so they queue on that disk instead
+        """
+        if CHECKS[name].cost < COST_DEMUX:
+            return None
+        path = self.get_value('path')
+        if get_stager(self.config).staged(path):
+            path = self.media_path()
+        return get_io_scheduler(self.config).gate(path)
+
+    def do_ffmpeg_checks(self, cancel_token=None):
         # If an unsupported video format is detected, set relevant values to null and exit
         if self.get_value('extension') not in VIDEO_CONTAINERS:
             self.set_null_properties('fps',
@@ -175,20 +471,29 @@ class MediaInspection:
                                      'audio_bitrate',
                                      'audio_sample_rate',
                                      'framecount',
-                                     'full_duration')
+                                     'full_duration',
+                                     'audio_layout')
             return
 
         # do any checks that come direct out of ffmpeg
-        self.stream = ffmpeg.Stream(self.get_value('path'))
+        # (or straight out of the movie header, if it is one we can read ourselves)
+        self.stream = get_stream(self.config, self.get_value('path'), cancel_token=cancel_token)
 
         # todo this is a reasonable default value - but we have a double up of setting a default here and elsewhere
         timecode_start = self.stream.video_start_timecode()
         if not timecode_start:
             timecode_start = '00:00:00:00'
 
+        # not every container lists the frame count (eg mkv, a lot of mxf), so then we count the packets ourselves
+        try:
+            framecount = self.stream.video_framecount()
+        except (KeyError, TypeError, ValueError):
+            print("No frame count listed, counting packets instead : {}".format(self.get_value('path')))
+            framecount = self.packet_index(cancel_token=cancel_token).framecount()
+
         # NOTE : we want to do this instead of ask the stream for duration
         #   because the duration listed in the stream can be unreliable
-        full_duration = float(self.stream.video_framecount() / self.stream.video_fps())
+        full_duration = float(framecount / self.stream.video_fps())
         
         self.set_values({
             'timecode_start':    timecode_start,
@@ -199,11 +504,189 @@ class MediaInspection:
             'audio_codec':       self.stream.audio_codec(),
             'audio_bitrate':     self.stream.audio_bitrate(),
             'audio_sample_rate': self.stream.audio_sample_rate(),
-            'framecount':        self.stream.video_framecount(),
-            'full_duration':     full_duration
+            'framecount':        framecount,
+            'full_duration':     full_duration,
+            'audio_layout':      self.stream.audio_layout()
+        })
+
+    def do_packet_checks(self, cancel_token=None):
+        """
+        Everything we can tell from the packets alone, without decoding anything
+        """
+        if self.get_value('extension') not in VIDEO_CONTAINERS:
+            self.set_null_properties('frame_rate_mode', 'peak_bitrate', 'max_keyframe_interval')
+            return
+
+        index = self.packet_index(cancel_token=cancel_token)
+
+        self.set_values({
+            'frame_rate_mode':       'Variable' if index.is_variable_frame_rate() else 'Constant',
+            'peak_bitrate':          index.peak_bitrate(),
+            'max_keyframe_interval': index.max_keyframe_interval()
         })
 
-    def do_pil_checks(self):
+    def do_fingerprint_check(self, cancel_token=None):
+        """
+        Near instant, and finds the files in the library that could be this one under another name
+        Whether any of them actually is, is up to do_identical_check
+        """
+        path = self.get_value('path')
+        block_size = int(self.config.getfloat('Checksums', 'fingerprint_block_mb', fallback=1) * MIB)
+        partial = partial_fingerprint(path, block_size=block_size)
+        self.sampled_fingerprint = sampled_fingerprint(path)
+        self.set_value('partial_fingerprint', partial)
+
+        self.identical_candidates = get_library_index(self.config).candidates(path, partial, self.sampled_fingerprint)
+
+    def do_identical_check(self, cancel_token=None):
+        """
+        dependant on : do_ffmpeg_checks, do_fingerprint_check
+
+        The decoding checks wait on this, so if we've seen this exact file before under another name,
+            its measurements are already ours by the time they look for them, and they have nothing to decode
+        The fingerprints only say which files could be the same, eg a new audio mix can leave a ProRes master
+            the same size, with the same head, tail and sampled blocks - so we check every byte of both
+        NOTE : not in fast mode, reading two whole files would cost far more than the head and tail we decode
+        """
+        if self.fast_mode or not self.identical_candidates:
+            return
+
+        path = self.get_value('path')
+
+        # the reader run_check got us, before the file is staged and we'd be told the local disk's
+        held_gate = self.read_gate('identical')
+
+        mine = self.own_checksums(cancel_token=cancel_token)
+        for other in self.identical_candidates:
+            theirs = self.file_checksums(other, held_gate=held_gate, cancel_token=cancel_token)
+            common = [x for x in mine if mine[x] and theirs.get(x)]
+            if common and all(mine[x] == theirs[x] for x in common):
+                self.identical_to = other
+                break
+            print("{} has the same fingerprints as {}, but isn't the same".format(path, other))
+
+        if self.identical_to:
+            print("{} is identical to {}, reusing its measurements".format(path, self.identical_to))
+            get_measurement_store(self.config).adopt(path, self.identical_to)
+
+    def own_checksums(self, cancel_token=None):
+        """
+        The checksums of this file, which we have for free if the stager fed them as it read the whole of it
+        """
+        path = self.get_value('path')
+        store = get_measurement_store(self.config)
+        found = store.get(path, 'checksums')
+        if found:
+            return found
+
+        # we already hold a reader on the disk we're reading from, see run_check
+        media_path = self.media_path(cancel_token=cancel_token)
+        checksums = self._staging_checksums
+        if checksums is None or checksums.bytes != os.path.getsize(path):
+            read_size = int(self.config.getfloat('Checksums', 'read_size_mb', fallback=8) * MIB)
+            checksums = hash_file(media_path, self.new_checksums(), read_size=read_size, cancel_token=cancel_token)
+
+        found = checksums.hexdigests()
+        store.put(path, 'checksums', found)
+        return found
+
+    def file_checksums(self, path, held_gate=None, cancel_token=None):
+        """
+        The stored checksums of another file, or we read it for them (waiting our turn on its disk) and store them
+        held_gate is the reader we already have, if it's on the same disk that's the one to read it with
+        """
+        store = get_measurement_store(self.config)
+        found = store.get(path, 'checksums')
+        if found:
+            return found
+
+        gate = get_io_scheduler(self.config).gate(path)
+        if gate is held_gate:
+            gate = None
+        if gate is not None:
+            gate.acquire(cancel_token=cancel_token)
+        try:
+            read_size = int(self.config.getfloat('Checksums', 'read_size_mb', fallback=8) * MIB)
+            found = hash_file(path, self.new_checksums(), read_size=read_size, cancel_token=cancel_token).hexdigests()
+        finally:
+            if gate is not None:
+                gate.release()
+
+        store.put(path, 'checksums', found)
+        return found
+
+    def do_library_check(self, cancel_token=None):
+        """
+        dependant on : do_ffmpeg_checks, do_identical_check, do_pil_checks
+
+        Whether we've seen this file before, or another version of it, see library.py
+        The picture is only compared if the pixel strip covered the whole movie
+            so in fast mode (unless the strip was kept from before) it can only be identical or new
+        """
+        path = self.get_value('path')
+        index = get_library_index(self.config)
+
+        if self.identical_to and index.get(self.identical_to):
+            entry = dict(index.get(self.identical_to), path=path)
+        else:
+            fps = self.get_value('fps')
+            first_frame = self.get_value('content_start_frame')
+            last_frame = self.get_value('content_end_frame')
+
+            picture = None
+            audio = None
+            seconds = None
+            audio_tracks = len(self.stream.audio_streams()) if self.stream else None
+            if self.picture_singles and fps and first_frame is not None and last_frame is not None:
+                picture = picture_signature(self.picture_singles, first_frame, last_frame)
+                seconds = (last_frame - first_frame + 1) / float(fps)
+
+                if picture and audio_tracks:
+                    report = self.audio_report(cancel_token=cancel_token)
+                    tracks = [x for x in report.tracks if len(x.envelope)]
+                    if tracks:
+                        audio = audio_signature([x.envelope for x in tracks],
+                                                tracks[0].envelope_resolution,
+                                                first_frame / float(fps),
+                                                (last_frame + 1) / float(fps))
+
+            entry = new_entry(path,
+                              self.get_value('partial_fingerprint'),
+                              self.sampled_fingerprint,
+                              seconds=seconds,
+                              picture=picture,
+                              audio=audio,
+                              audio_tracks=audio_tracks)
+
+        kind, other = index.match(entry, identical_to=self.identical_to)
+        self.set_value('library_match', describe_match(kind, other))
+        index.add(entry)
+
+    def do_checksum_checks(self, cancel_token=None):
+        """
+        Checksums of the whole file, for delivery manifests
+        If the file was staged, the stager fed them as it read, otherwise we read it for them (see checksums.py)
+        Either way they're kept in the measurement store, the file would have to change for them to
+        """
+        path = self.get_value('path')
+        store = get_measurement_store(self.config)
+
+        found = store.get(path, 'checksums')
+        if not found:
+            media_path = self.media_path(cancel_token=cancel_token)
+
+            checksums = self._staging_checksums
+            if checksums is None or checksums.bytes != os.path.getsize(path):
+                # nobody staged it, or someone else did before we asked for the bytes
+                read_size = int(self.config.getfloat('Checksums', 'read_size_mb', fallback=8) * MIB)
+                checksums = hash_file(media_path, self.new_checksums(), read_size=read_size, cancel_token=cancel_token)
+
+            found = checksums.hexdigests()
+            store.put(path, 'checksums', found)
+
+        self.set_values({x: found.get(x) for x in ('md5', 'sha256', 'xxh64')})
+
+    def do_pil_checks(self, cancel_token=None):
         """
         dependant on : do_ffmpeg_checks
 
@@ -221,6 +704,7 @@ class MediaInspection:
                                      'content_end_frame',
                                      'content_duration',
                                      'content_start_timecode',
+                                     'content_boundary_uncertainty',
                                      'aspect_ratio')
             return
 
@@ -234,13 +718,62 @@ class MediaInspection:
         In the process, the luminance and chromaticity is averaged
         We are able to query this to make basic extrapolations about sections of black, or duplicate frames 
         """
-        ps = PixelStrip(self.config, self.get_value('path'))
+        # if the audio hasn't been analysed yet, it can share the pixel strip's decode rather than have one of its own
+        # the audio checks wait on the lock until it's done, and only decode the audio themselves if it didn't happen
+        fuse_audio = self.fuse_audio_wanted()
+        analyses = []
+        media_path = self.media_path(cancel_token=cancel_token)
+
+        def fuse(decode):
+            track_count = len(self.stream.audio_streams())
+            analyses.append(fused_audio_analysis(media_path,
+                                                 [self.stream.audio_channel_layout(i) for i in range(track_count)],
+                                                 [self.stream.audio_sample_rate(i) for i in range(track_count)],
+                                                 self.config,
+                                                 decode=decode))
+
+        # the strip of the whole movie is kept, so we never decode it again (unless the file changes)
+        store = get_measurement_store(self.config)
+        strip_key = 'pixel_strip_{}'.format(self.config.get('Pixel Strip', 'decode_mode', fallback='full'))
+        stored_strip = store.get_blob(self.get_value('path'), strip_key)
+
+        if fuse_audio:
+            self._audio_report_lock.acquire()
+        try:
+            if stored_strip:
+                ps = PixelStrip(self.config,
+                                media_path,
+                                cancel_token=cancel_token,
+                                workspace_owner=self.uuid,
+                                singles=singles_from_bytes(stored_strip),
+                                framecount=self.get_value('framecount'))
+            else:
+                ps = PixelStrip(self.config,
+                                media_path,
+                                cancel_token=cancel_token,
+                                workspace_owner=self.uuid,
+                                segments=self.segments(cancel_token=cancel_token),
+                                fuse=fuse if fuse_audio else None,
+                                framecount=self.get_value('framecount'))
+                if ps.covers_whole_movie():
+                    store.put_blob(self.get_value('path'), strip_key, singles_to_bytes(ps.single_pixels))
+
+            if analyses and analyses[0].finished:
+                print("Analysed the audio in the same decode as the pixel strip : {}".format(self.get_value('path')))
+                self._audio_report = audio_report_from(analyses[0], self.config)
+                store_audio_report(get_measurement_store(self.config), self.get_value('path'), self._audio_report)
+        finally:
+            if fuse_audio:
+                self._audio_report_lock.release()
 
         """
         Get chunks according to a 1 luma tolerance of change 
         If we were to use a tolerance much lower the slate changes from frame to frame
         """
         similar_chunks = ps.get_luma_chunks(tolerance=1)
+        if stored_strip or ps.covers_whole_movie():
+            self.picture_singles = [(x.frame_number, x.span, x.luma) for x in ps.single_pixels]
+        self.luma_chunk_spans = [(x[0].frame_number, x.last_frame_number()) for x in similar_chunks]
 
         """
         ### SLATE
@@ -258,6 +791,14 @@ class MediaInspection:
         else:
             self.set_value('slate', False)
 
+        slate_chunk = find_slate_chunk(similar_chunks,
+                                       fps,
+                                       self.get_value('slate'),
+                                       search_seconds=self.config.getfloat('Slate Reader', 'slate_search_seconds',
+                                                                           fallback=10))
+        if slate_chunk is not None:
+            self.slate_lumas = [(x.frame_number, x.luma) for x in slate_chunk]
+
         """
         ### BLACK FRAMES
         We get the amount of black frames at the tail of the file
@@ -290,15 +831,28 @@ class MediaInspection:
         start_content = similar_chunks[start_offset][0].frame_number
         self.set_value('content_start_frame', start_content)
 
-        end_content = similar_chunks[len(similar_chunks) + end_offset][-1].frame_number
+        end_content = similar_chunks[len(similar_chunks) + end_offset].last_frame_number()
         self.set_value('content_end_frame', end_content)
 
+        # unless every frame was decoded, the boundaries either side of the content are only accurate to a few frames
+        boundary_chunks = similar_chunks[:start_offset] + [similar_chunks[len(similar_chunks) + end_offset]]
+        self.set_value('content_boundary_uncertainty', ps.max_boundary_uncertainty(boundary_chunks))
+
         self.set_value('content_duration', (end_content - start_content + 1) / float(fps))
 
         content_start_timecode = Timecode(fps, timecode_start)
         content_start_timecode.frames += start_content
         self.set_value('content_start_timecode', content_start_timecode)
 
+        # the specs can be scored again later without the pixel strip, see specs.py
+        get_measurement_store(self.config).put(self.get_value('path'), 'content', {
+            'content_start_frame':  start_content,
+            'content_end_frame':    end_content,
+            'fps':                  fps,
+            'slate':                self.get_value('slate'),
+            'black_at_tail':        self.get_value('black_at_tail')
+        })
+
         """
         ### BLANKING
         Not implemented yet
@@ -319,20 +873,22 @@ class MediaInspection:
         """
         return
 
-    def do_pytesseract_checks(self):
+    def do_pytesseract_checks(self, cancel_token=None):
         """
         dependant on : do_ffmpeg_checks, do_pil_checks
 
-        This performs an OCR read on a slice of the first frame, intending to recognize media key numbers
+        This performs an OCR read on a slice of the slate, intending to recognize media key numbers
+        Where the pixel strip found the slate, the best few frames of it are read, otherwise just the first frame
 
         IMPORTANT : the text recognition isn't perfect, and the filenames often don't match exactly
                     this just checks "probably right", or "not good at all" for speeds sake
         """
 
         try:
-            slate_reader = SlateReader(self.config, self.get_value('path'))
-            slate_reader.output_head_frame()
-            slate_reader.read_tesseract()
+            slate_reader = SlateReader(self.config,
+                                       self.media_path(cancel_token=cancel_token),
+                                       cancel_token=cancel_token)
+            slate_reader.read_slate(self.slate_lumas)
 
             self.set_values({
                 'slate_key_number': slate_reader.slate_info['key'],
@@ -341,6 +897,10 @@ class MediaInspection:
                 'slate_aspect':     slate_reader.slate_info['aspect']
             })
 
+        except (ffmpeg.FFmpegCancelled, CheckCancelled):
+            # let run_check deal with these
+            raise
+
         except pytesseract.pytesseract.TesseractNotFoundError as e:
             print("Tesseract is not installed, not reading slate text \n{}".format(e))
             self.set_null_properties('slate_key_number', 'slate_date', 'slate_duration', 'slate_aspect')
@@ -349,126 +909,243 @@ class MediaInspection:
             print("Something went wrong, not reading slate text \n{}".format(e))
             self.set_null_properties('slate_key_number', 'slate_date', 'slate_duration', 'slate_aspect')
 
-    def do_op48_audio_check(self):
+    def do_burnins_check(self, cancel_token=None):
+        """
+        dependant on : do_ffmpeg_checks, do_pil_checks
+
+        This reads any text burnt into the picture across the whole clip (eg timecode, "NOT FOR BROADCAST")
+        See BurninsReader, it only reads a frame every so often,
+            and not at all where the pixel strip says nothing changed
+        """
+        if self.get_value('extension') not in VIDEO_CONTAINERS:
+            self.set_null_properties('burnins')
+            return
+
+        try:
+            reader = BurninsReader(self.config,
+                                   self.media_path(cancel_token=cancel_token),
+                                   self.stream.video_resolution(),
+                                   self.get_value('fps'),
+                                   luma_chunk_spans=self.luma_chunk_spans,
+                                   cancel_token=cancel_token,
+                                   segments=self.segments(cancel_token=cancel_token))
+            reader.read()
+            self.set_value('burnins', reader.summary())
+
+        except (ffmpeg.FFmpegCancelled, CheckCancelled):
+            # let run_check deal with these
+            raise
+
+        except pytesseract.pytesseract.TesseractNotFoundError as e:
+            print("Tesseract is not installed, not reading burn ins \n{}".format(e))
+            self.set_null_properties('burnins')
+
+        except Exception as e:
+            print("Something went wrong, not reading burn ins \n{}".format(e))
+            self.set_null_properties('burnins')
+
+    def do_op48_audio_check(self, cancel_token=None):
         """
         dependant on : do_ffmpeg_checks, do_pil_checks
 
-        This checks for OP48 audio compliance
+        This checks for OP48 audio compliance, by default
+        - audio peaks below -9 dB across the whole clip
         - 12 frames of silence at the content head
         - 12 frames of silence at the content tail
+        The rules themselves are the OP48 spec, see specs.py
+
+        In fast mode the whole clip check is left to do_op48_followup_check,
+            so the head and tail results come back first
+        """
+        self.spec_check('OP48', 'op48_audio', cancel_token=cancel_token)
+
+    def do_op48_followup_check(self, cancel_token=None):
+        """
+        dependant on : do_op48_audio_check
+
+        In fast mode, this finishes off the OP48 check with the measurements that need the whole clip
+        """
+        self.spec_followup_check('OP48', 'op48_audio', cancel_token=cancel_token)
+
+    def do_audio_peak_check(self, cancel_token=None):
+        """
+        This gets the peak volume across the whole clip (the loudest of any track),
+        and a summary of the loudness and peak of each programme of tracks
         """
 
         # If an unsupported video format is detected, set relevant values to null and exit
-        # TODO audio check acknowledges if the media is mute
         if self.get_value('extension') not in VIDEO_CONTAINERS:
-            self.set_null_properties('op48_audio',
-                                     'audio_peak')
+            self.set_null_properties('audio_peak', 'audio_programmes')
             return
 
-        result = "OP48"
-        issues = []
+        report = self.audio_report(cancel_token=cancel_token)
+        self.set_values({
+            'audio_peak':       report.peak(),
+            'audio_programmes': report.summary()
+        })
 
-        path = self.get_value('path')
+    def content_window(self):
+        """
+        dependant on : do_ffmpeg_checks, do_pil_checks
+
+        The content in seconds from the start of the file (ie without the slate and black), or None if we don't know it
+        """
         content_start_frame = self.get_value('content_start_frame')
         content_end_frame = self.get_value('content_end_frame')
         fps = self.get_value('fps')
 
-        # check from max volume across whole clip
-        ac = is_max_volume_less_than(path, -9)
-        if not ac:
-            issues.append("audio peaks above -9 dB")
+        if content_start_frame is None or content_end_frame is None or not fps:
+            return None
+        return content_start_frame / fps, content_end_frame / fps
 
-        # TODO they want "silence" but nothing says how silent it needs to be
-        #  these masters evidently have some level of wiggle room, so I'm going to guess
-        #  because I've seen things pass looking like that
-        tolerable_level_of_silence = -50
-        frames_either_side = 12
+    def do_content_loudness_check(self, cancel_token=None):
+        """
+        dependant on : do_ffmpeg_checks, do_pil_checks
 
-        # check content first 12 frames for silence
-        content_start_seconds = content_start_frame / fps
-        content_start_seconds_plus = (content_start_frame + frames_either_side) / fps
+        The loudness, loudness range and true peak of each programme over just the content
+        This comes out of the loudness timelines of the whole clip, so it doesn't take another decode
+        """
+        if self.get_value('extension') not in VIDEO_CONTAINERS or self.content_window() is None:
+            self.set_null_properties('content_loudness')
+            return
 
-        mv = get_max_volume_for_duration(path, content_start_seconds, content_start_seconds_plus)
-        if mv >= tolerable_level_of_silence:
-            issues.append("first frames not silent")
+        report = self.audio_report(cancel_token=cancel_token)
+        self.set_value('content_loudness', report.window_summary(*self.content_window()))
 
-        # check content last 12 frames for silence
-        content_end_seconds = content_end_frame / fps
-        content_end_seconds_minus = (content_end_frame - frames_either_side) / fps
+    def do_op59_audio_check(self, cancel_token=None):
+        """
+        dependant on : do_ffmpeg_checks, do_pil_checks
 
-        # TODO get a lot a false negatives here - investigate further
-        # above is the strictly correct math, but maybe this fixes it ?
-        # content_end_seconds_minus += 0.01
-        # content_end_seconds_minus += 0.5
-        content_end_seconds_minus += (1 / fps)
+        This checks for OP59 audio compliance, by default
+        - loudness of -24 ±1 LKFS across the content (the whole clip if we can't tell where that is)
+        - 12 frames of silence at the content head
+        - 12 frames of silence at the content tail
+        The rules themselves are the OP59 spec, see specs.py
 
-        mv = get_max_volume_for_duration(path, content_end_seconds_minus, content_end_seconds)
-        if mv >= tolerable_level_of_silence:
-            issues.append("last frames not silent")
+        In fast mode the whole clip check is left to do_op59_followup_check,
+            so the head and tail results come back first
+        """
+        self.spec_check('OP59', 'op59_audio', cancel_token=cancel_token)
 
-        if issues:
-            result = "Not OP48 - {}".format(', '.join(issues))
+    def do_op59_followup_check(self, cancel_token=None):
+        """
+        dependant on : do_op59_audio_check
 
-        self.set_value('op48_audio', result)
-        self.set_value('audio_peak', get_max_volume(path))
+        In fast mode, this finishes off the OP59 check with the measurements that need the whole clip
+        """
+        self.spec_followup_check('OP59', 'op59_audio', cancel_token=cancel_token)
 
-    def do_op59_audio_check(self):
+    def spec_check(self, spec_name, key, cancel_token=None):
         """
         dependant on : do_ffmpeg_checks, do_pil_checks
 
-        This checks for OP59 audio compliance
+        Scores the file against a spec, and puts the result in key
         """
 
         # If an unsupported video format is detected, set relevant values to null and exit
         # TODO audio check acknowledges if the media is mute
         if self.get_value('extension') not in VIDEO_CONTAINERS:
-            self.set_null_properties('op59_audio',
-                                     'audio_peak')
+            self.set_null_properties(key)
             return
 
-        result = "OP59"
-        issues = []
+        spec = self.specs[spec_name]
+        measurements = InspectionMeasurements(self, cancel_token=cancel_token)
 
-        path = self.get_value('path')
-        content_start_frame = self.get_value('content_start_frame')
-        content_end_frame = self.get_value('content_end_frame')
-        fps = self.get_value('fps')
+        if self.fast_mode:
+            window_issues = spec.issues(measurements, whole_clip=False)
+            self.window_issues[key] = window_issues
+            self.set_value(key, compliance_result(spec_name, window_issues, pending=True))
+            return
 
-        # they want "silence" but nothing says how silent it needs to be
-        # these masters evidently have some level of wiggle room,
-        # so I'm going to guess it's this because I've seen things pass looking like that
-        tolerable_level_of_silence = -50
-        frames_either_side = 12
+        self.set_value(key, compliance_result(spec_name, spec.issues(measurements, fail_fast=measurements.fail_fast)))
 
-        # todo is there a better time and place for this check?
-        # check content first 12 frames for silence
-        content_start_seconds = content_start_frame / fps
-        content_start_seconds_plus = (content_start_frame + frames_either_side) / fps
+    def spec_followup_check(self, spec_name, key, cancel_token=None):
+        if self.get_value('extension') not in VIDEO_CONTAINERS:
+            return
 
-        # check from max volume across whole clip
-        ac = is_loudness_in_bounds(path, -25, -23)
-        if not ac:
-            issues.append("loudness outside -24 ±1 LKFS bounds")
+        # the head and tail pass failed or was cancelled, so there is nothing to finish off
+        window_issues = self.window_issues.get(key)
+        if window_issues is None:
+            print("No {} result for the head and tail to follow up on : {}".format(spec_name, self.get_value('path')))
+            self.set_null_properties(key)
+            return
 
-        mv = get_max_volume_for_duration(path, content_start_seconds, content_start_seconds_plus)
-        if mv >= tolerable_level_of_silence:
-            issues.append("first frames not silent")
+        measurements = InspectionMeasurements(self, cancel_token=cancel_token)
+        issues = self.specs[spec_name].issues(measurements,
+                                              whole_clip=True,
+                                              fail_fast=measurements.fail_fast,
+                                              failed=bool(window_issues)) + window_issues
+        self.set_value(key, compliance_result(spec_name, issues))
 
-        # check content last 12 frames for silence
-        content_end_seconds = content_end_frame / fps
-        content_end_seconds_minus = (content_end_frame - frames_either_side) / fps
 
-        # TODO get a lot a false negatives here - investigate further
-        # above is the strictly correct math, but maybe this fixes it ?
-        # content_end_seconds_minus += 0.01
-        # content_end_seconds_minus += 0.5
-        content_end_seconds_minus += (1 / fps)
+class InspectionMeasurements:
+    """
+    The measurements the specs are scored on (see specs.py), measured from the media if they haven't been already
+    """
+    def __init__(self, inspection, cancel_token=None):
+        self.inspection = inspection
+        self.config = inspection.config
+        self.cancel_token = cancel_token
+
+        # when triaging, we measure as little as we can, and stop as soon as a file has failed (see Spec.issues)
+        self.fail_fast = self.config.getboolean('Fail Fast', 'enabled', fallback=False)
+
+    def track_count(self):
+        return len(self.inspection.stream.audio_streams())
+
+    def loud_tracks(self, ceiling):
+        inspection = self.inspection
+
+        # when triaging, a clip that goes over can stop decoding the moment it does
+        # but that doesn't tell us all the tracks that go over, so if we have the full report we use that
+        if inspection._audio_report is None and self.fail_fast:
+            peak, failed_at, track = watch_peak(inspection.media_path(cancel_token=self.cancel_token),
+                                                ceiling,
+                                                self.track_count(),
+                                                cancel_token=self.cancel_token,
+                                                segments=inspection.segments(cancel_token=self.cancel_token))
+            if failed_at is None:
+                return []
+            return [(track, failed_at)]
+
+        report = inspection.audio_report(cancel_token=self.cancel_token)
+        return [(x.index, None) for x in report.tracks if x.peak is not None and x.peak >= ceiling]
+
+    def programme_loudness(self):
+        # the slate and black would otherwise drag the loudness down
+        report = self.inspection.audio_report(cancel_token=self.cancel_token)
+        if self.content_window() is not None and self.config.getboolean('Audio', 'content_only_loudness',
+                                                                        fallback=True):
+            loudness = [x[0] for x in report.window_loudness(*self.content_window())]
+        else:
+            loudness = [x.integrated_loudness for x in report.programmes]
+        return [(x.tracks, value) for x, value in zip(report.programmes, loudness)]
 
-        mv = get_max_volume_for_duration(path, content_end_seconds_minus, content_end_seconds)
-        if mv >= tolerable_level_of_silence:
-            issues.append("last frames not silent")
+    def content_window(self):
+        return self.inspection.content_window()
+
+    def fps(self):
+        return self.inspection.get_value('fps')
+
+    def whole_clip_measured(self):
+        return self.inspection._audio_report is not None
+
+    def peak_between(self, seconds_from, seconds_to):
+        """
+        These only need a short window of audio each, so they are quick even on long media
+        And if the whole clip has been analysed already (or we're going to anyway),
+            they're just a look up in its silence index
+        NOTE : failing fast, we might never need the whole clip,
+            so unless we have it already each window is its own decode
+        """
+        inspection = self.inspection
 
-        if issues:
-            result = "Not OP59 - {}".format(', '.join(issues))
+        report = None
+        if inspection._audio_report is not None or not (inspection.fast_mode or self.fail_fast):
+            report = inspection.audio_report(cancel_token=self.cancel_token)
 
-        self.set_value('op59_audio', result)
+        return get_max_volume_for_duration(inspection.media_path(cancel_token=self.cancel_token),
+                                           seconds_from,
+                                           seconds_to,
+                                           cancel_token=self.cancel_token,
+                                           report=report)
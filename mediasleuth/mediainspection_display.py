@@ -10,6 +10,7 @@ import threading
 import os
 
 from mediasleuth.mediainspection import MediaInspection
+from mediasleuth.registry import CHECKS, COLUMN_PROPERTIES, checks_for_properties
 
 
 class MediaInspectionDisplayItem:
@@ -34,84 +35,81 @@ class MediaInspectionDisplayItem:
         # do not start threads here or it'll ruin your day
         # the updating and the threads need all the dataview upstream of this to be in order, or it'll misbehave
 
+        # one event per scheduled check, set once that check has finished
+        self.check_events = {}
+        self.lock = threading.Lock()
+
+        self.cancelled = False
+
     def default_display_result(self):
-        return [
-            self.filepath,
-            self.parent_folder,
-            self.filename,
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-            'loading...',
-        ]
-
-    def start_threads(self):
+        return [self.filepath, self.parent_folder, self.filename] + ['loading...' for _ in COLUMN_PROPERTIES]
+
+    def start_threads(self, property_keys):
         """
-        This kicks off threads that perform all of our checks
-        The threads are nested such that dependant work happens one after the other
-        eg audio check requires the content duration determined by pil whose assumptions depend on ffmpeg
+        This kicks off threads that perform the checks needed for the given properties
+        Only the work for those properties (and whatever it depends on) is scheduled,
+            anything else can be asked for later with request_properties
 
-        TODO better naming than thread1..5 - it's not very descriptive
         TODO better system than this for managing threads...
             It's highly possible to make quite a lot of threads at once with this system
             So we oughto look at pool management
         """
-        t = self.thread1
-        x = threading.Thread(target=t)
-        x.start()
-        self.threads.append(x)
-
-    def thread1(self):
-        self.inspection.do_ffmpeg_checks()
-        self.update()
+        self.request_properties(property_keys)
 
-        # dependant threads
-        t = self.thread2
-        x = threading.Thread(target=t)
-        x.start()
-        self.threads.append(x)
+    def request_properties(self, property_keys):
+        """
+        Schedule any checks that haven't been run yet, that are needed to produce the given properties
 
-    def thread2(self):
-        self.inspection.do_pil_checks()
+        Each check gets its own thread, which waits until the checks it depends on are finished
+        eg audio check requires the content duration determined by pil whose assumptions depend on ffmpeg
+        """
+        if self.cancelled:
+            return
+
+        with self.lock:
+            # these are ordered such that dependencies are always scheduled before their dependants
+            for name in checks_for_properties(property_keys, fast_mode=self.inspection.fast_mode):
+                if name in self.check_events:
+                    continue
+
+                self.check_events[name] = threading.Event()
+                self.inspection.checks_requested.add(name)
+
+                x = threading.Thread(target=self.run_check, args=(name,))
+                x.start()
+                self.threads.append(x)
+
+    def run_check(self, name):
+        for dependency in CHECKS[name].depends_on:
+            self.check_events[dependency].wait()
+
+        # in fast mode the whole clip checks are low priority, so let everything else finish first
+        if self.inspection.fast_mode and CHECKS[name].whole_clip:
+            with self.lock:
+                others = [e for n, e in self.check_events.items() if not CHECKS[n].whole_clip]
+            for event in others:
+                event.wait()
+
+        self.inspection.run_check(name)
+        self.check_events[name].set()
         self.update()
 
-        # dependant threads
-        for t in [self.thread3,
-                  self.thread4,
-                  self.thread5
-                  ]:
-            x = threading.Thread(target=t)
-            x.start()
-            self.threads.append(x)
-
-    def thread3(self):
-        self.inspection.do_pytesseract_checks()
-        self.update()
+        # once everything scheduled so far is done, the working files can go
+        # if more properties are asked for later, those checks make (and release) their own
+        with self.lock:
+            finished = all(x.is_set() for x in self.check_events.values())
+        if finished:
+            self.inspection.release_working_files()
 
-    def thread4(self):
-        self.inspection.do_op48_audio_check()
-        self.update()
+    def cancel(self):
+        """
+        Stop all the work for this item - used when it is being replaced, so it must not touch the table again
+        """
+        self.cancelled = True
+        self.inspection.cancel()
 
-    def thread5(self):
-        self.inspection.do_op59_audio_check()
-        self.update()
+    def is_running(self):
+        return any(x.is_alive() for x in self.threads)
 
     def __iter__(self):
         return self.display_results
@@ -121,6 +119,8 @@ class MediaInspectionDisplayItem:
         Update the UI table with new information
         Called intermittently by the threads
         """
+        if self.cancelled:
+            return
 
         row = self.parent.get_row_by_file(self.filepath)
 
@@ -129,28 +129,7 @@ class MediaInspectionDisplayItem:
             self.filepath,
             self.parent_folder,
             self.filename,
-            self.inspection.get_display('timecode_start'),
-            self.inspection.get_display('content_start_timecode'),
-            self.inspection.get_display('framecount'),
-            self.inspection.get_display('full_duration'),
-            self.inspection.get_display('content_duration'),
-            self.inspection.get_display('slate'),
-            self.inspection.get_display('black_at_tail'),
-            self.inspection.get_display('slate_key_number'),
-            self.inspection.get_display('op48_audio'),
-            self.inspection.get_display('op59_audio'),
-            self.inspection.get_display('audio_peak'),
-            self.inspection.get_display('resolution'),
-            self.inspection.get_display('fps'),
-            self.inspection.get_display('video_bitrate'),
-            self.inspection.get_display('video_codec'),
-            self.inspection.get_display('audio_codec'),
-            self.inspection.get_display('audio_bitrate'),
-            self.inspection.get_display('audio_sample_rate'),
-            self.inspection.get_display('slate_date'),
-            self.inspection.get_display('slate_aspect'),
-            self.inspection.get_display('slate_duration'),
-        ]
+        ] + [self.inspection.get_display(key) for name, key in COLUMN_PROPERTIES]
 
         for col, v in enumerate(self.display_results):
             self.parent.dataview.SetValue(v, row, col)
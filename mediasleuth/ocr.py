@@ -0,0 +1,337 @@
+"""
+Runs the OCR for every inspection, so we aren't paying to start tesseract once per slate
+
+Every pytesseract call starts a new tesseract, which loads its language models from scratch
+With hundreds of slates in a batch, that start up is most of the time spent reading them
+So there are two ways around it, and whichever we can use is picked by get_ocr_engine
+
+TesserocrPool
+    If tesserocr is installed, we keep a pool of its tesseract APIs (one per core), already loaded and ready to go
+    Each read borrows one, so reads run side by side across the cores, without ever starting tesseract again
+    https://github.com/sirfz/tesserocr
+    NOTE : the config is tesseract command line options, of which an API can only take --psm, --oem and -c
+        reads with any other options go to a TesseractBatcher instead, so they read the same whichever engine
+
+TesseractBatcher
+    Otherwise reads wait a moment for others to arrive, and they all go to one tesseract as a list of images
+    tesseract reads a text file of image paths as the pages of one document, and says which page each word is on
+    So the models are loaded once per batch, and each inspection gets back its own page
+    NOTE : this does mean writing the frames out for tesseract, to the workspace (which is in RAM where it can be)
+
+Every engine takes a PIL image, and gives back the same as pytesseract.image_to_data(..., output_type=DICT),
+    for the keys we use
+"""
+
+# builtin
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+# external
+import pytesseract
+
+# internal
+from mediasleuth.workspace import get_workspace
+
+# CONSTANTS
+
+# the keys of the pytesseract dict that the readers use
+DATA_KEYS = ('text', 'left', 'top', 'width', 'height', 'conf')
+
+# how often a waiting read checks in on its cancel token, in seconds
+POLL_INTERVAL = 0.25
+
+
+class TesseractSingle:
+    """
+    One tesseract per read, the way pytesseract works out of the box
+    """
+    def image_to_data(self, image, lang='eng', config='', cancel_token=None):
+        # pytesseract runs tesseract itself so we can't poll it like ffmpeg,
+        # but we can give it whatever is left of our deadline, and it will kill tesseract when that runs out
+        d = pytesseract.image_to_data(image,
+                                      lang=lang,
+                                      config=config,
+                                      output_type=pytesseract.Output.DICT,
+                                      timeout=remaining(cancel_token))
+        return {key: d[key] for key in DATA_KEYS}
+
+
+class TesserocrPool:
+    def __init__(self, workers, config):
+        import tesserocr
+        self.tesserocr = tesserocr
+
+        self.workers = workers
+
+        # for the reads whose options an API can't take, made the first time there is one
+        self.config = config
+        self.fallback = None
+
+        # the apis for each set of settings, made as they're needed up to one per worker
+        self.apis = {}
+        self.made = {}
+        self.lock = threading.Lock()
+
+    def borrow(self, lang, config):
+        key = (lang, config)
+        with self.lock:
+            if key not in self.apis:
+                self.apis[key] = queue.Queue()
+                self.made[key] = 0
+
+            if self.apis[key].empty() and self.made[key] < self.workers:
+                self.made[key] += 1
+                options = tesseract_options(config)
+                api = self.tesserocr.PyTessBaseAPI(lang=lang, **{x: options[x] for x in ('psm', 'oem') if x in options})
+                for name, value in options['variables']:
+                    api.SetVariable(name, value)
+                return api
+
+        return self.apis[key].get()
+
+    def give_back(self, lang, config, api):
+        self.apis[(lang, config)].put(api)
+
+    def get_fallback(self):
+        with self.lock:
+            if self.fallback is None:
+                print("The tesseract config has options tesserocr can't take, reading those with tesseract itself")
+                self.fallback = TesseractBatcher(self.config)
+        return self.fallback
+
+    def image_to_data(self, image, lang='eng', config='', cancel_token=None):
+        if tesseract_options(config)['unsupported']:
+            return self.get_fallback().image_to_data(image, lang=lang, config=config, cancel_token=cancel_token)
+
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+
+        api = self.borrow(lang, config)
+        try:
+            # tesserocr lets go of the GIL while it reads, so the other workers carry on
+            api.SetImage(image)
+            api.Recognize()
+
+            d = {key: [] for key in DATA_KEYS}
+            level = self.tesserocr.RIL.WORD
+            iterator = api.GetIterator()
+            for word in self.tesserocr.iterate_level(iterator, level):
+                text = word.GetUTF8Text(level)
+                box = word.BoundingBox(level)
+                if not text or not box:
+                    continue
+                d['text'].append(text)
+                d['left'].append(box[0])
+                d['top'].append(box[1])
+                d['width'].append(box[2] - box[0])
+                d['height'].append(box[3] - box[1])
+                d['conf'].append(word.Confidence(level))
+            return d
+        finally:
+            api.Clear()
+            self.give_back(lang, config, api)
+
+
+class TesseractBatcher:
+    def __init__(self, config):
+        self.batch_size = config.getint('OCR', 'batch_size', fallback=16)
+        self.batch_wait = config.getfloat('OCR', 'batch_wait_seconds', fallback=0.5)
+        self.batch_timeout = config.getfloat('OCR', 'batch_timeout_seconds', fallback=300)
+
+        self.workspace = get_workspace(config)
+        self.single = TesseractSingle()
+
+        # (image, lang, config, future) waiting to be read
+        self.waiting = queue.Queue()
+        threading.Thread(target=self.run, daemon=True, name='ocr-batcher').start()
+
+    def image_to_data(self, image, lang='eng', config='', cancel_token=None):
+        future = Future()
+        self.waiting.put((image, lang, config, future))
+
+        while True:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            try:
+                return future.result(timeout=POLL_INTERVAL)
+            except TimeoutError:
+                continue
+
+    def run(self):
+        while True:
+            batch = [self.waiting.get()]
+
+            # give the others a moment to catch up
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.waiting.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            # only reads with the same settings can go in together
+            groups = {}
+            for item in batch:
+                groups.setdefault((item[1], item[2]), []).append(item)
+
+            for (lang, config), items in groups.items():
+                self.read_batch(items, lang, config)
+
+    def read_batch(self, items, lang, config):
+        if len(items) == 1:
+            self.read_each(items, lang, config)
+            return
+
+        owner = 'ocr_batch_{}'.format(id(items))
+        list_path = self.workspace.new_artifact(owner, 'ocr_batch', 'txt')
+        try:
+            image_paths = []
+            for n, item in enumerate(items):
+                image_path = self.workspace.new_artifact(owner, 'ocr_batch', 'png', name=str(n))
+                item[0].save(image_path)
+                self.workspace.written(image_path)
+                image_paths.append(image_path)
+
+            with open(list_path, 'w') as f:
+                f.write('\n'.join(image_paths) + '\n')
+            self.workspace.written(list_path)
+
+            print("Reading {} frames in one tesseract".format(len(items)))
+            d = pytesseract.image_to_data(list_path,
+                                          lang=lang,
+                                          config=config,
+                                          output_type=pytesseract.Output.DICT,
+                                          timeout=self.batch_timeout)
+
+            # each image is a page, in the order they were listed
+            pages = [{key: [] for key in DATA_KEYS} for _ in items]
+            for i, page in enumerate(d['page_num']):
+                if 1 <= page <= len(pages):
+                    for key in DATA_KEYS:
+                        pages[page - 1][key].append(d[key][i])
+
+            for item, page in zip(items, pages):
+                item[3].set_result(page)
+
+        except Exception as e:
+            # one bad frame shouldn't cost the rest of the batch their read, so they go one at a time
+            print("Could not read the batch in one go, reading them one at a time \n{}".format(e))
+            self.read_each([x for x in items if not x[3].done()], lang, config)
+
+        finally:
+            self.workspace.release(owner)
+
+    def read_each(self, items, lang, config):
+        for image, _, _, future in items:
+            try:
+                future.set_result(self.single.image_to_data(image, lang=lang, config=config))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def read_regions(engine, pool, image, regions, lang='eng', config='', cancel_token=None):
+    """
+    Reads each (left, top, right, bottom) region of the image side by side on the pool (see get_region_pool),
+        and puts the words back where they were
+    The words come back region by region, in the order the regions were given
+    """
+    futures = [pool.submit(engine.image_to_data,
+                                        image.crop(region),
+                                        lang=lang,
+                                        config=config,
+                                        cancel_token=cancel_token) for region in regions]
+
+    d = {key: [] for key in DATA_KEYS}
+    for region, future in zip(regions, futures):
+        part = future.result()
+        part['left'] = [x + region[0] for x in part['left']]
+        part['top'] = [x + region[1] for x in part['top']]
+        for key in DATA_KEYS:
+            d[key] += part[key]
+    return d
+
+
+def tesseract_options(config):
+    """
+    The options of a tesseract command line that a tesserocr API can take, eg '--psm 6 -c preserve_interword_spaces=1'
+        {'psm': 6, 'variables': [('preserve_interword_spaces', '1')], 'unsupported': []}
+    psm and oem are only there if they were given, unsupported is every other argument
+    """
+    options = {'variables': [], 'unsupported': []}
+
+    args = config.split()
+    i = 0
+    while i < len(args):
+        value = args[i + 1] if i + 1 < len(args) else ''
+        if args[i] == '-c' and '=' in value:
+            options['variables'].append(tuple(value.split('=', 1)))
+        elif args[i] in ('--psm', '--oem') and value.isdigit():
+            options[args[i][2:]] = int(value)
+        else:
+            options['unsupported'].append(args[i])
+            i += 1
+            continue
+        i += 2
+    return options
+
+
+def remaining(cancel_token):
+    if cancel_token is None:
+        return 0
+    cancel_token.raise_if_cancelled()
+    return cancel_token.remaining() or 0
+
+
+def tesserocr_available():
+    try:
+        import tesserocr
+        return True
+    except ImportError:
+        return False
+
+
+def ocr_workers(config):
+    workers = config.getint('OCR', 'workers', fallback=0)
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+# There is just the one engine per running instance, that's the point of it
+# and the one pool for reading regions side by side, sized the same as the engine
+_engine = None
+_engine_lock = threading.Lock()
+_region_pool = None
+_region_pool_lock = threading.Lock()
+
+
+def get_region_pool(config):
+    global _region_pool
+    with _region_pool_lock:
+        if _region_pool is None:
+            _region_pool = ThreadPoolExecutor(max_workers=ocr_workers(config), thread_name_prefix='ocr')
+    return _region_pool
+
+
+def get_ocr_engine(config):
+    """
+    [OCR] engine picks which, auto is a pool if tesserocr is installed and batching otherwise
+    single is how it used to be, one tesseract per read
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            engine = config.get('OCR', 'engine', fallback='auto')
+            workers = ocr_workers(config)
+
+            if engine == 'tesserocr' or (engine == 'auto' and tesserocr_available()):
+                _engine = TesserocrPool(workers, config)
+            elif engine in ('auto', 'batch'):
+                _engine = TesseractBatcher(config)
+            else:
+                _engine = TesseractSingle()
+            print("Reading slates with {}".format(type(_engine).__name__))
+    return _engine
@@ -0,0 +1,184 @@
+"""
+Remembers what tesseract read off a slate, so we don't read the same slate twice
+
+OCR is one of the slowest things we do, and a delivery batch is often dozens of versions with the same slate
+So the results are kept against a perceptual hash (dHash) of the head frame, after it has been filtered for OCR,
+    along with the settings it was read with - a change to the crop, the filter or tesseract means reading again
+Refreshing an inspection, or a re-delivery of the same file, then finds its slate here and skips tesseract entirely
+
+dHash shrinks the frame to a small grey grid and keeps one bit per cell, whether it is brighter than the cell beside it
+    https://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html (2013)
+With near_duplicates on, two frames match if their hashes are at most max_distance bits apart
+NOTE : versions of a spot can have slates that only differ by a few characters (eg the key number)
+    and that doesn't move a single bit of the hash, even on a fine grid - the text is too small a part of the frame
+    so by default a frame has to be exactly the same (by a digest of its pixels) as one we've read before
+    which it is when the same file is read again, or the same file is delivered again
+    only turn on near_duplicates if the slates you get vary in ways that don't matter (eg noise, encoding)
+
+The cache is one json file, and when it is full the least recently used entries go first
+    a hit only moves when the entry was last used, which isn't worth writing the whole file for
+    so that waits for the next put, or for us to exit
+"""
+
+# builtin
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+
+# external
+from PIL import Image
+
+# internal
+import ext.systools as systools
+
+from mediasleuth.platform import config_directory
+
+
+class OcrCache:
+    def __init__(self, config):
+        self.enabled = config.getboolean('OCR Cache', 'enabled', fallback=True)
+        self.max_entries = config.getint('OCR Cache', 'max_entries', fallback=2000)
+        self.hash_size = config.getint('OCR Cache', 'hash_size', fallback=32)
+        self.near_duplicates = config.getboolean('OCR Cache', 'near_duplicates', fallback=False)
+        self.max_distance = config.getint('OCR Cache', 'max_distance', fallback=0)
+
+        self.path = os.path.join(config_directory('ocr_cache'), 'ocr_cache.json')
+        self.lock = threading.Lock()
+
+        # read the once, and written back whenever it changes
+        self.entries = []
+        if self.enabled:
+            systools.mkdir(os.path.dirname(self.path))
+            self.entries = self.read()
+
+        # whether anything has been used since we last wrote it out
+        self.dirty = False
+        atexit.register(self.flush)
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return []
+
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("Could not read the OCR cache, starting afresh \n{}".format(e))
+            return []
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.write()
+
+    def write(self):
+        # write it alongside and swap it in, so nobody ever reads half a file
+        self.dirty = False
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print("Could not write the OCR cache \n{}".format(e))
+
+    def image_hash(self, image):
+        """
+        The perceptual hash of the frame, and the digest of its exact pixels
+        """
+        return {'dhash': dhash(image, self.hash_size), 'digest': hashlib.sha1(image.tobytes()).hexdigest()}
+
+    def get(self, image_hash, settings):
+        """
+        The stored result for the closest matching frame read with the same settings, or None if there isn't one
+        """
+        if not self.enabled:
+            return None
+
+        settings = settings_key(settings)
+        with self.lock:
+            best = None
+            best_distance = None
+            for entry in self.entries:
+                if entry['settings'] != settings:
+                    continue
+                distance = hamming_distance(entry['hash']['dhash'], image_hash['dhash'])
+                if distance > self.max_distance:
+                    continue
+                if not self.near_duplicates and entry['hash']['digest'] != image_hash['digest']:
+                    continue
+                if best is None or distance < best_distance:
+                    best, best_distance = entry, distance
+
+            if best is None:
+                return None
+
+            best['used'] = time.time()
+            self.dirty = True
+
+        print("Found slate in OCR cache, {} bits from what was read before".format(best_distance))
+        return best['data']
+
+    def put(self, image_hash, settings, data):
+        """
+        data has to be something json can hold
+        """
+        if not self.enabled:
+            return
+
+        settings = settings_key(settings)
+        with self.lock:
+            self.entries = [x for x in self.entries if not (x['hash'] == image_hash and x['settings'] == settings)]
+            self.entries.append({'hash': image_hash, 'settings': settings, 'data': data, 'used': time.time()})
+
+            if len(self.entries) > self.max_entries:
+                self.entries.sort(key=lambda x: x['used'])
+                self.entries = self.entries[len(self.entries) - self.max_entries:]
+
+            self.write()
+
+
+def dhash(image, hash_size=32):
+    """
+    A hex string of hash_size * hash_size bits, see the top of this file
+    """
+    grey = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(grey.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+
+    return '{:0{}x}'.format(value, hash_size * hash_size // 4)
+
+
+def hamming_distance(a, b):
+    """
+    How many bits two hashes differ by, hashes of different sizes never match
+    """
+    if len(a) != len(b):
+        return float('inf')
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def settings_key(settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# There is just the one cache per running instance
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_ocr_cache(config):
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = OcrCache(config)
+    return _cache
@@ -29,8 +29,17 @@ def temp_directory(child_folder=''):
     return path
 
 
+def ram_directory():
+    """
+    A RAM backed directory for small short lived files, if the platform has one we can rely on
+    """
+    if sys.platform.startswith('linux') and os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return None
+
+
 def config_directory(child_folder=''):
-    path = "~/.mediasleuth/"
+    path = os.path.expanduser("~/.mediasleuth/")
     if sys.platform.startswith('win32'):
         path = os.path.join(os.environ['APPDATA'], "mediasleuth")
 
@@ -0,0 +1,32 @@
+"""
+Gets the stream info for a file, the quickest way we can
+
+For QuickTime and MP4 files everything we need is in the movie header, which we can read ourselves in a blink
+Anything else (or any header we can't make sense of) goes to ffprobe as usual
+"""
+
+# internal
+import ext.ffmpeg as ffmpeg
+import ext.quicktime as quicktime
+
+# CONSTANTS
+
+QUICKTIME_EXTENSIONS = [
+    'mov',
+    'mp4',
+    'm4v',
+]
+
+
+def get_stream(config, path, cancel_token=None):
+    """
+    Returns an ffmpeg.Stream for the file, which may or may not have come from ffprobe
+    """
+    if config.getboolean('Probe', 'read_quicktime_headers', fallback=True):
+        if path.split('.')[-1].lower() in QUICKTIME_EXTENSIONS:
+            probe_data = quicktime.probe(path)
+            if probe_data:
+                return ffmpeg.Stream(path, probe_data=probe_data)
+            print("Could not read the movie header, asking ffprobe : {}".format(path))
+
+    return ffmpeg.Stream(path, cancel_token=cancel_token)
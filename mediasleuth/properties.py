@@ -114,6 +114,20 @@ class TimeProperty(Property):
         return smart_units.fit_string(self._value, 'seconds')
 
 
+class UncertaintyProperty(Property):
+    """
+    For property values that are a number of frames either way that an estimate could be out by
+    Unlike most properties, 0 is a meaningful value here (it means the estimate is exact)
+    """
+    def display(self):
+        if self._set and not self._null and self._value == 0:
+            return self._display()
+        return Property.display(self)
+
+    def _display(self):
+        return '±{} frames'.format(self._value)
+
+
 class ConditionsProperty(Property):
     """
     For property values which house a table of conditions
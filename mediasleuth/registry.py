@@ -0,0 +1,231 @@
+"""
+This is the declarative map of which check produces which property, and roughly what that check costs
+
+Rather than running every check on every file, the display asks for the properties it actually needs
+The registry works out which checks (and the checks they depend on) have to run to produce them
+That way hiding the SLATE KEY column means we never spin up tesseract, and so on
+
+NOTE : the checks are named here, but the work itself still lives on the MediaInspection
+    each Check just points at the MediaInspection method that does it
+"""
+
+# CONSTANTS
+
+# Rough relative costs, so we can do the cheap work first
+# a probe is near instant, a decode scales with the duration of the media, OCR is slow regardless
+# a demux reads the whole file like a decode does, but doesn't decode it, so it is somewhere in between
+COST_NONE = 0
+COST_PROBE = 1
+COST_DEMUX = 5
+COST_DECODE = 10
+COST_OCR = 20
+
+
+class Check:
+    def __init__(self, name, method, cost, depends_on=(), whole_clip=False, follows=None):
+        self.name = name
+
+        # the name of the MediaInspection method that performs this check
+        self.method = method
+
+        self.cost = cost
+
+        # the names of checks whose properties this check reads
+        # NOTE : decoding checks also want the duration from ffmpeg, to know how long to wait before they're hung
+        self.depends_on = depends_on
+
+        # whole clip checks decode everything, so in fast mode they wait until the quicker checks are done
+        self.whole_clip = whole_clip
+
+        # a follow up check only runs in fast mode, and finishes off the properties of the check it follows
+        self.follows = follows
+
+
+CHECKS = {
+    'ffmpeg':       Check('ffmpeg',       'do_ffmpeg_checks',      COST_PROBE),
+    'fingerprint':  Check('fingerprint',  'do_fingerprint_check',  COST_PROBE),
+    'identical':    Check('identical',    'do_identical_check',    COST_DEMUX, depends_on=('ffmpeg', 'fingerprint')),
+    'packets':      Check('packets',      'do_packet_checks',      COST_DEMUX, depends_on=('identical',)),
+    'checksums':    Check('checksums',    'do_checksum_checks',    COST_DEMUX, depends_on=('identical',)),
+    'pil':          Check('pil',          'do_pil_checks',         COST_DECODE, depends_on=('ffmpeg', 'identical')),
+    'pytesseract':  Check('pytesseract',  'do_pytesseract_checks', COST_OCR, depends_on=('ffmpeg', 'pil')),
+    'burnins':      Check('burnins',      'do_burnins_check',      COST_OCR, depends_on=('ffmpeg', 'pil'),
+                          whole_clip=True),
+    'audio_peak':   Check('audio_peak',   'do_audio_peak_check',   COST_DECODE, depends_on=('ffmpeg', 'identical'),
+                          whole_clip=True),
+    'op48_audio':   Check('op48_audio',   'do_op48_audio_check',   COST_DECODE, depends_on=('ffmpeg', 'pil')),
+    'op59_audio':   Check('op59_audio',   'do_op59_audio_check',   COST_DECODE, depends_on=('ffmpeg', 'pil')),
+    'library':      Check('library',      'do_library_check',      COST_DECODE,
+                          depends_on=('ffmpeg', 'identical', 'pil')),
+    'content_loudness': Check('content_loudness', 'do_content_loudness_check', COST_DECODE,
+                              depends_on=('ffmpeg', 'pil'), whole_clip=True),
+
+    # fast mode follow ups
+    'op48_followup': Check('op48_followup', 'do_op48_followup_check', COST_DECODE,
+                           depends_on=('op48_audio',), whole_clip=True, follows='op48_audio'),
+    'op59_followup': Check('op59_followup', 'do_op59_followup_check', COST_DECODE,
+                           depends_on=('op59_audio',), whole_clip=True, follows='op59_audio'),
+}
+
+# Which check produces each property
+# None means the property is known up front (or not implemented yet), so there is nothing to schedule
+PROPERTY_CHECKS = {
+    # basic properties
+    'path':                   None,
+    'name':                   None,
+    'from_folder':            None,
+    'extension':              None,
+    'timecode_start':         'ffmpeg',
+    'full_duration':          'ffmpeg',
+    'framecount':             'ffmpeg',
+    'fps':                    'ffmpeg',
+    'resolution':             'ffmpeg',
+    'audio_peak':             'audio_peak',
+    'audio_programmes':       'audio_peak',
+    'audio_layout':           'ffmpeg',
+    'video_bitrate':          'ffmpeg',
+    'video_codec':            'ffmpeg',
+    'audio_codec':            'ffmpeg',
+    'audio_bitrate':          'ffmpeg',
+    'audio_sample_rate':      'ffmpeg',
+    'frame_rate_mode':        'packets',
+    'peak_bitrate':           'packets',
+    'max_keyframe_interval':  'packets',
+    'md5':                    'checksums',
+    'sha256':                 'checksums',
+    'xxh64':                  'checksums',
+    'partial_fingerprint':    'fingerprint',
+
+    # estimated properties
+    'content_start_timecode': 'pil',
+    'content_start_frame':    'pil',
+    'content_end_frame':      'pil',
+    'content_duration':       'pil',
+    'content_boundary_uncertainty': 'pil',
+    'black_at_tail':          'pil',
+    'content_loudness':       'content_loudness',
+    'burnins':                'burnins',
+    'library_match':          'library',
+    'slate_agency':           'pytesseract',
+    'slate_aspect':           'pytesseract',
+    'slate_client':           'pytesseract',
+    'slate_date':             'pytesseract',
+    'slate_director':         'pytesseract',
+    'slate_duration':         'pytesseract',
+    'slate_key_number':       'pytesseract',
+    'slate_product':          'pytesseract',
+    'slate_productionco':     'pytesseract',
+    'slate_title':            'pytesseract',
+    'content_aspect_ratio':   None,
+    'blanking_summary':       None,
+    'has_duplicate_frames':   None,
+
+    # criteria properties
+    'slate':                  'pil',
+    'op48_audio':             'op48_audio',
+    'op59_audio':             'op59_audio',
+}
+
+# The data columns of the table, in order, and the property that fills each of them
+# The first few columns (full path, folder, name) come straight from the file path, so they aren't listed here
+COLUMN_PROPERTIES = [
+    ['TIMECODE START',    'timecode_start'],
+    ['PICTURE START',     'content_start_timecode'],
+    ['FRAMES#',           'framecount'],
+    ['FULL DURATION',     'full_duration'],
+    ['PICTURE DURATION',  'content_duration'],
+    ['HAS SLATE',         'slate'],
+    ['BLACK AT TAIL',     'black_at_tail'],
+    ['SLATE KEY',         'slate_key_number'],
+    ['OP48 AUDIO',        'op48_audio'],
+    ['OP59 AUDIO',        'op59_audio'],
+    ['AUDIO PEAK',        'audio_peak'],
+    ['RESOLUTION',        'resolution'],
+    ['FPS',               'fps'],
+    ['BITRATE',           'video_bitrate'],
+    ['VIDEO CODEC',       'video_codec'],
+    ['AUDIO CODEC',       'audio_codec'],
+    ['AUDIO BITRATE',     'audio_bitrate'],
+    ['AUDIO SAMPLE RATE', 'audio_sample_rate'],
+    ['SLATE DATE',        'slate_date'],
+    ['SLATE ASPECT',      'slate_aspect'],
+    ['SLATE DURATION',    'slate_duration'],
+    ['PICTURE ACCURACY',  'content_boundary_uncertainty'],
+    ['FRAME RATE MODE',   'frame_rate_mode'],
+    ['PEAK BITRATE',      'peak_bitrate'],
+    ['MAX GOP',           'max_keyframe_interval'],
+    ['AUDIO LAYOUT',      'audio_layout'],
+    ['AUDIO PROGRAMMES',  'audio_programmes'],
+    ['CONTENT LOUDNESS',  'content_loudness'],
+    ['BURN INS',          'burnins'],
+    ['MD5',               'md5'],
+    ['SHA-256',           'sha256'],
+    ['XXH64',             'xxh64'],
+    ['FINGERPRINT',       'partial_fingerprint'],
+    ['LIBRARY MATCH',     'library_match'],
+]
+
+
+def column_property(column_name):
+    """
+    Returns the property key shown in a given column, or None if the column isn't backed by a check
+    """
+    for name, key in COLUMN_PROPERTIES:
+        if name == column_name:
+            return key
+    return None
+
+
+def properties_for_check(check_name):
+    """
+    Returns all the property keys a check is responsible for setting
+    """
+    if CHECKS[check_name].follows:
+        return properties_for_check(CHECKS[check_name].follows)
+    return [key for key, check in PROPERTY_CHECKS.items() if check == check_name]
+
+
+def checks_for_properties(property_keys, fast_mode=False):
+    """
+    Returns the names of every check needed to produce the given properties, including their dependencies
+    In fast mode, this includes the follow ups for those checks
+
+    They are ordered so that a check always comes after the checks it depends on,
+    and otherwise the cheapest checks come first
+    """
+    needed = set()
+
+    def add_check(name):
+        if name in needed:
+            return
+        needed.add(name)
+        for dependency in CHECKS[name].depends_on:
+            add_check(dependency)
+
+    for key in property_keys:
+        check_name = PROPERTY_CHECKS.get(key)
+        if check_name:
+            add_check(check_name)
+
+    if fast_mode:
+        for name, check in CHECKS.items():
+            if check.follows in needed:
+                needed.add(name)
+
+    ordered = []
+    remaining = sorted(needed, key=lambda x: (CHECKS[x].cost, x))
+    while remaining:
+        for name in remaining:
+            if all(d in ordered for d in CHECKS[name].depends_on):
+                ordered.append(name)
+                remaining.remove(name)
+                break
+
+    return ordered
+
+
+def estimated_cost(property_keys, fast_mode=False):
+    """
+    Returns the summed relative cost of producing the given properties
+    """
+    return sum(CHECKS[x].cost for x in checks_for_properties(property_keys, fast_mode=fast_mode))
@@ -0,0 +1,198 @@
+"""
+Splits long media into time segments, so the decoding checks can run over them in parallel
+
+One ffmpeg process decodes about as fast as one process can, so a 90 minute master takes near real time to get through
+Instead we cut the file into segments that start on keyframes, and run one ffmpeg per segment at the same time
+Starting each segment on a keyframe means the decoder doesn't waste time on frames before the cut,
+    and the frames in each segment line up exactly with where the last one stopped
+
+The checks then stitch the results back together - which is easy for per frame data and peaks,
+    but loudness needs the gating blocks from each segment to be gated together (see audio.py)
+
+All the segment work shares one pool of threads, so several long files at once don't swamp the machine
+"""
+
+# builtin
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+# internal
+import ext.ffmpeg as ffmpeg
+
+from mediasleuth.cancellation import CheckCancelled
+
+# CONSTANTS
+
+# how often a map waiting on its segments checks in on its cancel token, in seconds
+POLL_INTERVAL = 0.25
+
+
+class Segment:
+    def __init__(self, index, start, end, first_frame, frame_count, threads=0):
+        self.index = index
+
+        # in seconds from the start of the file
+        self.start = start
+        self.end = end
+
+        self.first_frame = first_frame
+        self.frame_count = frame_count
+
+        # decoder threads for the process working on this segment, 0 lets ffmpeg decide
+        self.threads = threads
+
+    def duration(self):
+        return self.end - self.start
+
+    def input_args(self, preroll=0):
+        """
+        The ffmpeg input options to decode just this segment
+        preroll starts decoding a little early, for measurements that need some history (eg loudness)
+        """
+        preroll = min(preroll, self.start)
+
+        args = ''
+        if self.threads:
+            args += '-threads {} '.format(self.threads)
+        return args + '-ss {:.6f} -t {:.6f}'.format(self.start - preroll, self.duration() + preroll)
+
+
+class SegmentExecutor:
+    """
+    Holds the segments for one file, and runs work over them in parallel
+    """
+    def __init__(self, segments, workers):
+        self.segments = segments
+        self.workers = workers
+
+    def __len__(self):
+        return len(self.segments)
+
+    def map(self, fn, items=None, cancel_token=None):
+        """
+        Run fn on each item (the segments by default) in the shared pool, returning the results in order
+        If any of them fall over, or the cancel token trips, the ones that haven't started yet are dropped and we raise
+
+        IMPORTANT : called from work that is already running in the pool (eg a segment that refines its own frames),
+            the items are run right there, one after another
+            waiting on the pool from inside it can take up every thread with work waiting on work that can't start
+        """
+        if items is None:
+            items = self.segments
+
+        if in_pool():
+            results = []
+            for x in items:
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                results.append(fn(x))
+            return results
+
+        futures = [get_pool(self.workers).submit(run_in_pool, fn, x) for x in items]
+        try:
+            pending = futures
+            while pending:
+                if cancel_token is not None and cancel_token.is_cancelled():
+                    raise CheckCancelled()
+                done, pending = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_EXCEPTION)
+                for f in done:
+                    if f.exception() is not None:
+                        raise f.exception()
+            return [f.result() for f in futures]
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+
+
+def plan_segments(config, file, duration, fps, framecount, cancel_token=None, known_keyframes=None):
+    """
+    Returns a SegmentExecutor for the file, or None if it isn't long enough to be worth splitting
+
+    We aim for one segment per worker, but never shorter than min_segment_seconds
+    Each cut is moved forward to the next keyframe, and if there isn't one close by we don't cut there
+    If we already know where all the keyframes are (eg from a packet index) we use those, rather than go looking
+    """
+    if not config.getboolean('Segments', 'enabled', fallback=True):
+        return None
+
+    if not duration or not fps or not framecount:
+        return None
+
+    workers = worker_count(config)
+    min_seconds = config.getfloat('Segments', 'min_segment_seconds', fallback=120)
+    search_seconds = config.getfloat('Segments', 'keyframe_search_seconds', fallback=10)
+
+    count = min(workers, int(duration // min_seconds))
+    if count < 2:
+        return None
+
+    cut_times = [duration * i / count for i in range(1, count)]
+    if known_keyframes is not None:
+        keyframes = []
+        for t in cut_times:
+            after = [k for k in known_keyframes if t <= k <= t + search_seconds]
+            keyframes.append(after[0] if after else None)
+    else:
+        keyframes = ffmpeg.keyframes_after(file, cut_times, search_seconds=search_seconds, cancel_token=cancel_token)
+
+    # cut on the frame boundaries, so the frame numbers of each segment follow on exactly
+    # but seek to the keyframe time itself, rounding could land us just before it and cost us a whole GOP
+    cuts = {}
+    for k in keyframes:
+        if k is not None and 0 < int(round(k * fps)) < framecount:
+            cuts[int(round(k * fps))] = k
+    if not cuts:
+        print("No keyframes to cut on, decoding in one go : {}".format(file))
+        return None
+
+    # split the cores between the processes, so they don't fight over them
+    threads = max(1, (os.cpu_count() or 1) // (len(cuts) + 1))
+
+    boundaries = [(0, 0.0)] + sorted(cuts.items()) + [(framecount, max(duration, framecount / fps))]
+
+    segments = []
+    for i in range(len(boundaries) - 1):
+        first_frame, start = boundaries[i]
+        next_frame, end = boundaries[i + 1]
+        segments.append(Segment(i, start, end, first_frame, next_frame - first_frame, threads=threads))
+
+    print("Decoding in {} segments : {}".format(len(segments), file))
+    return SegmentExecutor(segments, workers)
+
+
+def worker_count(config):
+    workers = config.getint('Segments', 'workers', fallback=0)
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def run_in_pool(fn, x):
+    _pool_thread.active = True
+    try:
+        return fn(x)
+    finally:
+        _pool_thread.active = False
+
+
+def in_pool():
+    return getattr(_pool_thread, 'active', False)
+
+
+# There is just the one pool per running instance, shared by every file
+# it is sized by whoever gets to it first, the config doesn't change while we're running
+_pool = None
+_pool_lock = threading.Lock()
+
+# marks the threads that are running pool work, see SegmentExecutor.map
+_pool_thread = threading.local()
+
+
+def get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='segment')
+    return _pool
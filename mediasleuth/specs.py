@@ -0,0 +1,341 @@
+"""
+Compliance specs (eg OP48, OP59) as config rather than code
+
+Each spec is a [Spec NAME] section of the config, and each option in it adds a rule, eg
+    [Spec OP48]
+    max_peak_db=-9
+    head_silence_frames=12
+    tail_silence_frames=12
+    silence_db=-50
+
+The rules never look at the media, only at the measurements they're given
+    a MediaInspection gives them live measurements, which decode whatever hasn't been measured yet
+    StoredMeasurements gives them what is in the measurement store, and nothing else
+So changing a spec, or adding one for another broadcaster, can re-score every file we've inspected before
+    without reading any media at all, see rescore
+    python -m mediasleuth.specs [--spec NAME ...] [path ...]
+    re-scores the paths given, or every file in the library index (see library.py), and prints the results
+
+A measurements object has to answer:
+    loud_tracks(ceiling) - [(track index, seconds it first went over, or None if we don't know)]
+    programme_loudness() - [(track indexes, integrated loudness)] for each programme
+    content_window() - (start, end) of the content in seconds, or None if we don't know
+    fps()
+    peak_between(seconds_from, seconds_to) - the loudest any track gets in the window
+    whole_clip_measured() - whether the whole clip rules can be answered without decoding anything more
+Anything it can't answer raises NotMeasured
+"""
+
+# builtin
+import os
+import argparse
+import configparser
+
+# internal
+from mediasleuth.checks.audio import programme_name, load_audio_report
+from mediasleuth.measurements import get_measurement_store
+from mediasleuth.library import get_library_index
+
+# CONSTANTS
+
+# The specs we ship with, a [Spec NAME] section of the same name in the config replaces one of these outright
+# NOTE : the config in app data is only copied over the once, so these keep older configs working
+DEFAULT_SPECS = {
+    'OP48': {
+        'max_peak_db':          '-9',
+        'head_silence_frames':  '12',
+        'tail_silence_frames':  '12',
+        'silence_db':           '-50',
+    },
+    'OP59': {
+        'loudness_target':      '-24',
+        'loudness_tolerance':   '1',
+        'head_silence_frames':  '12',
+        'tail_silence_frames':  '12',
+        'silence_db':           '-50',
+    },
+}
+
+
+class NotMeasured(Exception):
+    """
+    Raised when a rule needs a measurement we don't have
+    """
+    pass
+
+
+class Rule:
+    # whole clip rules need all of the audio measured, so in fast mode they are left to the follow up
+    whole_clip = False
+
+    def issues(self, measurements):
+        raise NotImplementedError
+
+
+class PeakRule(Rule):
+    whole_clip = True
+
+    def __init__(self, max_peak):
+        self.max_peak = max_peak
+
+    def issues(self, measurements):
+        loud_tracks = measurements.loud_tracks(self.max_peak)
+        if not loud_tracks:
+            return []
+
+        # if we know where it went over (ie it was found failing fast), we say so
+        track, seconds = loud_tracks[0]
+        at = '' if seconds is None else ' at {:.2f}s'.format(seconds)
+
+        if measurements.track_count() == 1:
+            return ["audio peaks above {:g} dB{}".format(self.max_peak, at)]
+        return ["{} peaks above {:g} dB{}".format(programme_name([x[0] for x in loud_tracks]), self.max_peak, at)]
+
+
+class LoudnessRule(Rule):
+    whole_clip = True
+
+    def __init__(self, target, tolerance):
+        self.target = target
+        self.tolerance = tolerance
+
+    def issues(self, measurements):
+        loudness = measurements.programme_loudness()
+        out_of_bounds = [tracks for tracks, value in loudness
+                         if value is None or not self.target - self.tolerance < value < self.target + self.tolerance]
+        if not out_of_bounds:
+            return []
+
+        bounds = '{:g} ±{:g} LKFS'.format(self.target, self.tolerance)
+        if len(loudness) == 1:
+            return ["loudness outside {} bounds".format(bounds)]
+        return ["{} loudness outside {} bounds".format(', '.join([programme_name(x) for x in out_of_bounds]), bounds)]
+
+
+class SilenceRule(Rule):
+    """
+    Some number of frames of silence at the head or tail of the content
+    """
+    def __init__(self, end, frames, silence_db):
+        self.end = end
+        self.frames = frames
+        self.silence_db = silence_db
+
+    def issues(self, measurements):
+        content = measurements.content_window()
+        fps = measurements.fps()
+        if content is None or not fps:
+            raise NotMeasured("content window")
+
+        if self.end == 'head':
+            seconds_from = content[0]
+            seconds_to = content[0] + self.frames / fps
+        else:
+            # TODO get a lot a false negatives here - investigate further
+            #  the strictly correct math is a whole frame earlier, this is how it has always been measured
+            seconds_from = content[1] - (self.frames - 1) / fps
+            seconds_to = content[1]
+
+        if measurements.peak_between(seconds_from, seconds_to) >= self.silence_db:
+            return ["{} frames not silent".format('first' if self.end == 'head' else 'last')]
+        return []
+
+
+# Which option of a spec adds which rule, given the whole section so rules can have more than one setting
+RULE_OPTIONS = {
+    'max_peak_db':          lambda x: PeakRule(x.getfloat('max_peak_db')),
+    'loudness_target':      lambda x: LoudnessRule(x.getfloat('loudness_target'),
+                                                   x.getfloat('loudness_tolerance', fallback=1)),
+    'head_silence_frames':  lambda x: SilenceRule('head',
+                                                  x.getint('head_silence_frames'),
+                                                  x.getfloat('silence_db', fallback=-50)),
+    'tail_silence_frames':  lambda x: SilenceRule('tail',
+                                                  x.getint('tail_silence_frames'),
+                                                  x.getfloat('silence_db', fallback=-50)),
+}
+
+
+class Spec:
+    def __init__(self, name, rules):
+        self.name = name
+        self.rules = rules
+
+    def issues(self, measurements, whole_clip=None, fail_fast=False, failed=False):
+        """
+        The issues found by every rule, or just the whole clip (or not whole clip) ones
+
+        When failing fast, the quick rules go first, and once anything has failed (or had already, see failed)
+            the whole clip rules are only scored if they're already measured - a file that's failed won't pass
+            by decoding the rest of it, so we don't
+        The issues still come back in the order of the rules
+        """
+        rules = [x for x in self.rules if whole_clip is None or x.whole_clip == whole_clip]
+        if fail_fast:
+            rules.sort(key=lambda x: x.whole_clip)
+
+        found = {}
+        for rule in rules:
+            if fail_fast and rule.whole_clip and (failed or any(found.values())) \
+                    and not measurements.whole_clip_measured():
+                continue
+            found[rule] = rule.issues(measurements)
+
+        return [x for rule in self.rules for x in found.get(rule, [])]
+
+    def result(self, measurements):
+        return compliance_result(self.name, self.issues(measurements))
+
+
+def load_specs(config):
+    """
+    Every spec, by name - the ones we ship with, plus (or replaced by) any in the config
+    """
+    sections = configparser.ConfigParser()
+    sections.read_dict({'Spec {}'.format(name): options for name, options in DEFAULT_SPECS.items()})
+    for section in config.sections():
+        if section.startswith('Spec '):
+            sections.remove_section(section)
+            sections.read_dict({section: dict(config[section])})
+
+    specs = {}
+    for section in sections.sections():
+        options = sections[section]
+        rules = [RULE_OPTIONS[x](options) for x in options if x in RULE_OPTIONS]
+        specs[section[len('Spec '):]] = Spec(section[len('Spec '):], rules)
+    return specs
+
+
+def compliance_result(standard, issues, pending=False):
+    """
+    Formats the result of a compliance check for display
+    pending means there are still whole clip measurements to come, so a pass isn't final yet
+    """
+    result = standard
+    if issues:
+        result = "Not {} - {}".format(standard, ', '.join(issues))
+
+    if pending:
+        result += " (whole clip pending)"
+
+    return result
+
+
+class StoredMeasurements:
+    """
+    The measurements of a file from the measurement store, without ever touching the file itself
+    """
+    def __init__(self, config, path):
+        self.config = config
+        store = get_measurement_store(config)
+
+        self.report = load_audio_report(config, store, path)
+        self.content = store.get(path, 'content') or {}
+
+    def audio_report(self):
+        if self.report is None:
+            raise NotMeasured("audio")
+        return self.report
+
+    def track_count(self):
+        return len(self.audio_report().tracks)
+
+    def whole_clip_measured(self):
+        return self.report is not None
+
+    def loud_tracks(self, ceiling):
+        return [(x.index, None) for x in self.audio_report().tracks if x.peak is not None and x.peak >= ceiling]
+
+    def programme_loudness(self):
+        report = self.audio_report()
+        if self.content_window() is not None and self.config.getboolean('Audio', 'content_only_loudness',
+                                                                        fallback=True):
+            loudness = [x[0] for x in report.window_loudness(*self.content_window())]
+        else:
+            loudness = [x.integrated_loudness for x in report.programmes]
+        return [(x.tracks, value) for x, value in zip(report.programmes, loudness)]
+
+    def content_window(self):
+        start_frame = self.content.get('content_start_frame')
+        end_frame = self.content.get('content_end_frame')
+        if start_frame is None or end_frame is None or not self.fps():
+            return None
+        return start_frame / self.fps(), end_frame / self.fps()
+
+    def fps(self):
+        return self.content.get('fps')
+
+    def peak_between(self, seconds_from, seconds_to):
+        peak = self.audio_report().peak_between(seconds_from, seconds_to)
+        if peak is None:
+            raise NotMeasured("audio between {} and {}".format(seconds_from, seconds_to))
+        return peak
+
+
+def rescore(config, paths, spec_names=None):
+    """
+    Scores every file against the specs (all of them by default), from their stored measurements alone
+    Returns {path: {spec name: result}}
+        where the result is None if the file hasn't had everything measured that the spec needs
+    """
+    specs = load_specs(config)
+    if spec_names is not None:
+        specs = {x: specs[x] for x in spec_names}
+
+    results = {}
+    for path in paths:
+        measurements = StoredMeasurements(config, path)
+        results[path] = {}
+        for name, spec in specs.items():
+            try:
+                results[path][name] = spec.result(measurements)
+            except NotMeasured as e:
+                print("Can't score {} against {}, not measured : {}".format(path, name, e))
+                results[path][name] = None
+    return results
+
+
+def library_paths(config):
+    """
+    Every file in the library index that is still there, ie every file we've inspected
+    """
+    index = get_library_index(config)
+    with index.lock:
+        paths = sorted(index.entries)
+
+    missing = [x for x in paths if not os.path.isfile(x)]
+    for path in missing:
+        print("No longer there, not re-scoring : {}".format(path))
+    return [x for x in paths if x not in missing]
+
+
+def main(args=None):
+    from mediasleuth.config import MediaSleuthConfig
+
+    parser = argparse.ArgumentParser(prog='python -m mediasleuth.specs',
+                                     description="Re-score inspected files against the specs, "
+                                                 "from their stored measurements alone")
+    parser.add_argument('paths', nargs='*', help="the files to re-score, every file in the library by default")
+    parser.add_argument('--spec', action='append', dest='specs', metavar='NAME',
+                        help="a spec to score against, every spec by default (can be given more than once)")
+    options = parser.parse_args(args)
+
+    config = MediaSleuthConfig().config
+    specs = load_specs(config)
+    for name in options.specs or []:
+        if name not in specs:
+            parser.error("No such spec : {} (there is {})".format(name, ', '.join(sorted(specs))))
+
+    paths = [os.path.abspath(x) for x in options.paths] or library_paths(config)
+    if not paths:
+        print("Nothing to re-score, the library is empty")
+        return
+
+    results = rescore(config, paths, spec_names=options.specs)
+    for path, scores in results.items():
+        print(path)
+        for name, result in scores.items():
+            print("    {} : {}".format(name, result if result is not None else "not measured"))
+
+
+if __name__ == '__main__':
+    main()
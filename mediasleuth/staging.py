@@ -0,0 +1,289 @@
+"""
+Reads media that lives on network storage (SMB / NFS...) the once, rather than once for every check
+
+Every ffprobe and ffmpeg we run opens the file and reads it again, and on a share that is the whole file over the wire
+    eg the packet index, the pixel strip, the audio and the slate are each a full read of a multi GB master
+So a file on a network mount is staged - read the once, in big sequential reads, to a local copy
+    every decode after that reads the local copy, and anything else that wants the bytes (eg a checksum)
+    can be handed them as they go by (see consumers), rather than reading the file again for itself
+Once every inspection using the copy is done with it, it's deleted
+
+posix_fadvise lets the kernel know how we read:
+    SEQUENTIAL on the share, so it reads further ahead
+    DONTNEED on each part of the share once we've read it, we never read it again, so there's no use caching it
+NOTE : fadvise is unix only, elsewhere we just don't give the advice
+
+Files on local disks aren't staged (unless [Staging] enabled=always), reading them again is cheap and a copy isn't
+"""
+
+# builtin
+import os
+import re
+import sys
+import time
+import shutil
+import threading
+import subprocess
+
+# internal
+import ext.systools as systools
+
+from mediasleuth.platform import temp_directory
+from mediasleuth.workspace import pid_is_running
+from mediasleuth.cancellation import CheckCancelled
+
+# CONSTANTS
+
+# how long we trust what we know of the mounts, in seconds
+MOUNTS_TTL = 60
+
+# GetDriveTypeW says this for mapped network drives
+DRIVE_REMOTE = 4
+
+
+class StagedCopy:
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+
+        # the inspections using it
+        self.owners = set()
+
+        self.ready = threading.Event()
+        # if it couldn't be staged, everyone reads the source instead
+        self.failed = False
+
+
+class Stager:
+    def __init__(self, config):
+        self.mode = config.get('Staging', 'enabled', fallback='auto').lower()
+        self.read_size = int(config.getfloat('Staging', 'read_size_mb', fallback=8) * 1000000)
+        self.min_free = config.getfloat('Staging', 'min_free_gb', fallback=2) * 1000000000
+        self.filesystems = [x.strip() for x in config.get('Staging',
+                                                          'network_filesystems',
+                                                          fallback='nfs, nfs4, cifs, smb3, smbfs, afpfs').split(',')]
+
+        self.root = config.get('Staging', 'directory', fallback='') or temp_directory('staging')
+        systools.mkdir(self.root)
+        self.clear_orphans()
+
+        self.copies = {}
+        self.staged_count = 0
+        self.lock = threading.Lock()
+
+        self._mounts = None
+        self._mounts_read = 0
+
+    def clear_orphans(self):
+        """
+        Copies are named for the instance that made them, so anything left by an instance that isn't running can go
+        """
+        for name in os.listdir(self.root):
+            pid = name.split('-')[0]
+            if pid.isdigit() and (int(pid) == os.getpid() or pid_is_running(int(pid))):
+                continue
+            print("Removing orphaned staged copy : {}".format(name))
+            try:
+                systools.rm(os.path.join(self.root, name))
+            except OSError as e:
+                print("Could not remove orphaned staged copy \n{}".format(e))
+
+    def wants(self, path):
+        if self.mode in ('false', 'never', 'off'):
+            return False
+        if self.mode in ('true', 'always'):
+            return True
+        return self.is_network_path(path)
+
+    def stage(self, path, owner, consumers=(), cancel_token=None):
+        """
+        The path to read the media from - a local copy if it's worth making one, otherwise the path itself
+        The first owner to ask does the reading, and anyone else asking meanwhile waits for it
+        consumers are anything with an update(bytes) method (eg hashlib), and are given every block as it's read
+            NOTE : they only get the bytes if this call is the one that reads the file, see staged
+        """
+        if not self.wants(path):
+            return path
+
+        with self.lock:
+            copy = self.copies.get(path)
+            reading = copy is None
+            if reading:
+                # numbered, as files in different folders can have the same name
+                self.staged_count += 1
+                name = '{}-{}-{}'.format(os.getpid(), self.staged_count, os.path.basename(path))
+                copy = self.copies[path] = StagedCopy(path, os.path.join(self.root, name))
+            copy.owners.add(owner)
+
+        if reading:
+            try:
+                self.read(copy, consumers, cancel_token)
+            except Exception:
+                copy.failed = True
+                copy.ready.set()
+                with self.lock:
+                    self.copies.pop(path, None)
+                remove(copy.path)
+                raise
+            copy.ready.set()
+
+        while not copy.ready.wait(0.25):
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+
+        return copy.source if copy.failed else copy.path
+
+    def staged(self, path):
+        """
+        Whether the file has already been read to a local copy
+        """
+        with self.lock:
+            copy = self.copies.get(path)
+        return copy is not None and copy.ready.is_set() and not copy.failed
+
+    def read(self, copy, consumers, cancel_token):
+        size = os.path.getsize(copy.source)
+        free = shutil.disk_usage(self.root).free
+        if free - size < self.min_free:
+            print("Not enough room to stage {}, reading it where it is".format(copy.source))
+            copy.failed = True
+            return
+
+        print("Staging {} to {}".format(copy.source, copy.path))
+        started = time.monotonic()
+
+        # the one buffer for every read, so a big file doesn't churn through memory
+        buffer = bytearray(self.read_size)
+        view = memoryview(buffer)
+
+        with open(copy.source, 'rb', buffering=0) as source, open(copy.path, 'wb') as destination:
+            advise(source, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+            offset = 0
+            while True:
+                if cancel_token is not None and cancel_token.is_cancelled():
+                    raise CheckCancelled()
+
+                count = source.readinto(buffer)
+                if not count:
+                    break
+
+                block = view[:count]
+                destination.write(block)
+                for consumer in consumers:
+                    consumer.update(block)
+
+                advise(source, offset, count, 'POSIX_FADV_DONTNEED')
+                offset += count
+
+        seconds = max(time.monotonic() - started, 0.001)
+        print("Staged {:.1f} MB in {:.1f}s ({:.1f} MB/s) : {}".format(offset / 1000000,
+                                                                     seconds,
+                                                                     offset / 1000000 / seconds,
+                                                                     copy.source))
+
+    def release(self, owner):
+        """
+        The owner is done with whatever it staged, and any copy nobody else is using is deleted
+        """
+        finished = []
+        with self.lock:
+            for path, copy in list(self.copies.items()):
+                copy.owners.discard(owner)
+                if not copy.owners and copy.ready.is_set():
+                    finished.append(self.copies.pop(path))
+
+        for copy in finished:
+            remove(copy.path)
+
+    def is_network_path(self, path):
+        if sys.platform.startswith('win32'):
+            return windows_network_path(path)
+
+        path = os.path.realpath(path)
+        best = None
+        for mount_point, filesystem in self.mounts():
+            if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                if best is None or len(mount_point) > len(best[0]):
+                    best = (mount_point, filesystem)
+
+        return best is not None and (best[1] in self.filesystems or best[1].startswith('fuse.sshfs'))
+
+    def mounts(self):
+        """
+        (mount point, filesystem type) of every mount, from /proc/mounts on linux, and mount everywhere else
+        """
+        with self.lock:
+            if self._mounts is not None and time.monotonic() - self._mounts_read < MOUNTS_TTL:
+                return self._mounts
+
+        mounts = []
+        try:
+            if os.path.isfile('/proc/mounts'):
+                with open('/proc/mounts', 'r') as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) >= 3:
+                            # spaces in mount points are escaped as \040
+                            mounts.append((fields[1].replace('\\040', ' '), fields[2]))
+            else:
+                # eg //user@server/share on /Volumes/share (smbfs, nodev, nosuid, mounted by user)
+                out = subprocess.run(['mount'], capture_output=True, text=True).stdout
+                for line in out.splitlines():
+                    match = re.match(r'^.+ on (?P<point>.+) \((?P<type>[^,)]+)', line)
+                    if match:
+                        mounts.append((match.group('point'), match.group('type')))
+        except (OSError, subprocess.SubprocessError) as e:
+            print("Could not read the mounts, not staging anything \n{}".format(e))
+
+        with self.lock:
+            self._mounts = mounts
+            self._mounts_read = time.monotonic()
+        return mounts
+
+
+def advise(f, offset, length, advice):
+    """
+    posix_fadvise, where we have it
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(f.fileno(), offset, length, getattr(os, advice))
+    except OSError:
+        pass
+
+
+def windows_network_path(path):
+    """
+    UNC paths (\\\\server\\share), or a drive letter mapped to a share
+    """
+    path = os.path.abspath(path)
+    if path.startswith('\\\\'):
+        return True
+
+    import ctypes
+    drive = os.path.splitdrive(path)[0]
+    return bool(drive) and ctypes.windll.kernel32.GetDriveTypeW(drive + '\\') == DRIVE_REMOTE
+
+
+def remove(path):
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        # on windows a copy that's still open can't be deleted, the orphan clear up gets it next time
+        print("Could not remove staged copy \n{}".format(e))
+
+
+# There is just the one stager per running instance, so inspections of the same file share the copy
+_stager = None
+_stager_lock = threading.Lock()
+
+
+def get_stager(config):
+    global _stager
+    with _stager_lock:
+        if _stager is None:
+            _stager = Stager(config)
+    return _stager
@@ -0,0 +1,262 @@
+"""
+The workspace manages all of the temp working files we make (pixel strips, head frames, tables for printing)
+
+Every file we make is an artifact with an owner (usually the uuid of the MediaInspection that wanted it)
+While the owner is working, its artifacts are pinned and won't be touched
+Once the owner is finished, its artifacts are released, and deleted (or kept around for debugging, if configured)
+
+Anything kept around is evicted least recently used first, so the whole workspace stays under a size cap
+This is so that a station that has been running for weeks has the same temp footprint as one that just started
+
+Where there is room for it, we prefer a RAM backed directory (eg /dev/shm), since these files are small and short lived
+Each running instance works in its own session folder,
+    so on startup anything not belonging to a live session is an orphan
+"""
+
+# builtin
+import os
+import time
+import shutil
+import threading
+import subprocess
+from collections import OrderedDict
+
+# internal
+import ext.systools as systools
+
+from mediasleuth.platform import temp_directory, ram_directory
+
+# CONSTANTS
+
+# folders in the temp directory that aren't ours, and clear up their own orphans
+# staging holds the copies of every running instance, see Stager.clear_orphans
+NOT_OURS = ('staging',)
+
+
+class Artifact:
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self.size = 0
+        self.last_used = time.time()
+
+        # pinned artifacts are still needed by their owner, and are never evicted
+        self.pinned = True
+
+
+class Workspace:
+    def __init__(self, config):
+        self.max_size = config.getfloat('Workspace', 'max_size_mb', fallback=512) * 1000000
+        self.keep_finished = config.getboolean('Workspace', 'keep_finished_artifacts', fallback=False)
+        prefer_ram = config.getboolean('Workspace', 'prefer_ram', fallback=True)
+
+        self.root = self.choose_root(prefer_ram)
+        self.session_path = os.path.join(self.root, 'session-{}'.format(os.getpid()))
+
+        # ordered by last use, the least recently used is first
+        self.artifacts = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.clear_orphans()
+        systools.mkdir(self.session_path)
+
+        print("Using workspace : {}".format(self.session_path))
+
+    def choose_root(self, prefer_ram):
+        """
+        Use the RAM backed directory if we have one, and it has room for the whole size cap
+        Otherwise fall back to the regular temp directory
+        """
+        ram_path = ram_directory()
+        if prefer_ram and ram_path and os.path.isdir(ram_path):
+            if shutil.disk_usage(ram_path).free > self.max_size:
+                return os.path.join(ram_path, 'mediasleuth')
+        return temp_directory()
+
+    def clear_orphans(self):
+        """
+        Delete anything in our workspace roots that isn't the working folder of a running instance
+        We check both roots, in case the last run used the other one
+        NOTE : except what other parts keep alongside us (see NOT_OURS), which is theirs to clear up
+        """
+        roots = [temp_directory()]
+        if ram_directory():
+            roots.append(os.path.join(ram_directory(), 'mediasleuth'))
+
+        for root in roots:
+            if not os.path.isdir(root):
+                continue
+
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+
+                if root == temp_directory() and name in NOT_OURS:
+                    continue
+
+                if name.startswith('session-') and name != os.path.basename(self.session_path):
+                    pid = name.split('-')[-1]
+                    if pid.isdigit() and pid_is_running(int(pid)):
+                        continue
+
+                elif path == self.session_path:
+                    continue
+
+                print("Removing orphaned working files : {}".format(path))
+                try:
+                    systools.rm(path)
+                except OSError as e:
+                    print("Could not remove orphaned working files \n{}".format(e))
+
+    #
+    # Artifacts
+    #
+
+    def new_artifact(self, owner, kind, extension, name=''):
+        """
+        Returns the path for a new working file, pinned to the owner until they release it
+        kind is just the folder it goes in, to keep things legible
+        name tells apart multiple artifacts of the same kind for the same owner
+        """
+        folder = os.path.join(self.session_path, kind)
+        systools.mkdir(folder)
+
+        filename = str(owner)
+        if name:
+            filename += '_{}'.format(name)
+
+        path = os.path.join(folder, '{}.{}'.format(filename, extension))
+
+        # an owner can ask for the same artifact again, so don't overwrite its details
+        with self.lock:
+            if path not in self.artifacts:
+                self.artifacts[path] = Artifact(path, owner)
+            self.artifacts.move_to_end(path)
+
+        return path
+
+    def written(self, path):
+        """
+        Let the workspace know that an artifact has been written, so we can account for its size
+        """
+        with self.lock:
+            if path not in self.artifacts:
+                return
+
+            artifact = self.artifacts[path]
+            if os.path.isfile(path):
+                artifact.size = os.path.getsize(path)
+            artifact.last_used = time.time()
+            self.artifacts.move_to_end(path)
+
+        self.evict()
+
+    def touch(self, path):
+        """
+        Mark an artifact as recently used
+        """
+        with self.lock:
+            if path in self.artifacts:
+                self.artifacts[path].last_used = time.time()
+                self.artifacts.move_to_end(path)
+
+    def retain(self, path):
+        """
+        Unpin an artifact but keep it on disk, eg something handed off to the browser
+        It will hang around until it gets evicted to make room
+        """
+        with self.lock:
+            if path in self.artifacts:
+                self.artifacts[path].pinned = False
+
+        self.evict()
+
+    def release(self, owner):
+        """
+        The owner is finished with all of its artifacts
+        """
+        with self.lock:
+            owned = [x for x in self.artifacts.values() if x.owner == owner]
+
+            for artifact in owned:
+                artifact.pinned = False
+                if not self.keep_finished:
+                    self._delete(artifact)
+
+        self.evict()
+
+    def total_size(self):
+        return sum(x.size for x in self.artifacts.values())
+
+    def evict(self):
+        """
+        Delete released artifacts, least recently used first, until we're back under the size cap
+        """
+        with self.lock:
+            total = self.total_size()
+            if total <= self.max_size:
+                return
+
+            for artifact in list(self.artifacts.values()):
+                if total <= self.max_size:
+                    break
+                if artifact.pinned:
+                    continue
+                total -= artifact.size
+                self._delete(artifact)
+
+            if total > self.max_size:
+                print("Workspace is over its size cap, but everything in it is still in use")
+
+    def flush(self):
+        """
+        Delete everything that isn't still in use
+        Unlike wiping the temp directory, this is safe to do while checks are running
+        """
+        with self.lock:
+            for artifact in list(self.artifacts.values()):
+                if not artifact.pinned:
+                    self._delete(artifact)
+
+            # and anything that isn't being tracked at all
+            for folder, dirs, files in os.walk(self.session_path):
+                for f in files:
+                    path = os.path.join(folder, f)
+                    if path not in self.artifacts:
+                        os.remove(path)
+
+    def _delete(self, artifact):
+        """
+        Expects the lock to be held
+        """
+        self.artifacts.pop(artifact.path, None)
+        if os.path.isfile(artifact.path):
+            os.remove(artifact.path)
+
+
+def pid_is_running(pid):
+    """
+    Windows has no os.kill(pid, 0) equivalent without extra libraries, so we ask tasklist instead
+    """
+    if os.name == 'nt':
+        out = subprocess.run(['tasklist', '/FI', 'PID eq {}'.format(pid)], capture_output=True, text=True).stdout
+        return str(pid) in out
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# There is just the one workspace per running instance
+_workspace = None
+_workspace_lock = threading.Lock()
+
+
+def get_workspace(config):
+    global _workspace
+    with _workspace_lock:
+        if _workspace is None:
+            _workspace = Workspace(config)
+    return _workspace